@@ -0,0 +1,371 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAITING, record_stage
+
+logger = logging.getLogger(__name__)
+
+# 默认限流：接口=每分钟请求数:突发上限
+DEFAULT_RATE_LIMITS = (
+    "/generate-image=20:5,/jobs/generate-image=20:5,/upload=20:5,"
+    "/analyze-image=60:10,/analyze-image/stream=60:10,/analyze-images=10:3"
+)
+# 默认后端并发上限（每个 worker 进程）
+DEFAULT_CONCURRENCY = "comfyui=8,ollama=8"
+
+ANONYMOUS = "anonymous"
+
+
+class AdmissionRejected(Exception):
+    """请求未被接纳，调用方应返回 429 并带上 Retry-After"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _parse_pairs(spec: str) -> Dict[str, str]:
+    """解析 "名称=值,名称=值" 形式的配置"""
+    pairs = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, sep, value = item.strip().partition("=")
+        if not sep:
+            raise ValueError(f"无法解析配置项 {item!r}（格式为 名称=值）")
+        pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class TokenBucket:
+    """令牌桶：按 rate（个/秒）补充令牌，最多积累 burst 个"""
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def take(self, now: float) -> float:
+        """取一个令牌；成功返回 0，否则返回距下一个令牌的秒数"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """按 (客户端, 接口) 的令牌桶限流
+
+    令牌桶数量不超过 max_buckets，超出时淘汰最久未使用的（被淘汰的客户端下次从满桶开始）。
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], max_buckets: int):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+        self.evicted = 0
+
+    @classmethod
+    def parse(cls, spec: str, max_buckets: int) -> "RateLimiter":
+        limits = {}
+        for route, value in _parse_pairs(spec).items():
+            per_minute, _, burst = value.partition(":")
+            try:
+                rate = float(per_minute) / 60
+                limits[route] = (rate, float(burst or max(1.0, rate * 60)))
+            except ValueError:
+                raise ValueError(f"无法解析限流配置 {route}={value}（格式为 接口=每分钟请求数:突发上限）")
+        return cls(limits, max_buckets)
+
+    def check(self, client: str, route: str) -> float:
+        """返回 0 表示放行，否则为建议的重试等待秒数"""
+        limit = self.limits.get(route)
+        if limit is None:
+            return 0.0
+        key = (client, route)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(limit[0], limit[1], now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(now)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limits": {route: {"per_minute": rate * 60, "burst": burst} for route, (rate, burst) in self.limits.items()},
+            "buckets": len(self._buckets),
+            "max_buckets": self.max_buckets,
+            "evicted": self.evicted,
+        }
+
+
+class FairLimiter:
+    """单个后端的并发上限，等待的请求按客户端轮转放行
+
+    每个客户端一个 FIFO 等待队列，空出名额时依次从各客户端的队首放行，
+    发送大量请求的客户端不会挤占其他客户端的名额。等待总数与单个客户端的等待数都有上限，
+    超出时立即拒绝（AdmissionRejected），而不是让请求在队列中超时。
+    """
+
+    def __init__(self, name: str, limit: int, max_waiting: int, max_waiting_per_client: int):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.max_waiting_per_client = max_waiting_per_client
+        self.active = 0
+        self.waiting = 0
+        self.granted = 0
+        self.rejected = 0
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        # 每个名额平均占用的秒数（指数加权），用于估算 Retry-After
+        self._hold: Optional[float] = None
+
+    def retry_after(self, ahead: Optional[int] = None) -> int:
+        """按排在前面的请求数与平均占用时间估算的重试等待秒数"""
+        ahead = self.waiting if ahead is None else ahead
+        hold = self._hold or 1.0
+        return max(1, math.ceil(hold * (ahead + 1) / self.limit))
+
+    def admissible(self, client: str) -> int:
+        """当前是否可以排队；可以时返回 0，否则返回建议的重试等待秒数"""
+        if self.active < self.limit and not self._waiters:
+            return 0
+        if self.waiting >= self.max_waiting or len(self._waiters.get(client, ())) >= self.max_waiting_per_client:
+            return self.retry_after()
+        return 0
+
+    async def acquire(self, client: str, bounded: bool = True):
+        """获取一个名额；bounded=False 时不受等待数上限限制，总是排队等待"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.granted += 1
+            return
+        retry_after = self.admissible(client) if bounded else 0
+        if retry_after:
+            self.rejected += 1
+            raise AdmissionRejected(f"{self.name} 繁忙，请稍后重试", retry_after)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client, deque()).append(future)
+        self._set_waiting(self.waiting + 1)
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已获得名额但调用方已放弃：交给下一个等待者
+                self.release(None)
+            else:
+                self._forget(client, future)
+            record_stage("admission_wait", self.name, time.monotonic() - started, "cancelled")
+            raise
+        record_stage("admission_wait", self.name, time.monotonic() - started)
+
+    def release(self, held: Optional[float]):
+        if held is not None:
+            self._hold = held if self._hold is None else self._hold + 0.2 * (held - self._hold)
+        self.active -= 1
+        self._wake()
+
+    def _forget(self, client: str, future: asyncio.Future):
+        queue = self._waiters.get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self._set_waiting(self.waiting - 1)
+            if not queue:
+                del self._waiters[client]
+
+    def _wake(self):
+        """按客户端轮转放行等待者"""
+        while self.active < self.limit and self._waiters:
+            client, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            self._set_waiting(self.waiting - 1)
+            if queue:
+                self._waiters.move_to_end(client)
+            else:
+                del self._waiters[client]
+            if future.done():
+                continue
+            self.active += 1
+            self.granted += 1
+            future.set_result(None)
+
+    def _set_waiting(self, waiting: int):
+        self.waiting = waiting
+        ADMISSION_WAITING.labels(backend=self.name).set(waiting)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "waiting_clients": len(self._waiters),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "mean_hold_seconds": self._hold,
+        }
+
+
+class FairQueue(asyncio.Queue):
+    """按 key 轮转出队的有界队列
+
+    每个 key 一个 FIFO，出队时在各 key 之间轮流；max_per_key > 0 时单个 key 的排队数也有上限，
+    超出时 put_nowait 抛出 asyncio.QueueFull。key 为 None 的元素共用一个 FIFO，不受 max_per_key 限制。
+    """
+
+    def __init__(self, maxsize: int = 0, key: Callable[[Any], Hashable] = lambda item: None, max_per_key: int = 0):
+        self._key = key
+        self.max_per_key = max_per_key
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue: "OrderedDict[Hashable, Deque[Any]]" = OrderedDict()
+        self._size = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def pending(self, key: Hashable) -> int:
+        return len(self._queue.get(key, ()))
+
+    def put_nowait(self, item):
+        key = self._key(item)
+        if self.max_per_key and key is not None and self.pending(key) >= self.max_per_key:
+            raise asyncio.QueueFull
+        super().put_nowait(item)
+
+    def _put(self, item):
+        self._queue.setdefault(self._key(item), deque()).append(item)
+        self._size += 1
+
+    def _get(self):
+        key, queue = next(iter(self._queue.items()))
+        item = queue.popleft()
+        if queue:
+            self._queue.move_to_end(key)
+        else:
+            del self._queue[key]
+        self._size -= 1
+        return item
+
+
+class AdmissionController:
+    """昂贵接口前的准入控制（状态只在进程内，且有上限）
+
+    - 按客户端与接口的令牌桶限流，超出时在读取请求体之前返回 429
+    - 每个后端（comfyui、ollama）的并发上限，等待的请求按客户端轮转放行
+    - 等待队列已满时立即返回 429，Retry-After 按平均占用时间估算
+    多个 worker 进程时各自计算，实际上限为配置值乘以进程数。
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        rate_limits: Optional[str] = None,
+        concurrency: Optional[str] = None,
+        max_buckets: Optional[int] = None,
+        max_waiting: Optional[int] = None,
+        max_waiting_per_client: Optional[int] = None,
+        client_header: Optional[str] = None,
+    ):
+        """
+        Args:
+            enabled: 默认读取 ADMISSION_ENABLED；关闭时不限流、不限并发，生成任务按提交顺序执行
+            rate_limits: 默认读取 ADMISSION_RATE_LIMITS（接口=每分钟请求数:突发上限，逗号分隔）
+            concurrency: 默认读取 ADMISSION_CONCURRENCY（后端=并发上限，逗号分隔）
+            client_header: 标识客户端的请求头（如反向代理设置的 X-Forwarded-For），默认按连接的 IP
+        """
+        if enabled is None:
+            enabled = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.enabled = enabled
+        if rate_limits is None:
+            rate_limits = os.getenv("ADMISSION_RATE_LIMITS", DEFAULT_RATE_LIMITS)
+        if concurrency is None:
+            concurrency = os.getenv("ADMISSION_CONCURRENCY", DEFAULT_CONCURRENCY)
+        max_buckets = max_buckets or int(os.getenv("ADMISSION_MAX_CLIENTS", "10000"))
+        max_waiting = max_waiting or int(os.getenv("ADMISSION_MAX_WAITING", "64"))
+        max_waiting_per_client = max_waiting_per_client or int(os.getenv("ADMISSION_MAX_WAITING_PER_CLIENT", "4"))
+        header = client_header if client_header is not None else os.getenv("ADMISSION_CLIENT_HEADER", "")
+        self.client_header = header.strip().lower()
+
+        self.rate_limiter = RateLimiter.parse(rate_limits, max_buckets)
+        self.backends: Dict[str, FairLimiter] = {
+            name: FairLimiter(name, int(limit), max_waiting, max_waiting_per_client)
+            for name, limit in _parse_pairs(concurrency).items() if int(limit) > 0
+        }
+
+    def client_id(self, request) -> str:
+        """请求所属的客户端：配置的请求头（取第一个值）或连接的 IP"""
+        if self.client_header:
+            value = request.headers.get(self.client_header, "").split(",")[0].strip()
+            if value:
+                return value
+        return request.client.host if request.client else ANONYMOUS
+
+    def check(self, request) -> int:
+        """按客户端与接口限流；放行返回 0，否则返回 Retry-After 秒数"""
+        if not self.enabled:
+            return 0
+        route = request.url.path
+        wait = self.rate_limiter.check(self.client_id(request), route)
+        if not wait:
+            return 0
+        ADMISSION_REJECTED.labels(route=route, reason="rate_limited").inc()
+        return max(1, math.ceil(wait))
+
+    def admissible(self, backend: str, client: str, route: str = "") -> int:
+        """后端当前能否为该客户端排队；能时返回 0，否则返回 Retry-After 秒数"""
+        limiter = self.backends.get(backend) if self.enabled else None
+        retry_after = limiter.admissible(client) if limiter is not None else 0
+        if retry_after:
+            ADMISSION_REJECTED.labels(route=route, reason=f"{backend}_busy").inc()
+        return retry_after
+
+    def retry_after(self, backend: str, ahead: Optional[int] = None) -> int:
+        limiter = self.backends.get(backend)
+        return limiter.retry_after(ahead) if limiter is not None else 1
+
+    @asynccontextmanager
+    async def slot(self, backend: str, client: Optional[str], route: str = "", bounded: bool = True):
+        """占用后端的一个并发名额；未配置上限时直接执行
+
+        Args:
+            bounded: 等待数超出上限时是否拒绝；已经在任务队列中排过队的生成任务传入 False
+        """
+        limiter = self.backends.get(backend) if self.enabled else None
+        if limiter is None:
+            yield
+            return
+        try:
+            await limiter.acquire(client or ANONYMOUS, bounded)
+        except AdmissionRejected:
+            ADMISSION_REJECTED.labels(route=route, reason=f"{backend}_busy").inc()
+            raise
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            limiter.release(time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "client_header": self.client_header or None,
+            "rate_limits": self.rate_limiter.stats(),
+            "backends": {name: limiter.stats() for name, limiter in self.backends.items()},
+        }
@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from metrics import BATCH_ANALYZE_ITEMS, BATCH_ANALYZE_PREFETCHED
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    """批量分析中的一张图片"""
+    __slots__ = ("index", "source", "data", "prompt")
+
+    def __init__(self, index: int, source: str, data: Any, prompt: Optional[str] = None):
+        self.index = index
+        # 结果中标识图片的字符串：URL 或上传的文件名
+        self.source = source
+        self.data = data
+        self.prompt = prompt
+
+
+class BatchAnalyzer:
+    """/analyze-images 的批量图片分析
+
+    - 同时最多分析 concurrency 张图片（默认 BATCH_ANALYZE_CONCURRENCY）
+    - 分析的同时按提交顺序提前下载后面的最多 prefetch 张（默认 BATCH_ANALYZE_PREFETCH），
+      分析名额空出时图片已在本地
+    - 每张图片完成后立即产出结果（顺序为完成顺序，以 index 对应请求中的位置）；
+      单张失败只产出该图片的错误，不影响其他图片
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, prefetch: Optional[int] = None, max_items: Optional[int] = None):
+        self.concurrency = concurrency or int(os.getenv("BATCH_ANALYZE_CONCURRENCY", "4"))
+        self.prefetch = prefetch if prefetch is not None else int(os.getenv("BATCH_ANALYZE_PREFETCH", "4"))
+        self.max_items = max_items or int(os.getenv("BATCH_ANALYZE_MAX_ITEMS", "64"))
+        self.batches = 0
+        self.running = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    async def run(
+        self,
+        items: List[BatchItem],
+        fetch: Callable[[Any], Awaitable[Any]],
+        analyze: Callable[[Any, Optional[str]], Awaitable[str]],
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """依次产出各图片的结果，最后产出汇总
+
+        Args:
+            fetch: 提前下载图片，返回传给 analyze 的数据
+            analyze: 分析一张图片，返回描述
+        """
+        if len(items) > self.max_items:
+            raise ValueError(f"一次最多分析 {self.max_items} 张图片")
+        # 已下载或正在下载、尚未分析完的图片数上限；信号量先到先得，下载按提交顺序进行
+        window = asyncio.Semaphore(self.concurrency + self.prefetch)
+        slots = asyncio.Semaphore(self.concurrency)
+        results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+        async def one(item: BatchItem):
+            started = time.perf_counter()
+            try:
+                async with window:
+                    data = await fetch(item.data)
+                    BATCH_ANALYZE_PREFETCHED.inc()
+                    try:
+                        await slots.acquire()
+                    finally:
+                        BATCH_ANALYZE_PREFETCHED.dec()
+                    try:
+                        description = await analyze(data, item.prompt)
+                    finally:
+                        slots.release()
+                result = {"index": item.index, "source": item.source, "status": "ok", "prompt": description}
+            except Exception as e:
+                logger.warning("Batch item %d failed (%s): %s", item.index, item.source, e)
+                result = {"index": item.index, "source": item.source, "status": "error", "error": str(e)}
+            result["seconds"] = round(time.perf_counter() - started, 3)
+            results.put_nowait(result)
+
+        self.batches += 1
+        self.running += 1
+        started = time.perf_counter()
+        tasks = [asyncio.ensure_future(one(item)) for item in items]
+        counts = {"ok": 0, "error": 0}
+        try:
+            for _ in items:
+                result = await results.get()
+                counts[result["status"]] += 1
+                BATCH_ANALYZE_ITEMS.labels(outcome=result["status"]).inc()
+                yield result
+        finally:
+            self.running -= 1
+            self.succeeded += counts["ok"]
+            self.failed += counts["error"]
+            # 客户端断开时未完成的图片随之取消
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.cancelled += len(pending)
+                BATCH_ANALYZE_ITEMS.labels(outcome="cancelled").inc(len(pending))
+                await asyncio.gather(*pending, return_exceptions=True)
+        yield {
+            "status": "done",
+            "total": len(items),
+            "succeeded": counts["ok"],
+            "failed": counts["error"],
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "running": self.running,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "concurrency": self.concurrency,
+            "prefetch": self.prefetch,
+            "max_items": self.max_items,
+        }
@@ -0,0 +1,104 @@
+"""生成质量自适应：突发负载下固定完整质量 vs 按 p95 目标降档
+
+按 平稳 → 突发 → 回落 三个阶段以固定到达率（开环）提交生成请求到替身 ComfyUI，
+替身的采样时间按步数与分辨率缩放。分别在关闭（固定完整质量）与开启质量控制器时，
+报告各阶段的端到端延迟 p50/p95、各档位的请求数，以及档位随时间的变化。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_adaptive_quality --target 3 --burst-rate 4
+"""
+import os
+import time
+import asyncio
+import argparse
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.fake_comfyui import FakeComfyUI
+from benchmarks.loadgen import percentile
+
+
+async def _run(args: argparse.Namespace, target: float) -> Dict[str, Any]:
+    os.environ["COMFY_UI_ENDPOINT"] = f"http://127.0.0.1:{args.port}"
+    os.environ.pop("COMFY_UI_WS_ENDPOINT", None)
+
+    # 依赖环境变量，需在设置后导入
+    from http_client import http_clients
+    from comfy_handler import ComfyUIHandler
+    from quality_controller import QualityController
+
+    fake = FakeComfyUI(prompt_overhead=args.overhead, per_image=args.per_image)
+    await fake.start(port=args.port)
+    await http_clients.start()
+    handler = ComfyUIHandler()
+    handler.quality = QualityController(target=target, interval=args.interval, window=args.window)
+    await handler.start()
+
+    phases = [("steady", args.rate, args.phase), ("burst", args.burst_rate, args.phase), ("calm", args.rate, args.phase)]
+    results: List[Tuple[str, str, float]] = []
+    timeline: List[Tuple[float, str]] = []
+    started = time.perf_counter()
+
+    async def one(phase: str, index: int):
+        workflow = handler.prepare_workflow(f"{phase} prompt {index}")
+        quality = handler.describe_quality(workflow)
+        request_started = time.perf_counter()
+        await handler.generate_image("", workflow_data=workflow)
+        latency = time.perf_counter() - request_started
+        handler.quality.record(quality["level"], latency)
+        results.append((phase, quality["tier"], latency))
+
+    try:
+        tasks = []
+        for phase, rate, duration in phases:
+            count = int(rate * duration)
+            for index in range(count):
+                tasks.append(asyncio.ensure_future(one(phase, index)))
+                if not timeline or timeline[-1][1] != handler.quality.tier.name:
+                    timeline.append((time.perf_counter() - started, handler.quality.tier.name))
+                await asyncio.sleep(1 / rate)
+        await asyncio.gather(*tasks)
+    finally:
+        await handler.close()
+        await http_clients.close()
+        await fake.stop()
+
+    return {"results": results, "timeline": timeline, "elapsed": time.perf_counter() - started}
+
+
+def _report(name: str, run: Dict[str, Any], target: float):
+    print(f"== {name} (total {run['elapsed']:.0f}s)")
+    print(f"  {'phase':8s} {'requests':>8s} {'p50 s':>7s} {'p95 s':>7s}  tiers")
+    for phase in ("steady", "burst", "calm", "all"):
+        rows = [row for row in run["results"] if phase == "all" or row[0] == phase]
+        latencies = [latency for _, _, latency in rows]
+        tiers = Counter(tier for _, tier, _ in rows)
+        p95 = percentile(latencies, 0.95)
+        flag = " over target" if target and p95 > target else ""
+        print(f"  {phase:8s} {len(rows):8d} {percentile(latencies, 0.5):7.2f} {p95:7.2f}  "
+              f"{', '.join(f'{tier} {count}' for tier, count in tiers.most_common())}{flag}")
+    if len(run["timeline"]) > 1:
+        print("  tier changes: " + " -> ".join(f"{tier}@{at:.0f}s" for at, tier in run["timeline"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成质量自适应的延迟对比")
+    parser.add_argument("--target", type=float, default=3.0, help="p95 目标（秒）")
+    parser.add_argument("--rate", type=float, default=1.0, help="平稳与回落阶段的到达率（请求/秒）")
+    parser.add_argument("--burst-rate", type=float, default=4.0, help="突发阶段的到达率（请求/秒）")
+    parser.add_argument("--phase", type=float, default=20, help="每个阶段的时长（秒）")
+    parser.add_argument("--overhead", default="0.05", help="替身 ComfyUI 每个 prompt 的固定开销分布")
+    parser.add_argument("--per-image", type=float, default=0.4, help="完整质量下每张图片的采样时间（秒）")
+    parser.add_argument("--interval", type=float, default=1.0, help="控制器调整间隔（秒）")
+    parser.add_argument("--window", type=float, default=10.0, help="控制器统计 p95 的窗口（秒）")
+    parser.add_argument("--port", type=int, default=18190)
+    args = parser.parse_args()
+
+    fixed = asyncio.run(_run(args, 0))
+    adaptive = asyncio.run(_run(args, args.target))
+    _report("fixed full quality", fixed, args.target)
+    _report(f"adaptive, p95 target {args.target:g}s", adaptive, args.target)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""准入控制：一个客户端持续刷生成接口时，其他玩家的生成延迟
+
+在替身服务前启动后端（客户端由 X-Client-ID 区分），同时运行：
+- 1 个贪婪客户端：多个并发连接不停提交 /jobs/generate-image，收到 429 后不等 Retry-After 立即重试
+- 若干普通客户端：逐个同步请求 /generate-image
+依次对比三种配置：off（关闭准入控制，任务按提交顺序执行）、fair（只有按客户端轮转与并发上限）、
+full（再加上令牌桶限流）。检查：
+- 开启后普通客户端的 p95 低于关闭时
+- 所有 429 都带 Retry-After，且没有 5xx
+- 大量不同客户端访问后，令牌桶数量不超过 ADMISSION_MAX_CLIENTS
+任一检查失败时以非零状态退出。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_admission --duration 20 --players 3
+"""
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from typing import Any, Dict
+
+import aiohttp
+
+from benchmarks.loadgen import percentile, spawn_backend, stop_backend
+from benchmarks.stack import FakeStack
+
+MODES = {
+    "off": {"ADMISSION_ENABLED": "false"},
+    "fair": {"ADMISSION_ENABLED": "true", "ADMISSION_RATE_LIMITS": ""},
+    "full": {"ADMISSION_ENABLED": "true"},
+}
+
+
+async def _greedy(session: aiohttp.ClientSession, base: str, deadline: float, stats: Dict[str, Any], index: int):
+    count = 0
+    while time.monotonic() < deadline:
+        count += 1
+        form = {"prompt": f"greedy {index} {count}"}
+        async with session.post(f"{base}/jobs/generate-image", data=form, headers={"X-Client-ID": "greedy"}) as response:
+            await response.read()
+            stats["status"][response.status] += 1
+            if response.status == 429 and "Retry-After" not in response.headers:
+                stats["missing_retry_after"] += 1
+            if response.status != 200:
+                await asyncio.sleep(0.05)
+
+
+async def _player(session: aiohttp.ClientSession, base: str, deadline: float, stats: Dict[str, Any], name: str):
+    count = 0
+    while time.monotonic() < deadline:
+        count += 1
+        started = time.perf_counter()
+        form = {"prompt": f"{name} {count}"}
+        async with session.post(f"{base}/generate-image", data=form, headers={"X-Client-ID": name}) as response:
+            await response.read()
+            stats["status"][response.status] += 1
+            if response.status == 200:
+                stats["latencies"].append(time.perf_counter() - started)
+            elif response.status == 429:
+                if "Retry-After" not in response.headers:
+                    stats["missing_retry_after"] += 1
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+
+async def _many_clients(session: aiohttp.ClientSession, base: str, clients: int) -> Dict[str, Any]:
+    """不同客户端各发一个请求（表单不完整，限流后立即返回 422），之后读取令牌桶数量"""
+    for index in range(clients):
+        async with session.post(f"{base}/analyze-image", headers={"X-Client-ID": f"visitor-{index}"}) as response:
+            await response.read()
+    async with session.get(f"{base}/stats") as response:
+        return (await response.json())["admission"]["rate_limits"]
+
+
+async def _run_mode(stack: FakeStack, mode: str, args: argparse.Namespace) -> Dict[str, Any]:
+    env = {
+        **stack.backend_env(), **MODES[mode],
+        "LOG_LEVEL": "WARNING",
+        "ADMISSION_CLIENT_HEADER": "X-Client-ID",
+        "ADMISSION_CONCURRENCY": f"comfyui={args.concurrency},ollama={args.concurrency}",
+        "ADMISSION_MAX_CLIENTS": str(args.max_clients),
+        "COMFY_UI_DEDUP_WINDOW_MS": "0",
+        "JOB_STORE_DB": "",
+    }
+    process = await spawn_backend(env, args.port, tempfile.mkdtemp(prefix="bench_admission_"))
+    base = f"http://127.0.0.1:{args.port}"
+    greedy = {"status": Counter(), "missing_retry_after": 0}
+    players = {"status": Counter(), "missing_retry_after": 0, "latencies": []}
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+            deadline = time.monotonic() + args.duration
+            await asyncio.gather(
+                *[_greedy(session, base, deadline, greedy, index) for index in range(args.greedy_connections)],
+                *[_player(session, base, deadline, players, f"player-{index}") for index in range(args.players)],
+            )
+            buckets = await _many_clients(session, base, args.max_clients * 3) if mode == "full" else None
+    finally:
+        await stop_backend(process)
+    return {"greedy": greedy, "players": players, "buckets": buckets}
+
+
+async def _run(args: argparse.Namespace) -> bool:
+    stack = FakeStack(ollama_latency=0.05, comfy_latency=args.comfy_latency, per_image=args.per_image,
+                      base_port=args.base_port)
+    await stack.start()
+    results = {}
+    try:
+        for mode in MODES:
+            results[mode] = await _run_mode(stack, mode, args)
+    finally:
+        await stack.stop()
+
+    print(f"{args.duration:g}s per mode, 1 greedy client x{args.greedy_connections} connections, "
+          f"{args.players} players, backend concurrency {args.concurrency}")
+    print(f"{'mode':6s} {'player ok':>9s} {'p50 s':>7s} {'p95 s':>7s} {'player 429':>10s} "
+          f"{'greedy ok':>9s} {'greedy 429':>10s}")
+    for mode, result in results.items():
+        players, greedy = result["players"], result["greedy"]
+        latencies = players["latencies"]
+        print(f"{mode:6s} {len(latencies):9d} {percentile(latencies, 0.5) or 0:7.2f} {percentile(latencies, 0.95) or 0:7.2f} "
+              f"{players['status'][429]:10d} {greedy['status'][200]:9d} {greedy['status'][429]:10d}")
+
+    checks = []
+    off_p95 = percentile(results["off"]["players"]["latencies"], 0.95)
+    for mode in ("fair", "full"):
+        p95 = percentile(results[mode]["players"]["latencies"], 0.95)
+        checks.append((f"player p95 lower with {mode}", p95 is not None and off_p95 is not None and p95 < off_p95,
+                       f"{p95 or 0:.2f}s vs {off_p95 or 0:.2f}s off"))
+    missing = sum(r[who]["missing_retry_after"] for r in results.values() for who in ("greedy", "players"))
+    errors = sum(count for r in results.values() for who in ("greedy", "players")
+                 for status, count in r[who]["status"].items() if status >= 500)
+    checks.append(("429 responses carry Retry-After", missing == 0, f"{missing} without"))
+    checks.append(("no 5xx responses", errors == 0, f"{errors} errors"))
+    buckets = results["full"]["buckets"]
+    checks.append(("rate-limit state bounded", buckets["buckets"] <= args.max_clients,
+                   f"{buckets['buckets']} buckets after {args.max_clients * 3} clients, {buckets['evicted']} evicted"))
+    for name, ok, detail in checks:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:32s} {detail}")
+    return all(ok for _, ok, _ in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="准入控制下普通客户端的生成延迟")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--players", type=int, default=3)
+    parser.add_argument("--greedy-connections", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=2, help="各后端的并发上限")
+    parser.add_argument("--max-clients", type=int, default=200, help="令牌桶数量上限")
+    parser.add_argument("--comfy-latency", default="0.2", help="替身 ComfyUI 每个 prompt 的固定开销分布")
+    parser.add_argument("--per-image", type=float, default=0.2)
+    parser.add_argument("--port", type=int, default=18720)
+    parser.add_argument("--base-port", type=int, default=18730)
+    ok = asyncio.run(_run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""批量图片分析：逐张调用 /analyze-image 与一次 /analyze-images 的对比
+
+替身图床每次下载耗时 --image-latency，替身 Ollama 每次分析耗时 --ollama-latency。
+依次运行：
+- sequential：像前端一样逐张请求 /analyze-image
+- batch-no-prefetch：/analyze-images，不提前下载（BATCH_ANALYZE_PREFETCH=0）
+- batch：/analyze-images，分析的同时提前下载后面的图片
+批量请求中混入 --missing 个不存在的图片 URL 与 --uploads 张上传的图片。检查：
+- 批量总耗时低于逐张请求，提前下载后低于不提前下载
+- 第一个结果在批量完成之前到达（逐行流式返回）
+- 只有不存在的图片失败，其他图片（含上传）都成功，最后一行汇总与之一致
+任一检查失败时以非零状态退出。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_batch_analysis --images 24 --concurrency 4
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from typing import Any, Dict, List
+
+import aiohttp
+
+from benchmarks.loadgen import spawn_backend, stop_backend
+from benchmarks.stack import FakeStack
+
+MODES = {
+    "sequential": {},
+    "batch-no-prefetch": {"BATCH_ANALYZE_PREFETCH": "0"},
+    "batch": {},
+}
+
+
+async def _sequential(session: aiohttp.ClientSession, base: str, urls: List[str]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    first = None
+    statuses = []
+    for url in urls:
+        form = {"objectName": "cup", "image_url": url, "model_type": "olama"}
+        async with session.post(f"{base}/analyze-image", data=form) as response:
+            body = await response.json()
+            statuses.append("ok" if body["code"] == 200 else "error")
+        if first is None:
+            first = time.perf_counter() - started
+    return {"elapsed": time.perf_counter() - started, "first": first, "statuses": statuses, "summary": None}
+
+
+async def _batch(session: aiohttp.ClientSession, base: str, urls: List[str], uploads: List[bytes]) -> Dict[str, Any]:
+    form = aiohttp.FormData()
+    form.add_field("objectName", "cup")
+    for url in urls:
+        form.add_field("image_url", url)
+    for index, photo in enumerate(uploads):
+        form.add_field("images", photo, filename=f"upload-{index}.jpg", content_type="image/jpeg")
+    started = time.perf_counter()
+    first = None
+    results: List[Dict[str, Any]] = []
+    summary = None
+    async with session.post(f"{base}/analyze-images", data=form) as response:
+        if response.status != 200:
+            raise RuntimeError(f"/analyze-images 返回 {response.status}: {await response.text()}")
+        async for line in response.content:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result["status"] == "done":
+                summary = result
+                continue
+            if first is None:
+                first = time.perf_counter() - started
+            results.append(result)
+    results.sort(key=lambda result: result["index"])
+    return {
+        "elapsed": time.perf_counter() - started,
+        "first": first,
+        "statuses": [result["status"] for result in results],
+        "sources": [result["source"] for result in results],
+        "summary": summary,
+    }
+
+
+async def _run_mode(stack: FakeStack, mode: str, args: argparse.Namespace) -> Dict[str, Any]:
+    env = {
+        **stack.backend_env(), **MODES[mode],
+        "LOG_LEVEL": "WARNING",
+        "VISION_CACHE_DB": "",
+        "BATCH_ANALYZE_CONCURRENCY": str(args.concurrency),
+    }
+    process = await spawn_backend(env, args.port, tempfile.mkdtemp(prefix="bench_batch_"))
+    base = f"http://127.0.0.1:{args.port}"
+    # 图片名各不相同，避免命中描述缓存；不存在的图片放在中间
+    urls = [stack.image_url(f"{mode}-{index}") for index in range(args.images)]
+    for index in range(args.missing):
+        urls.insert(len(urls) // 2, stack.image_url(f"missing-{mode}-{index}"))
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+            if mode == "sequential":
+                return await _sequential(session, base, urls)
+            return await _batch(session, base, urls, [stack.photo + f"{mode}-{index}".encode() for index in range(args.uploads)])
+    finally:
+        await stop_backend(process)
+
+
+async def _run(args: argparse.Namespace) -> bool:
+    stack = FakeStack(ollama_latency=args.ollama_latency, comfy_latency=0, base_port=args.base_port,
+                      image_latency=args.image_latency)
+    await stack.start()
+    results = {}
+    try:
+        for mode in MODES:
+            results[mode] = await _run_mode(stack, mode, args)
+    finally:
+        await stack.stop()
+
+    print(f"{args.images} images + {args.missing} missing, {args.uploads} uploads in batches, "
+          f"download {args.image_latency:g}s, analysis {args.ollama_latency}s, concurrency {args.concurrency}")
+    print(f"  {'mode':18s} {'total s':>8s} {'first s':>8s} {'ok':>4s} {'error':>6s}")
+    for mode, result in results.items():
+        statuses = result["statuses"]
+        print(f"  {mode:18s} {result['elapsed']:8.2f} {result['first']:8.2f} "
+              f"{statuses.count('ok'):4d} {statuses.count('error'):6d}")
+
+    checks = []
+    sequential, batch, no_prefetch = results["sequential"], results["batch"], results["batch-no-prefetch"]
+    checks.append(("batch faster than sequential", batch["elapsed"] < sequential["elapsed"],
+                   f"{batch['elapsed']:.2f}s vs {sequential['elapsed']:.2f}s"))
+    checks.append(("prefetch faster than no prefetch", batch["elapsed"] < no_prefetch["elapsed"],
+                   f"{batch['elapsed']:.2f}s vs {no_prefetch['elapsed']:.2f}s"))
+    checks.append(("first result streamed early", batch["first"] < batch["elapsed"] / 2,
+                   f"{batch['first']:.2f}s of {batch['elapsed']:.2f}s"))
+    for mode in ("batch", "batch-no-prefetch"):
+        result = results[mode]
+        failed = [source for source, status in zip(result["sources"], result["statuses"]) if status == "error"]
+        expected = args.images + args.uploads
+        summary = result["summary"] or {}
+        ok = (result["statuses"].count("ok") == expected and len(failed) == args.missing
+              and all("missing" in source for source in failed)
+              and (summary.get("total"), summary.get("succeeded"), summary.get("failed"))
+              == (expected + args.missing, expected, args.missing))
+        checks.append((f"{mode}: only missing images fail", ok,
+                       f"{result['statuses'].count('ok')} ok, {len(failed)} failed, summary {result['summary']}"))
+    for name, ok, detail in checks:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:44s} {detail}")
+    return all(ok for _, ok, _ in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量图片分析与逐张请求的对比")
+    parser.add_argument("--images", type=int, default=24, help="图片 URL 数量")
+    parser.add_argument("--missing", type=int, default=2, help="混入的不存在图片数量")
+    parser.add_argument("--uploads", type=int, default=2, help="批量请求中上传的图片数量")
+    parser.add_argument("--concurrency", type=int, default=4, help="BATCH_ANALYZE_CONCURRENCY")
+    parser.add_argument("--image-latency", type=float, default=0.3, help="替身图床每次下载的耗时（秒）")
+    parser.add_argument("--ollama-latency", default="0.3", help="替身 Ollama 每次分析的耗时分布")
+    parser.add_argument("--port", type=int, default=18760)
+    parser.add_argument("--base-port", type=int, default=18770)
+    ok = asyncio.run(_run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""生成请求去重的吞吐对比：逐个提交 vs 在窗口内合并完全相同的请求
+
+同时发出 --requests 个生成请求，分别在关闭与开启去重（--window-ms）时测量吞吐与提交的 prompt 数：
+- distinct：提示词各不相同，不应合并
+- duplicate：提示词相同、固定种子，只生成一次，所有请求共享同一张图片
+- random-seed：提示词相同、随机种子，工作流各不相同，不应合并，每个请求各得一张
+任一检查失败时以非零状态退出。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_dedup --requests 16
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from typing import Any, Dict
+
+from benchmarks.fake_comfyui import FakeComfyUI
+
+SCENARIOS = ("distinct", "duplicate", "random-seed")
+
+
+async def _run(args: argparse.Namespace, scenario: str, window: float) -> Dict[str, Any]:
+    os.environ["COMFY_UI_ENDPOINT"] = f"http://127.0.0.1:{args.port}"
+    os.environ.pop("COMFY_UI_ENDPOINTS", None)
+    os.environ.pop("COMFY_UI_WS_ENDPOINT", None)
+
+    # 依赖环境变量，需在设置后导入
+    from http_client import http_clients
+    from comfy_handler import ComfyUIHandler
+    from generation_dedup import GenerationDeduplicator
+
+    fake = FakeComfyUI()
+    await fake.start(port=args.port)
+    await http_clients.start()
+    handler = ComfyUIHandler()
+    handler.randomize_seed = scenario == "random-seed"
+    await handler.start()
+    dedup = GenerationDeduplicator(handler, window=window)
+    prompts = [f"benchmark prompt {i}" if scenario == "distinct" else "benchmark prompt" for i in range(args.requests)]
+    try:
+        started = time.perf_counter()
+        urls = await asyncio.gather(*[dedup.generate_image(handler.prepare_workflow(prompt)) for prompt in prompts])
+        elapsed = time.perf_counter() - started
+    finally:
+        await handler.close()
+        await http_clients.close()
+        await fake.stop()
+
+    return {
+        "elapsed": elapsed,
+        "throughput": args.requests / elapsed,
+        "prompts": fake.prompts_executed,
+        "images": len(set(urls)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成请求去重的吞吐对比")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--window-ms", type=float, default=50)
+    parser.add_argument("--port", type=int, default=18188)
+    args = parser.parse_args()
+
+    results = {}
+    for scenario in SCENARIOS:
+        results[scenario] = (
+            asyncio.run(_run(args, scenario, 0)),
+            asyncio.run(_run(args, scenario, args.window_ms / 1000)),
+        )
+
+    print(f"{args.requests} concurrent requests, window {args.window_ms:g} ms, fake ComfyUI")
+    print(f"  {'scenario':12s} {'mode':8s} {'total s':>8s} {'req/s':>7s} {'prompts':>8s} {'images':>7s}")
+    for scenario, (baseline, deduplicated) in results.items():
+        for name, result in (("off", baseline), ("dedup", deduplicated)):
+            print(f"  {scenario:12s} {name:8s} {result['elapsed']:8.2f} {result['throughput']:7.2f} "
+                  f"{result['prompts']:8d} {result['images']:7d}")
+        print(f"  {scenario:12s} speedup  {deduplicated['throughput'] / baseline['throughput']:.2f}x")
+
+    checks = []
+    distinct = results["distinct"][1]
+    checks.append(("distinct: not merged", distinct["prompts"] == args.requests,
+                   f"{distinct['prompts']} prompts for {args.requests} requests"))
+    duplicate = results["duplicate"][1]
+    checks.append(("duplicate: generated once", duplicate["prompts"] == 1 and duplicate["images"] == 1,
+                   f"{duplicate['prompts']} prompts, {duplicate['images']} distinct images"))
+    random_seed = results["random-seed"][1]
+    checks.append(("random-seed: one image per request",
+                   random_seed["prompts"] == args.requests and random_seed["images"] == args.requests,
+                   f"{random_seed['images']} distinct images in {random_seed['prompts']} prompts"))
+    for name, ok, detail in checks:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:36s} {detail}")
+    sys.exit(0 if all(ok for _, ok, _ in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
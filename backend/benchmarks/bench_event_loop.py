@@ -0,0 +1,146 @@
+"""慢 LLM 调用进行中时，/health 是否仍能及时响应
+
+在本进程中用 uvicorn 运行后端（替身服务提供 Ollama 与 ComfyUI），在同一事件循环里
+同时发起 --calls 个慢 LLM 调用，期间在独立线程中每隔 --probe-interval 秒请求一次 /health：
+- ollama：OllamaHandler 经原生异步 HTTP 调用替身 Ollama（每次耗时 --delay 秒）
+- sync-sdk：只有同步接口的厂商SDK（如 Gemini），经有界线程池执行（替身为 time.sleep）
+- blocking：对照组，在协程中直接调用同步函数（改动前的写法），/health 应被卡住
+另外检查 LLM_TIMEOUT 能中断进行中的调用。任一检查失败时以非零状态退出。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_event_loop --calls 10 --delay 2
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import http.client
+from typing import Any, Dict, List
+
+from benchmarks.loadgen import percentile
+from benchmarks.stack import FakeStack
+
+
+def _probe(url: str, interval: float, stop: threading.Event, latencies: List[float]):
+    """在独立线程中探测 /health：事件循环被卡住时探测本身不受影响"""
+    connection = http.client.HTTPConnection(url, timeout=60)
+    while not stop.is_set():
+        started = time.perf_counter()
+        connection.request("GET", "/health")
+        connection.getresponse().read()
+        latencies.append(time.perf_counter() - started)
+        stop.wait(interval)
+    connection.close()
+
+
+async def _measure(address: str, calls, args: argparse.Namespace) -> Dict[str, Any]:
+    stop = threading.Event()
+    latencies: List[float] = []
+    probe = threading.Thread(target=_probe, args=(address, args.probe_interval, stop, latencies), daemon=True)
+    probe.start()
+    # 先让探测请求建立连接
+    await asyncio.sleep(args.probe_interval * 2)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[call() for call in calls], return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    # 最后一次探测需要事件循环响应
+    while probe.is_alive():
+        await asyncio.sleep(0.01)
+    errors = [result for result in results if isinstance(result, Exception)]
+    return {"elapsed": elapsed, "errors": errors, "health": latencies}
+
+
+async def _run(args: argparse.Namespace) -> bool:
+    stack = FakeStack(ollama_latency=args.delay, comfy_latency=0, base_port=args.base_port)
+    await stack.start()
+    os.environ.update(stack.backend_env())
+    os.environ.update({"LOG_LEVEL": "WARNING", "JOB_STORE_DB": "", "VISION_CACHE_DB": "", "OLLAMA_PRELOAD": "false"})
+    # 后端在工作目录下创建 static 与 shared_state
+    os.chdir(tempfile.mkdtemp(prefix="bench_event_loop_"))
+
+    # 依赖环境变量，需在设置后导入
+    import uvicorn
+    import main
+    from llm_handlers import LLMHandler, OllamaHandler
+
+    class SyncSDKHandler(LLMHandler):
+        """只有同步接口的厂商SDK：经有界线程池执行"""
+        async def generate_description(self, image_data, prompt):
+            return await self._handle_timeout(self._run_blocking(time.sleep, args.delay))
+
+    class BlockingHandler(LLMHandler):
+        """对照组：在协程中直接调用同步函数"""
+        async def generate_description(self, image_data, prompt):
+            time.sleep(args.blocking_delay)
+            return ""
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    serving = asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    address = f"127.0.0.1:{args.port}"
+    results = {}
+    try:
+        for name, handler in (("ollama", OllamaHandler()), ("sync-sdk", SyncSDKHandler()), ("blocking", BlockingHandler())):
+            calls = [lambda index=index: handler.generate_description(None, f"slow call {index}") for index in range(args.calls)]
+            results[name] = await _measure(address, calls, args)
+        # 超时应在调用进行中生效，而不是等调用返回后才报告
+        handler = OllamaHandler()
+        handler.timeout = args.delay / 4
+        started = time.perf_counter()
+        try:
+            await handler.generate_description(None, "timeout check")
+            timed_out = False
+        except Exception:
+            timed_out = True
+        timeout_elapsed = time.perf_counter() - started
+    finally:
+        server.should_exit = True
+        await serving
+        await stack.stop()
+
+    print(f"{args.calls} concurrent LLM calls, {args.delay:g}s each (blocking control {args.blocking_delay:g}s), "
+          f"/health every {args.probe_interval * 1000:.0f} ms")
+    print(f"  {'mode':10s} {'calls s':>8s} {'errors':>7s} {'probes':>7s} {'health p50 ms':>14s} {'health max ms':>14s}")
+    for name, result in results.items():
+        health = result["health"]
+        print(f"  {name:10s} {result['elapsed']:8.2f} {len(result['errors']):7d} {len(health):7d} "
+              f"{percentile(health, 0.5) * 1000:14.1f} {max(health) * 1000:14.1f}")
+
+    checks = []
+    for name in ("ollama", "sync-sdk"):
+        result = results[name]
+        worst = max(result["health"])
+        checks.append((f"{name}: /health responsive", worst < args.health_limit and not result["errors"],
+                       f"max {worst * 1000:.0f} ms, {len(result['errors'])} errors"))
+    worst = max(results["blocking"]["health"])
+    checks.append(("blocking control: /health stalled", worst >= args.health_limit,
+                   f"max {worst * 1000:.0f} ms (shows the probe detects a blocked loop)"))
+    checks.append(("timeout interrupts a slow call", timed_out and timeout_elapsed < args.delay / 2,
+                   f"{'raised' if timed_out else 'returned'} after {timeout_elapsed:.2f}s"))
+    for name, ok, detail in checks:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:36s} {detail}")
+    return all(ok for _, ok, _ in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="慢 LLM 调用期间 /health 的响应时间")
+    parser.add_argument("--calls", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=2.0, help="每个 LLM 调用的耗时（秒）")
+    parser.add_argument("--blocking-delay", type=float, default=0.3, help="对照组每个同步调用的耗时（秒）")
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="/health 探测间隔（秒）")
+    parser.add_argument("--health-limit", type=float, default=0.25, help="/health 最长允许延迟（秒）")
+    parser.add_argument("--port", type=int, default=18820)
+    parser.add_argument("--base-port", type=int, default=18830)
+    logging.basicConfig(level=logging.ERROR)
+    ok = asyncio.run(_run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""图库页面的图片流量：原图每次重新下载 vs 缩略图 + ETag 协商
+
+在独立的后端进程的图片存储中放入若干张生成图大小的 PNG，模拟多次浏览同一图库：
+- original：每次浏览都完整下载原图（改动前的行为）
+- variant：首次浏览下载 ?w= 的 WebP 缩略图，之后带 If-None-Match 重新验证（304）
+另外报告缩略图首次生成（进程池）与命中磁盘缓存时的延迟。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_image_delivery --images 12 --visits 5 --width 320
+"""
+import io
+import os
+import time
+import asyncio
+import hashlib
+import argparse
+import tempfile
+from typing import Dict, List
+
+import aiohttp
+from PIL import Image, ImageFilter
+
+from benchmarks.loadgen import percentile, spawn_backend
+
+
+def _make_render(seed: int, size: int) -> bytes:
+    """生成一张接近扩散模型输出的 PNG：平滑的色块加少量纹理"""
+    noise = Image.effect_noise((size // 8, size // 8), 96).resize((size, size), Image.BICUBIC)
+    base = Image.merge("RGB", (noise, noise.rotate(90 + seed), Image.linear_gradient("L").resize((size, size))))
+    detail = Image.effect_noise((size, size), 24).convert("RGB")
+    image = Image.blend(base, detail, 0.15).filter(ImageFilter.SMOOTH)
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+async def _visit(session: aiohttp.ClientSession, urls: List[str], etags: Dict[str, str], stats: Dict[str, float]):
+    async def fetch(url: str):
+        headers = {"Accept": "image/avif,image/webp,*/*"}
+        if url in etags:
+            headers["If-None-Match"] = etags[url]
+        started = time.perf_counter()
+        async with session.get(url, headers=headers) as response:
+            body = await response.read()
+            if response.status == 200 and response.headers.get("ETag") and "w=" in url:
+                etags[url] = response.headers["ETag"]
+            stats["bytes"] += len(body)
+            stats["not_modified"] += response.status == 304
+        stats.setdefault("latencies", []).append(time.perf_counter() - started)
+
+    await asyncio.gather(*[fetch(url) for url in urls])
+
+
+async def _run(args: argparse.Namespace):
+    workdir = tempfile.mkdtemp(prefix="bench_images_")
+    store = os.path.join(workdir, "backend", "static", "images")
+    os.makedirs(store)
+    names = []
+    for seed in range(args.images):
+        data = _make_render(seed, args.size)
+        name = hashlib.sha256(data).hexdigest()[:32] + ".png"
+        with open(os.path.join(store, name), "wb") as f:
+            f.write(data)
+        names.append(name)
+    original_bytes = sum(os.path.getsize(os.path.join(store, name)) for name in names)
+
+    process = await spawn_backend({"LOG_LEVEL": "WARNING", "COMFY_UI_OUTPUT_DIR": workdir}, args.port, workdir)
+    base = f"http://127.0.0.1:{args.port}/static/images/"
+    results = {}
+    try:
+        async with aiohttp.ClientSession() as session:
+            for mode, query in (("original", ""), ("variant", f"?w={args.width}")):
+                urls = [base + name + query for name in names]
+                stats: Dict[str, float] = {"bytes": 0, "not_modified": 0}
+                etags: Dict[str, str] = {}
+                started = time.perf_counter()
+                visit_times = []
+                for _ in range(args.visits):
+                    visit_started = time.perf_counter()
+                    await _visit(session, urls, etags, stats)
+                    visit_times.append(time.perf_counter() - visit_started)
+                stats["elapsed"] = time.perf_counter() - started
+                stats["first_visit"] = visit_times[0]
+                stats["repeat_visit"] = sum(visit_times[1:]) / max(len(visit_times) - 1, 1)
+                results[mode] = stats
+
+            # 缩略图：首次生成与命中磁盘缓存的延迟（换一个档位，确保未生成过）
+            cold, warm = [], []
+            for name in names:
+                url = f"{base}{name}?w={args.width * 2}&format=jpeg"
+                for bucket in (cold, warm):
+                    started = time.perf_counter()
+                    async with session.get(url) as response:
+                        await response.read()
+                    bucket.append(time.perf_counter() - started)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    kb = 1024
+    print(f"{args.images} images of {args.size}x{args.size} PNG, {original_bytes / args.images / kb:.0f} KB each; "
+          f"{args.visits} gallery visits")
+    print(f"{'mode':10s} {'transferred':>12s} {'304s':>6s} {'first visit':>12s} {'repeat visit':>13s}")
+    for mode, stats in results.items():
+        print(f"{mode:10s} {stats['bytes'] / kb:9.0f} KB {int(stats['not_modified']):6d} "
+              f"{stats['first_visit'] * 1000:9.0f} ms {stats['repeat_visit'] * 1000:10.0f} ms")
+    saved = 1 - results["variant"]["bytes"] / results["original"]["bytes"]
+    print(f"bandwidth saved {saved * 100:.1f}%")
+    print(f"variant w{args.width * 2} jpeg  first request p50 {percentile(cold, 0.5) * 1000:.0f} ms, "
+          f"cached p50 {percentile(warm, 0.5) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片分发的流量与延迟")
+    parser.add_argument("--images", type=int, default=12)
+    parser.add_argument("--size", type=int, default=768)
+    parser.add_argument("--visits", type=int, default=5)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--port", type=int, default=18620)
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""LLM 服务管理：对冲请求的尾延迟，以及主服务故障时熔断与旧的退避重试的对比
+
+两个替身分别作为主服务（Ollama 接口）与备用服务（OpenAI 兼容接口）：
+- tail：主备延迟均为长尾分布，对比不对冲与对冲时的 p50/p95/p99 及额外请求量
+- outage：主服务全部返回 500，对比旧的 tenacity 退避重试（--legacy，较慢）、
+  仅失败切换（不熔断）与熔断后的延迟和主服务请求量
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_llm_providers --requests 200 --hedge-ms 600 --legacy
+--legacy 需要另外安装 tenacity（pip install tenacity），后端本身不再依赖它。
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import argparse
+from typing import Any, Dict, List
+
+from benchmarks.fake_ollama import FakeOllama
+from benchmarks.loadgen import percentile
+
+
+async def _drive(call, requests: int, concurrency: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for index in remaining:
+            started = time.perf_counter()
+            try:
+                await call(f"describe object {index}")
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return {"p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99), "errors": errors}
+
+
+async def _run(args: argparse.Namespace):
+    random.seed(args.seed)
+    primary = FakeOllama(latency=args.latency, per_mb=0, tokens=5)
+    secondary = FakeOllama(latency=args.latency, per_mb=0, tokens=5)
+    await primary.start(port=args.base_port)
+    await secondary.start(port=args.base_port + 1)
+    os.environ["OLLAMA_API_ENDPOINT"] = f"http://127.0.0.1:{args.base_port}/api/generate"
+    os.environ["OPENAI_API_ENDPOINT"] = f"http://127.0.0.1:{args.base_port + 1}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+
+    # 依赖环境变量，需在设置后导入
+    from http_client import http_clients
+    from llm_handlers import OllamaHandler, OpenAIHandler
+    from llm_providers import LLMProviderManager
+
+    await http_clients.start()
+    handlers = {"olama": OllamaHandler(), "openai": OpenAIHandler()}
+    rows = []
+
+    def manager(**kwargs) -> LLMProviderManager:
+        return LLMProviderManager(["olama", "openai"], handlers=handlers, **kwargs)
+
+    async def scenario(name: str, call, requests: int):
+        before = (primary.requests, secondary.requests)
+        result = await _drive(call, requests, args.concurrency)
+        result.update(name=name, requests=requests,
+                      primary=primary.requests - before[0], secondary=secondary.requests - before[1])
+        rows.append(result)
+
+    try:
+        plain = manager(hedge_delay=0)
+        hedged = manager(hedge_delay=args.hedge_ms / 1000)
+        await scenario("tail / no hedge", lambda p: plain.generate_description(None, p), args.requests)
+        await scenario(f"tail / hedge {args.hedge_ms:g}ms", lambda p: hedged.generate_description(None, p), args.requests)
+
+        primary.failure_rate = 1.0
+        if args.legacy:
+            from tenacity import retry, stop_after_attempt, wait_exponential
+
+            # 改动前各处理器上的退避重试
+            @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+            async def legacy(prompt):
+                return await handlers["olama"].generate_description(None, prompt)
+            await scenario("outage / legacy retry", legacy, args.concurrency * 2)
+        failover = manager(hedge_delay=0, failure_threshold=10 ** 9)
+        breaker = manager(hedge_delay=0, failure_threshold=3, reset_timeout=30)
+        await scenario("outage / failover only", lambda p: failover.generate_description(None, p), args.requests)
+        await scenario("outage / breaker", lambda p: breaker.generate_description(None, p), args.requests)
+    finally:
+        await http_clients.close()
+        await primary.stop()
+        await secondary.stop()
+
+    print(f"latency {args.latency}, concurrency {args.concurrency}")
+    print(f"{'scenario':24s} {'req':>5s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'errors':>7s} "
+          f"{'primary':>8s} {'secondary':>9s}")
+    for row in rows:
+        print(f"{row['name']:24s} {row['requests']:5d} {row['p50'] * 1000:8.0f} {row['p95'] * 1000:8.0f} "
+              f"{row['p99'] * 1000:8.0f} {row['errors']:7d} {row['primary']:8d} {row['secondary']:9d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM 服务对冲与熔断")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", default="lognormal:0.2:0.8", help="两个替身的延迟分布")
+    parser.add_argument("--hedge-ms", type=float, default=400, help="对冲延迟（毫秒）")
+    parser.add_argument("--legacy", action="store_true", help="同时测量旧的退避重试（每个请求约 8 秒；需 pip install tenacity）")
+    parser.add_argument("--base-port", type=int, default=18800)
+    parser.add_argument("--seed", type=int, default=0)
+    # 失败切换与熔断的日志会刷屏
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
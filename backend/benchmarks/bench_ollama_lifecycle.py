@@ -0,0 +1,164 @@
+"""Ollama 模型生命周期：预载入、keep_alive 与保活 ping、每个模型的并发上限
+
+替身 Ollama 首次使用模型时耗时 --model-load 载入，空闲超过 --ollama-keep-alive 秒后卸载。
+- idle：后端启动后等待片刻发出第一个 /analyze-image，再空闲一段（长于替身的默认 keep_alive）后
+  发出第二个，报告两次请求的延迟与模型载入次数。依次对比：
+  off（不预载入、不带 keep_alive、不 ping）、keep_alive（预载入并带上较长的 keep_alive）、
+  ping（预载入，keep_alive 仍用 Ollama 默认值，靠有流量期间的定时 ping 保活）
+- burst：替身同时处理超过 --ollama-parallel 个请求时互相争抢变慢，同时发出 --burst 个请求，
+  对比不限并发与每个模型并发上限为 --ollama-parallel 时的 p95 与总耗时
+任一检查失败时以非零状态退出。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_ollama_lifecycle --model-load 2 --idle 8
+"""
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from typing import Any, Dict, List
+
+import aiohttp
+
+from benchmarks.loadgen import percentile, spawn_backend, stop_backend
+from benchmarks.stack import FakeStack
+
+IDLE_MODES = {
+    "off": {"OLLAMA_PRELOAD": "false", "OLLAMA_KEEP_ALIVE": "", "OLLAMA_PING_INTERVAL": "0"},
+    "keep_alive": {"OLLAMA_PRELOAD": "true", "OLLAMA_KEEP_ALIVE": "10m", "OLLAMA_PING_INTERVAL": "0"},
+    "ping": {"OLLAMA_PRELOAD": "true", "OLLAMA_KEEP_ALIVE": ""},
+}
+
+
+def _reset(stack: FakeStack):
+    """每次启动后端都视为新的 Ollama 进程：模型需重新载入"""
+    ollama = stack.ollama
+    ollama.loaded.clear()
+    ollama._expires.clear()
+    ollama.loads = ollama.unloads = ollama.max_in_flight = 0
+
+
+async def _analyze(session: aiohttp.ClientSession, base: str, stack: FakeStack, name: str) -> float:
+    # 物体名称各不相同，避免命中描述缓存
+    form = {"objectName": name, "image_url": stack.image_url(name), "model_type": "olama"}
+    started = time.perf_counter()
+    async with session.post(f"{base}/analyze-image", data=form) as response:
+        await response.read()
+        if response.status != 200:
+            raise RuntimeError(f"/analyze-image 返回 {response.status}")
+    return time.perf_counter() - started
+
+
+async def _backend(stack: FakeStack, args: argparse.Namespace, overrides: Dict[str, str]):
+    env = {**stack.backend_env(), "LOG_LEVEL": "WARNING", "VISION_CACHE_DB": "", **overrides}
+    _reset(stack)
+    return await spawn_backend(env, args.port, tempfile.mkdtemp(prefix="bench_ollama_"))
+
+
+async def _idle_mode(stack: FakeStack, args: argparse.Namespace, mode: str) -> Dict[str, Any]:
+    overrides = {**IDLE_MODES[mode], "OLLAMA_MODEL_CONCURRENCY": "0"}
+    overrides.setdefault("OLLAMA_PING_INTERVAL", str(args.ollama_keep_alive / 3))
+    process = await _backend(stack, args, overrides)
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        # 空闲时间长于 uvicorn 的 keep-alive（5 秒），每个请求使用新连接
+        connector = aiohttp.TCPConnector(force_close=True)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # 用户打开页面到第一次识别之间的时间，预载入在这段时间内完成
+            await asyncio.sleep(args.model_load + 1)
+            first = await _analyze(session, base, stack, f"{mode}-first")
+            await asyncio.sleep(args.idle)
+            second = await _analyze(session, base, stack, f"{mode}-second")
+            async with session.get(f"{base}/stats") as response:
+                models = (await response.json())["ollama"]["models"]
+    finally:
+        await stop_backend(process)
+    pings = sum(model["pings"] for model in models.values())
+    return {"first": first, "second": second, "loads": stack.ollama.loads, "models": len(models), "pings": pings}
+
+
+async def _burst_mode(stack: FakeStack, args: argparse.Namespace, concurrency: int) -> Dict[str, Any]:
+    overrides = {"OLLAMA_PRELOAD": "true", "OLLAMA_MODEL_CONCURRENCY": str(concurrency)}
+    process = await _backend(stack, args, overrides)
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=600)) as session:
+            await asyncio.sleep(args.model_load + 1)
+            started = time.perf_counter()
+            latencies: List[float] = await asyncio.gather(
+                *[_analyze(session, base, stack, f"burst-{concurrency}-{index}") for index in range(args.burst)]
+            )
+            makespan = time.perf_counter() - started
+    finally:
+        await stop_backend(process)
+    return {"latencies": latencies, "makespan": makespan, "max_in_flight": stack.ollama.max_in_flight}
+
+
+async def _run(args: argparse.Namespace) -> bool:
+    stack = FakeStack(ollama_latency=args.ollama_latency, comfy_latency=0, base_port=args.base_port)
+    ollama = stack.ollama
+    ollama.load_time = args.model_load
+    ollama.keep_alive = args.ollama_keep_alive
+    await stack.start()
+    idle, burst = {}, {}
+    try:
+        for mode in IDLE_MODES:
+            idle[mode] = await _idle_mode(stack, args, mode)
+        ollama.parallel = args.ollama_parallel
+        ollama.thrash = args.thrash
+        for name, concurrency in (("unlimited", 0), ("gated", args.ollama_parallel)):
+            burst[name] = await _burst_mode(stack, args, concurrency)
+    finally:
+        await stack.stop()
+
+    print(f"idle: model load {args.model_load:g}s, Ollama default keep_alive {args.ollama_keep_alive:g}s, "
+          f"gap {args.idle:g}s")
+    print(f"  {'mode':10s} {'first s':>8s} {'after gap s':>11s} {'loads':>6s} {'pings':>6s}")
+    for mode, result in idle.items():
+        print(f"  {mode:10s} {result['first']:8.2f} {result['second']:11.2f} {result['loads']:6d} {result['pings']:6d}")
+    print(f"burst: {args.burst} parallel requests, Ollama parallel {args.ollama_parallel}, thrash {args.thrash:g}")
+    print(f"  {'mode':10s} {'p50 s':>7s} {'p95 s':>7s} {'makespan s':>10s} {'max in flight':>13s}")
+    for name, result in burst.items():
+        latencies = result["latencies"]
+        print(f"  {name:10s} {percentile(latencies, 0.5):7.2f} {percentile(latencies, 0.95):7.2f} "
+              f"{result['makespan']:10.2f} {result['max_in_flight']:13d}")
+
+    checks = []
+    for mode in ("keep_alive", "ping"):
+        result = idle[mode]
+        # 预载入的视觉模型与 LLM 模型各载入一次，之后不再载入
+        checks.append((f"{mode}: no load on the request path",
+                       result["loads"] == result["models"] and max(result["first"], result["second"]) < args.model_load,
+                       f"{result['loads']} loads of {result['models']} models, slowest {max(result['first'], result['second']):.2f}s"))
+    checks.append(("ping: pings sent during traffic", idle["ping"]["pings"] > 0, f"{idle['ping']['pings']} pings"))
+    checks.append(("off: model reloaded after the gap", idle["off"]["loads"] == 2, f"{idle['off']['loads']} loads"))
+    gated, unlimited = burst["gated"], burst["unlimited"]
+    checks.append(("gated: Ollama in-flight bounded", gated["max_in_flight"] <= args.ollama_parallel,
+                   f"max {gated['max_in_flight']}"))
+    gated_p95, unlimited_p95 = percentile(gated["latencies"], 0.95), percentile(unlimited["latencies"], 0.95)
+    checks.append(("gated: burst p95 lower", gated_p95 < unlimited_p95,
+                   f"{gated_p95:.2f}s vs {unlimited_p95:.2f}s unlimited"))
+    for name, ok, detail in checks:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:40s} {detail}")
+    return all(ok for _, ok, _ in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama 模型预载入、保活与并发上限")
+    parser.add_argument("--model-load", type=float, default=2.0, help="替身 Ollama 载入模型的耗时（秒）")
+    parser.add_argument("--ollama-keep-alive", type=float, default=3.0, help="替身 Ollama 默认的空闲卸载时间（秒）")
+    parser.add_argument("--idle", type=float, default=8.0, help="两次请求之间的空闲时间（秒）")
+    parser.add_argument("--ollama-latency", default="0.3", help="替身 Ollama 每个请求的耗时分布")
+    parser.add_argument("--ollama-parallel", type=int, default=2, help="替身 Ollama 不变慢的并行请求数，也是 gated 的并发上限")
+    parser.add_argument("--thrash", type=float, default=0.5, help="超出并行数后每多一个请求额外增加的争抢开销比例")
+    parser.add_argument("--burst", type=int, default=16)
+    parser.add_argument("--port", type=int, default=18740)
+    parser.add_argument("--base-port", type=int, default=18750)
+    ok = asyncio.run(_run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""图片预处理前后的端到端视觉延迟对比
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_preprocess --requests 8
+"""
+import io
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+from PIL import Image
+
+from benchmarks.fake_ollama import FakeOllama
+
+
+def _make_photo(width: int, height: int) -> bytes:
+    """生成一张接近手机照片体积的测试图（带噪声，压缩率低）"""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+async def _run(photo: bytes, requests: int, preprocess: bool, port: int) -> dict:
+    os.environ["VISION_MODEL_API_ENDPOINT"] = f"http://127.0.0.1:{port}/api/generate"
+
+    from http_client import http_clients
+    from vision_handler import VisionModelHandler
+
+    fake = FakeOllama()
+    await fake.start(port=port)
+    await http_clients.start()
+    handler = VisionModelHandler()
+    handler.preprocessor.enabled = preprocess
+    await handler.start()
+    latencies = []
+    try:
+        for i in range(requests):
+            # 每次改变提示词，避免命中描述缓存
+            started = time.perf_counter()
+            await handler.analyze_image(photo, f"describe #{i}")
+            latencies.append(time.perf_counter() - started)
+    finally:
+        await handler.close()
+        await http_clients.close()
+        await fake.stop()
+
+    return {
+        "p50": statistics.median(latencies),
+        "mean": statistics.mean(latencies),
+        "bytes_sent": fake.bytes_received / requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片预处理前后的视觉延迟对比")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--port", type=int, default=18434)
+    args = parser.parse_args()
+
+    photo = _make_photo(args.width, args.height)
+    print(f"input image: {args.width}x{args.height}, {len(photo) / 1024 / 1024:.1f} MB")
+
+    before = asyncio.run(_run(photo, args.requests, False, args.port))
+    after = asyncio.run(_run(photo, args.requests, True, args.port))
+
+    for name, result in (("raw", before), ("preprocessed", after)):
+        print(f"{name:13s} p50 {result['p50'] * 1000:7.0f} ms  mean {result['mean'] * 1000:7.0f} ms  "
+              f"{result['bytes_sent'] / 1024:8.0f} KB/request")
+    print(f"speedup       {before['p50'] / after['p50']:.2f}x (p50)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""后端冷启动：导入 main 的耗时，以及从启动进程到 /health 首次可用的时间
+
+- import：用 python -X importtime 导入 main，报告总耗时与自身耗时最多的顶层包
+- startup：在替身服务前启动后端进程（uvicorn），测量到 /health 首次返回 200 的时间，
+  以及随后第一个 /analyze-image 请求的延迟（含进程池启动与模型载入）；
+  --warmup 时再测量开启 BACKEND_WARMUP 的情况（替身 Ollama 用 --model-load 模拟模型载入显存的耗时）
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_startup --runs 5 --warmup
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from benchmarks.loadgen import BACKEND_DIR, percentile, spawn_backend, stop_backend
+from benchmarks.stack import FakeStack
+
+
+def _import_once(env: Dict[str, str]) -> Tuple[float, Dict[str, int]]:
+    """在新进程中导入 main，返回 (总耗时秒, 顶层包 -> 自身导入耗时微秒)"""
+    code = f"import sys; sys.path.insert(0, {BACKEND_DIR!r}); import main"
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=tempfile.mkdtemp(prefix="bench_import_"), env={**os.environ, **env},
+        capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 main 失败:\n{result.stderr[-2000:]}")
+    packages: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us = int(fields[0])
+        except ValueError:
+            continue
+        package = fields[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return elapsed, packages
+
+
+async def _wait_warm(session: aiohttp.ClientSession, base: str, timeout: float = 60) -> Optional[dict]:
+    """等待后台预热结束，返回 /stats 中的预热状态"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        async with session.get(f"{base}/stats") as response:
+            warmup = (await response.json()).get("warmup")
+        if not warmup or warmup.get("state") != "running":
+            return warmup
+        await asyncio.sleep(0.02)
+    return None
+
+
+async def _startup_once(stack: FakeStack, env: Dict[str, str], port: int, run: str) -> Dict[str, float]:
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    process = await spawn_backend(env, port, workdir, poll_interval=0.01)
+    result = {"healthy": time.perf_counter() - started}
+    try:
+        async with aiohttp.ClientSession() as session:
+            if env.get("BACKEND_WARMUP"):
+                warmup = await _wait_warm(session, base)
+                result["warm"] = time.perf_counter() - started
+                if warmup and warmup.get("errors"):
+                    print(f"warm-up errors: {warmup['errors']}")
+            form = {"objectName": "cat", "image_url": stack.image_url(run), "model_type": "olama"}
+            request_started = time.perf_counter()
+            async with session.post(f"{base}/analyze-image", data=form) as response:
+                await response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"/analyze-image 返回 {response.status}")
+            result["first_request"] = time.perf_counter() - request_started
+    finally:
+        await stop_backend(process)
+    # 每次启动都是新的 Ollama 进程状态：模型需重新载入
+    stack.ollama.loaded.clear()
+    return result
+
+
+async def _run(args: argparse.Namespace):
+    env = {"LOG_LEVEL": "WARNING"}
+    imports = [_import_once(env) for _ in range(args.runs)]
+    import_times = [elapsed for elapsed, _ in imports]
+    packages: Dict[str, List[int]] = {}
+    for _, breakdown in imports:
+        for package, self_us in breakdown.items():
+            packages.setdefault(package, []).append(self_us)
+
+    stack = FakeStack(ollama_latency=args.ollama_latency, comfy_latency=0, base_port=args.base_port)
+    stack.ollama.load_time = args.model_load
+    await stack.start()
+    rows: Dict[str, List[Dict[str, float]]] = {}
+    try:
+        modes = [("cold", "")] + ([("warmup", "all")] if args.warmup else [])
+        for mode, warmup in modes:
+            # 冷启动不让后台预载入模型，与 BACKEND_WARMUP 的效果区分开
+            backend_env = {**stack.backend_env(), **env, "BACKEND_WARMUP": warmup, "OLLAMA_PRELOAD": "false"}
+            rows[mode] = [
+                await _startup_once(stack, backend_env, args.port, f"{mode}-{run}") for run in range(args.runs)
+            ]
+    finally:
+        await stack.stop()
+
+    def ms(values: List[float]) -> str:
+        return f"{percentile(values, 0.5) * 1000:8.0f}" if values else "       -"
+
+    print(f"import main: p50 {percentile(import_times, 0.5) * 1000:.0f} ms over {args.runs} runs "
+          f"(process start included)")
+    heaviest = sorted(packages.items(), key=lambda item: -percentile(item[1], 0.5))[:args.top]
+    for package, values in heaviest:
+        print(f"  {package:28s} {percentile(values, 0.5) / 1000:8.1f} ms")
+    print(f"model load {args.model_load:g}s, p50 over {args.runs} runs")
+    print(f"{'mode':8s} {'/health ms':>10s} {'warm ms':>8s} {'1st req ms':>10s}")
+    for mode, results in rows.items():
+        print(f"{mode:8s} {ms([r['healthy'] for r in results]):>10s} {ms([r['warm'] for r in results if 'warm' in r])} "
+              f"{ms([r['first_request'] for r in results]):>10s}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="后端导入与启动耗时")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="列出自身导入耗时最多的顶层包数量")
+    parser.add_argument("--warmup", action="store_true", help="同时测量 BACKEND_WARMUP=all")
+    parser.add_argument("--model-load", type=float, default=2.0, help="替身 Ollama 载入模型的耗时（秒）")
+    parser.add_argument("--ollama-latency", default="0.2", help="替身 Ollama 每次调用的延迟分布")
+    parser.add_argument("--port", type=int, default=18640)
+    parser.add_argument("--base-port", type=int, default=18650)
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
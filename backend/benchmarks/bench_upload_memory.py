@@ -0,0 +1,150 @@
+"""并发大文件上传时后端进程的内存占用
+
+启动替身服务与独立的后端进程，同时发送多个约 10 MB 的 /upload 请求，
+按 /proc/<pid>/status 采样后端的 RSS，报告峰值相对空闲时的增长；
+另外发送一个超过上限、没有 Content-Length 的分块上传，确认在读取过程中被拒绝（413）。
+有上传失败、每个上传的 RSS 增长超过 --max-growth-per-upload，或超限上传未被拒绝时以非零状态退出。
+
+在 backend 目录下运行（仅限 Linux）：
+    python -m benchmarks.bench_upload_memory --concurrency 8
+"""
+import sys
+import asyncio
+import argparse
+import tempfile
+
+import aiohttp
+
+from benchmarks.loadgen import spawn_backend
+from benchmarks.stack import FakeStack, make_photo
+
+
+def _rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _make_upload(target_bytes: int) -> bytes:
+    """生成不超过 target_bytes 的最大测试照片"""
+    width, height = 4000, 3000
+    while True:
+        photo = make_photo(width, height)
+        if len(photo) <= target_bytes:
+            return photo
+        width, height = int(width * 0.95), int(height * 0.95)
+
+
+async def _sample(pid: int, peak: list, stop: asyncio.Event):
+    while not stop.is_set():
+        peak[0] = max(peak[0], _rss(pid))
+        await asyncio.sleep(0.01)
+
+
+async def _chunked_oversized(url: str, size: int) -> int:
+    async def body():
+        chunk = b"\0" * (1024 * 1024)
+        for _ in range(size // len(chunk) + 1):
+            yield chunk
+
+    form_head = (b'--bench\r\nContent-Disposition: form-data; name="image"; filename="big.jpg"\r\n'
+                 b"Content-Type: image/jpeg\r\n\r\n")
+
+    async def multipart():
+        yield form_head
+        async for chunk in body():
+            yield chunk
+        yield b"\r\n--bench--\r\n"
+
+    async with aiohttp.ClientSession() as session:
+        try:
+            async with session.post(url, data=multipart(),
+                                    headers={"Content-Type": "multipart/form-data; boundary=bench"}) as response:
+                return response.status
+        except aiohttp.ClientError:
+            # 服务端提前返回并关闭连接时，客户端可能还在发送
+            return -1
+
+
+async def _run(args: argparse.Namespace) -> bool:
+    stack = FakeStack(ollama_latency=args.latency, comfy_latency=0.1, per_image=0.1, base_port=args.base_port)
+    await stack.start()
+    env = {**stack.backend_env(), "VISION_PREPROCESS": "true" if args.preprocess else "false",
+           "LOG_LEVEL": "WARNING", "MAX_UPLOAD_BYTES": str(args.limit)}
+    process = await spawn_backend(env, args.port, tempfile.mkdtemp(prefix="bench_upload_"))
+    url = f"http://127.0.0.1:{args.port}/upload"
+    photo = _make_upload(args.limit - 64 * 1024)
+    try:
+        # 预热：加载模块、建立连接池与进程池
+        async with aiohttp.ClientSession() as session:
+            form = aiohttp.FormData()
+            form.add_field("image", photo, filename="warmup.jpg", content_type="image/jpeg")
+            async with session.post(url, data=form) as response:
+                await response.read()
+        await asyncio.sleep(0.5)
+        idle = _rss(process.pid)
+
+        peak = [idle]
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(_sample(process.pid, peak, stop))
+        statuses = []
+
+        async def upload(index: int):
+            form = aiohttp.FormData()
+            # 末尾附加序号，避免命中描述缓存
+            form.add_field("image", photo + str(index).encode(), filename=f"{index}.jpg", content_type="image/jpeg")
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, data=form) as response:
+                    body = await response.json()
+                    statuses.append(body.get("code"))
+
+        await asyncio.gather(*[upload(i) for i in range(args.concurrency)])
+        stop.set()
+        await sampler
+        oversized = await _chunked_oversized(url, args.limit + 2 * 1024 * 1024)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        await stack.stop()
+
+    mb = 1024 * 1024
+    growth = peak[0] - idle
+    per_upload = growth / args.concurrency
+    print(f"upload size      {len(photo) / mb:6.1f} MB x {args.concurrency} concurrent "
+          f"(preprocess {'on' if args.preprocess else 'off'})")
+    print(f"responses        {statuses.count(200)}/{len(statuses)} ok")
+    print(f"backend RSS      idle {idle / mb:6.1f} MB  peak {peak[0] / mb:6.1f} MB  "
+          f"growth {growth / mb:6.1f} MB ({per_upload / mb:.1f} MB per upload)")
+    print(f"chunked upload over the limit -> {oversized if oversized > 0 else 'connection closed by server'}")
+
+    checks = [
+        ("all uploads succeed", len(statuses) == args.concurrency and all(status == 200 for status in statuses),
+         f"{statuses.count(200)}/{args.concurrency} ok"),
+        ("RSS growth per upload bounded", per_upload <= args.max_growth_per_upload * mb,
+         f"{per_upload / mb:.1f} MB per upload, limit {args.max_growth_per_upload:g} MB"),
+        ("chunked upload over the limit rejected", oversized in (413, -1),
+         f"{oversized if oversized > 0 else 'connection closed'}"),
+    ]
+    for name, ok, detail in checks:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:40s} {detail}")
+    return all(ok for _, ok, _ in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发大文件上传的内存占用")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=10_000_000, help="后端的 MAX_UPLOAD_BYTES")
+    parser.add_argument("--latency", default="1.0", help="替身 Ollama 的延迟，保证上传在内存中重叠")
+    parser.add_argument("--preprocess", action="store_true", help="启用预处理（默认关闭，走流式 base64 路径）")
+    parser.add_argument("--max-growth-per-upload", type=float, default=3.0,
+                        help="每个并发上传允许的 RSS 增长（MB），默认为 3 个 1 MB 读写块")
+    parser.add_argument("--port", type=int, default=18610)
+    parser.add_argument("--base-port", type=int, default=18520)
+    ok = asyncio.run(_run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
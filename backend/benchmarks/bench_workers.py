@@ -0,0 +1,198 @@
+"""多 worker 部署（uvicorn --workers N）：共享状态检查与吞吐
+
+在替身服务前以 N 个 worker 启动后端，检查请求每次都用新连接（由内核分配给不同的 worker）：
+- jobs：任务提交后，任意 worker 都能查询（不出现 404）与订阅，直到任务完成
+- cancel：任务被其他 worker 收到的 DELETE 取消
+- description cache / generation cache：结果在一个 worker 写入后，其他 worker 直接命中，
+  替身服务只收到一次请求
+- images：生成的图片可从任一 worker 读取
+任一检查失败时以非零状态退出。--throughput 时另外对比 1 个与 N 个 worker 的 /upload 吞吐
+（图片预处理、JSON 与 base64 编码受单核限制的部分）。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_workers --workers 4 --throughput
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+from benchmarks.latency import Latency
+from benchmarks.loadgen import LoadGenerator, spawn_backend, stop_backend
+from benchmarks.stack import FakeStack
+
+
+class Client:
+    """每个请求使用新连接，并记录处理过请求的 worker"""
+
+    def __init__(self, base: str):
+        self.base = base
+        self.workers: Set[int] = set()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "Client":
+        connector = aiohttp.TCPConnector(force_close=True)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def request(self, method: str, path: str, **kwargs) -> Tuple[int, Any]:
+        async with self._session.request(method, self.base + path, **kwargs) as response:
+            body = await response.read()
+            if response.content_type == "application/json":
+                return response.status, json.loads(body)
+            return response.status, body
+
+    async def sample_workers(self, times: int = 8):
+        for _ in range(times):
+            _, stats = await self.request("GET", "/stats")
+            self.workers.add(stats["worker"]["pid"])
+
+    async def events(self, path: str) -> List[Dict[str, Any]]:
+        events = []
+        async with self._session.get(self.base + path) as response:
+            event = None
+            async for line in response.content:
+                line = line.decode().strip()
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    events.append({"event": event, "data": json.loads(line[len("data: "):])})
+        return events
+
+
+async def _poll_job(client: Client, job_id: str, not_found: List[str], timeout: float = 60) -> Dict[str, Any]:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status, body = await client.request("GET", f"/jobs/{job_id}")
+        if status == 404:
+            not_found.append(job_id)
+        elif body["data"]["status"] in ("succeeded", "failed", "cancelled"):
+            return body["data"]
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"任务 {job_id} 超时未结束")
+
+
+async def _submit(client: Client, prompt: str) -> str:
+    status, body = await client.request("POST", "/jobs/generate-image", data={"prompt": prompt})
+    if status != 200:
+        raise RuntimeError(f"提交任务失败: {status} {body}")
+    return body["data"]["job_id"]
+
+
+async def _checks(client: Client, stack: FakeStack, jobs: int) -> List[Tuple[str, bool, str]]:
+    results = []
+
+    # 任务在任一 worker 上可查询、可订阅
+    not_found: List[str] = []
+    job_ids = [await _submit(client, f"shared job {index}") for index in range(jobs)]
+    streamed = asyncio.ensure_future(client.events(f"/jobs/{job_ids[-1]}/events"))
+    finished = await asyncio.gather(*[_poll_job(client, job_id, not_found) for job_id in job_ids])
+    events = await streamed
+    succeeded = sum(job["status"] == "succeeded" for job in finished)
+    results.append(("jobs pollable from every worker", succeeded == jobs and not not_found,
+                    f"{succeeded}/{jobs} succeeded, {len(not_found)} polls returned 404"))
+    final = events[-1] if events else {}
+    results.append(("job events from any worker", final.get("data", {}).get("status") == "succeeded",
+                    f"{len(events)} events, last: {final.get('event')} {final.get('data', {}).get('status')}"))
+
+    # 其他 worker 收到的取消请求
+    stack.comfyui.prompt_overhead = Latency.of(1.5)
+    cancel_ids = [await _submit(client, f"cancelled job {index}") for index in range(jobs)]
+    for job_id in cancel_ids:
+        await client.request("DELETE", f"/jobs/{job_id}")
+    cancelled = await asyncio.gather(*[_poll_job(client, job_id, not_found) for job_id in cancel_ids])
+    count = sum(job["status"] == "cancelled" for job in cancelled)
+    results.append(("cancel from any worker", count == jobs,
+                    f"{count}/{jobs} cancelled, comfy deleted {stack.comfyui.prompts_deleted}, "
+                    f"interrupted {stack.comfyui.prompts_interrupted}"))
+    stack.comfyui.prompt_overhead = Latency.of(0.2)
+
+    # 描述缓存：同一图片只请求一次 Ollama
+    before = stack.ollama.requests
+    form = {"objectName": "cup", "image_url": stack.image_url("shared"), "model_type": "olama"}
+    statuses = [(await client.request("POST", "/analyze-image", data=form))[0] for _ in range(jobs)]
+    calls = stack.ollama.requests - before
+    results.append(("description cache shared", calls == 1 and set(statuses) == {200},
+                    f"{jobs} requests, {calls} Ollama calls"))
+
+    # 生成结果缓存：同一提示词只生成一次；生成的图片可从任一 worker 读取
+    before = stack.comfyui.prompts_executed
+    names = set()
+    for _ in range(jobs):
+        status, body = await client.request("POST", "/generate-image", data={"prompt": "shared cached prompt"})
+        if status == 200:
+            names.add(body["data"]["image_url"])
+    executed = stack.comfyui.prompts_executed - before
+    results.append(("generation cache shared", executed == 1 and len(names) == 1,
+                    f"{jobs} requests, {executed} ComfyUI prompts, {len(names)} distinct images"))
+    image_statuses = [(await client.request("GET", f"/static/images/{name}"))[0] for name in names for _ in range(jobs)]
+    results.append(("images served by every worker", bool(image_statuses) and set(image_statuses) == {200},
+                    f"{image_statuses.count(200)}/{len(image_statuses)} OK"))
+    return results
+
+
+async def _throughput(stack: FakeStack, env: Dict[str, str], args: argparse.Namespace) -> Dict[int, Dict[str, Any]]:
+    rows = {}
+    for workers in (1, args.workers):
+        workdir = tempfile.mkdtemp(prefix="bench_workers_")
+        process = await spawn_backend(env, args.port, workdir, uvicorn_args=["--workers", str(workers)])
+        try:
+            generator = LoadGenerator(f"http://127.0.0.1:{args.port}", "upload", args.concurrency,
+                                      duration=args.duration, photo=stack.photo)
+            rows[workers] = await generator.run()
+        finally:
+            await stop_backend(process)
+    return rows
+
+
+async def _run(args: argparse.Namespace) -> bool:
+    stack = FakeStack(ollama_latency=args.ollama_latency, comfy_latency=0.2, per_image=0.1, base_port=args.base_port)
+    await stack.start()
+    env = {**stack.backend_env(), "LOG_LEVEL": "WARNING", "JOB_SYNC_INTERVAL": "0.2"}
+    try:
+        workdir = tempfile.mkdtemp(prefix="bench_workers_")
+        process = await spawn_backend(env, args.port, workdir, uvicorn_args=["--workers", str(args.workers)])
+        try:
+            async with Client(f"http://127.0.0.1:{args.port}") as client:
+                await client.sample_workers()
+                results = await _checks(client, stack, args.jobs)
+                await client.sample_workers()
+        finally:
+            await stop_backend(process)
+        rows = await _throughput(stack, env, args) if args.throughput else {}
+    finally:
+        await stack.stop()
+
+    print(f"{args.workers} workers, {len(client.workers)} distinct worker pids seen on /stats")
+    for name, ok, detail in results:
+        print(f"  {'PASS' if ok else 'FAIL'}  {name:34s} {detail}")
+    for workers, result in rows.items():
+        print(f"upload x{args.concurrency}, {workers} worker(s): {result['throughput']:.1f} req/s, "
+              f"p50 {result['latency']['p50'] * 1000:.0f} ms, errors {result['errors']}")
+    return all(ok for _, ok, _ in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多 worker 共享状态检查与吞吐")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=8, help="每项检查的任务或请求数")
+    parser.add_argument("--throughput", action="store_true", help="同时对比 1 个与 N 个 worker 的 /upload 吞吐")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--ollama-latency", default="0.05", help="替身 Ollama 每次调用的延迟分布")
+    parser.add_argument("--port", type=int, default=18660)
+    parser.add_argument("--base-port", type=int, default=18670)
+    ok = asyncio.run(_run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""每次请求准备工作流的开销对比
+
+旧做法：深拷贝模板、修改、再完整序列化（提交与缓存键各一次）；
+新做法：从预编译模板构建，只复制并序列化被修改的节点。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_workflow_prepare --iterations 20000
+"""
+import copy
+import json
+import hashlib
+import argparse
+import timeit
+
+from workflow_registry import WorkflowRegistry, serialize_workflow
+
+
+def _baseline(template: dict, patch_points: dict, prompt: str) -> str:
+    workflow = copy.deepcopy(template)
+    node_id, input_name = patch_points["positive"]
+    workflow[node_id]["inputs"][input_name] = prompt
+    node_id, input_name = patch_points["negative"]
+    workflow[node_id]["inputs"][input_name] = "text, watermark"
+    key = hashlib.sha256(json.dumps(workflow, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")).hexdigest()
+    body = json.dumps({"prompt": workflow, "client_id": "benchmark"})
+    return key + body
+
+
+def _registry(template, prompt: str) -> str:
+    workflow = template.build(positive=prompt, negative="text, watermark")
+    serialized = serialize_workflow(workflow)
+    key = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    body = '{"prompt":%s,"client_id":%s}' % (serialized, json.dumps("benchmark"))
+    return key + body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="工作流准备开销对比")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--workflow", default=None)
+    args = parser.parse_args()
+
+    registry = WorkflowRegistry()
+    registry.load()
+    template = registry.get(args.workflow)
+
+    results = {
+        "deepcopy+dumps": timeit.timeit(
+            lambda: _baseline(template.nodes, template.patch_points, "a red apple"), number=args.iterations),
+        "template": timeit.timeit(
+            lambda: _registry(template, "a red apple"), number=args.iterations),
+    }
+    for name, elapsed in results.items():
+        print(f"{name:15s} {elapsed / args.iterations * 1e6:8.1f} us/request")
+    print(f"speedup         {results['deepcopy+dumps'] / results['template']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""对比 loadgen 保存的多次结果（通常来自不同提交）
+
+在 backend 目录下运行：
+    python -m benchmarks.compare benchmarks/results/*.json
+以每个场景最早的一次结果为基准，显示吞吐与延迟的变化。
+"""
+import json
+import argparse
+from typing import Any, Dict, List, Optional
+
+
+def _load(paths: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    by_scenario: Dict[str, List[Dict[str, Any]]] = {}
+    for path in paths:
+        with open(path) as f:
+            result = json.load(f)
+        by_scenario.setdefault(result["scenario"], []).append(result)
+    for results in by_scenario.values():
+        results.sort(key=lambda result: result.get("timestamp", ""))
+    return by_scenario
+
+
+def _delta(value: Optional[float], base: Optional[float]) -> str:
+    if value is None or not base:
+        return "      "
+    return f"{(value - base) / base * 100:+5.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比压测结果")
+    parser.add_argument("results", nargs="+", help="loadgen 保存的 JSON 文件")
+    args = parser.parse_args()
+
+    for scenario, results in _load(args.results).items():
+        base = results[0]
+        print(f"== {scenario}")
+        print(f"{'commit':12s} {'label':12s} {'c':>3s} {'req/s':>8s} {'':6s} {'p50 ms':>8s} {'':6s} "
+              f"{'p95 ms':>8s} {'':6s} {'p99 ms':>8s} {'errors':>7s}")
+        for result in results:
+            latency, base_latency = result["latency"], base["latency"]
+            commit = result["commit"] + ("*" if result.get("dirty") else "")
+            columns = [f"{commit:12s} {result.get('label', '')[:12]:12s} {result['concurrency']:3d}",
+                       f"{result['throughput']:8.2f} {_delta(result['throughput'], base['throughput'])}"]
+            for q in ("p50", "p95", "p99"):
+                value = latency.get(q)
+                shown = f"{value * 1000:8.0f}" if value is not None else "       -"
+                columns.append(f"{shown} {_delta(value, base_latency.get(q))}")
+            columns.append(f"{result['error_rate'] * 100:6.1f}%")
+            print(" ".join(columns))
+        print()
+
+
+if __name__ == "__main__":
+    main()
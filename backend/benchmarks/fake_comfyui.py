@@ -0,0 +1,255 @@
+"""本地 ComfyUI 替身，用于在没有 GPU 的环境下做基准测试
+
+模拟单 GPU 顺序执行：每个 prompt 耗时 prompt_overhead 抽样 + per_image * 图片数，
+采样时间按 KSampler 的步数与分辨率相对 reference_steps 步、reference_size 见方缩放；
+failure_rate 比例的 prompt 以 execution_error 结束。
+支持 /prompt、/queue（含 POST 删除排队项）、/interrupt、/history、/history/{prompt_id}、/ws、/view，
+以及 /upload 使用的 /api/predict。
+"""
+import os
+import json
+import uuid
+import random
+import asyncio
+import base64
+from typing import Any, Dict, List, Optional, Union
+
+from aiohttp import web
+
+from benchmarks.latency import Latency
+
+# 1x1 透明 PNG
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+def _count_images(workflow: Dict[str, Any], node_id: str) -> int:
+    """沿连接向上查找 EmptyLatentImage，返回其 batch_size"""
+    seen = set()
+    stack = [node_id]
+    while stack:
+        current = stack.pop()
+        if current in seen or current not in workflow:
+            continue
+        seen.add(current)
+        node = workflow[current]
+        if node.get("class_type") == "EmptyLatentImage":
+            return int(node["inputs"].get("batch_size", 1))
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                stack.append(value[0])
+    return 1
+
+
+def _sampling_scale(workflow: Dict[str, Any], node_id: str, reference_work: int) -> float:
+    """输出节点上游 KSampler 的 步数 × 宽 × 高 相对参考值的比例；缺少这些输入时为 1"""
+    seen = set()
+    stack = [node_id]
+    while stack:
+        current = stack.pop()
+        if current in seen or current not in workflow:
+            continue
+        seen.add(current)
+        node = workflow[current]
+        if node.get("class_type") == "KSampler":
+            latent = node["inputs"].get("latent_image")
+            latent_inputs = workflow.get(latent[0], {}).get("inputs", {}) if isinstance(latent, list) else {}
+            steps = node["inputs"].get("steps")
+            if steps is None or "width" not in latent_inputs or "height" not in latent_inputs:
+                return 1.0
+            return steps * latent_inputs["width"] * latent_inputs["height"] / reference_work
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                stack.append(value[0])
+    return 1.0
+
+
+class FakeComfyUI:
+    def __init__(
+        self,
+        prompt_overhead: Union[float, str, Latency] = 0.5,
+        per_image: float = 0.25,
+        steps: int = 4,
+        output_dir: Optional[str] = None,
+        failure_rate: float = 0.0,
+        reference_steps: int = 16,
+        reference_size: int = 512,
+    ):
+        self.prompt_overhead = Latency.of(prompt_overhead)
+        self.per_image = per_image
+        self.steps = steps
+        self.output_dir = output_dir
+        self.failure_rate = failure_rate
+        self.reference_work = reference_steps * reference_size * reference_size
+        self.history: Dict[str, Dict[str, Any]] = {}
+        self.prompts_executed = 0
+        self.prompts_failed = 0
+        self.images_generated = 0
+        self.prompts_deleted = 0
+        self.prompts_interrupted = 0
+        self._queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self._pending: List[str] = []
+        self._running: Optional[str] = None
+        self._deleted: set = set()
+        self._current: Optional[asyncio.Task] = None
+        self._sockets: Dict[str, List[web.WebSocketResponse]] = {}
+        self._counter = 0
+        self._runner: Optional[web.AppRunner] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/prompt", self.handle_prompt)
+        app.router.add_get("/queue", self.handle_queue)
+        app.router.add_post("/queue", self.handle_queue_delete)
+        app.router.add_post("/interrupt", self.handle_interrupt)
+        app.router.add_get("/history", self.handle_history)
+        app.router.add_get("/history/{prompt_id}", self.handle_history)
+        app.router.add_get("/ws", self.handle_ws)
+        app.router.add_get("/view", self.handle_view)
+        app.router.add_post("/api/predict", self.handle_predict)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8188):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._worker = asyncio.create_task(self._work())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+        for sockets in self._sockets.values():
+            for ws in sockets:
+                await ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def handle_prompt(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self._pending.append(prompt_id)
+        await self._queue.put((prompt_id, body["prompt"], body.get("client_id")))
+        return web.json_response({"prompt_id": prompt_id, "number": len(self._pending), "node_errors": {}})
+
+    async def handle_queue(self, request: web.Request) -> web.Response:
+        running = [[0, self._running]] if self._running else []
+        pending = [[i, prompt_id] for i, prompt_id in enumerate(self._pending)]
+        return web.json_response({"queue_running": running, "queue_pending": pending})
+
+    async def handle_queue_delete(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        for prompt_id in body.get("delete", []):
+            if prompt_id in self._pending:
+                self._pending.remove(prompt_id)
+                self._deleted.add(prompt_id)
+                self.prompts_deleted += 1
+        return web.Response()
+
+    async def handle_interrupt(self, request: web.Request) -> web.Response:
+        body = await request.json() if request.can_read_body else {}
+        prompt_id = body.get("prompt_id")
+        # 与 ComfyUI 一致：指定的 prompt 不在执行时忽略
+        if self._current is not None and (prompt_id is None or prompt_id == self._running):
+            self._current.cancel()
+        return web.Response()
+
+    async def handle_history(self, request: web.Request) -> web.Response:
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id is None:
+            return web.json_response(self.history)
+        if prompt_id in self.history:
+            return web.json_response({prompt_id: self.history[prompt_id]})
+        return web.json_response({})
+
+    async def handle_predict(self, request: web.Request) -> web.Response:
+        """同步生成接口：占用一次 GPU 时间后直接返回图片名"""
+        await request.read()
+        await asyncio.sleep(self.prompt_overhead.sample() + self.per_image)
+        self._counter += 1
+        return web.json_response({"image_url": f"ComfyUI_{self._counter:05d}_.png"})
+
+    async def handle_view(self, request: web.Request) -> web.Response:
+        return web.Response(body=PNG_BYTES, content_type="image/png")
+
+    async def handle_ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId", "")
+        self._sockets.setdefault(client_id, []).append(ws)
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self._sockets[client_id].remove(ws)
+        return ws
+
+    async def _send(self, client_id: Optional[str], event_type: str, data: Dict[str, Any]):
+        for ws in list(self._sockets.get(client_id or "", [])):
+            try:
+                await ws.send_str(json.dumps({"type": event_type, "data": data}))
+            except ConnectionError:
+                pass
+
+    async def _work(self):
+        while True:
+            prompt_id, workflow, client_id = await self._queue.get()
+            if prompt_id in self._deleted:
+                self._deleted.discard(prompt_id)
+                continue
+            self._pending.remove(prompt_id)
+            self._running = prompt_id
+            self._current = asyncio.ensure_future(self._execute(prompt_id, workflow, client_id))
+            try:
+                await self._current
+            except asyncio.CancelledError:
+                if not self._current.cancelled():
+                    raise
+                self.prompts_interrupted += 1
+                self.history[prompt_id] = {"prompt": [0, prompt_id, workflow], "outputs": {},
+                                           "status": {"completed": False, "status_str": "error"}}
+                await self._send(client_id, "execution_interrupted", {"prompt_id": prompt_id})
+            finally:
+                self._current = None
+                self._running = None
+
+    async def _execute(self, prompt_id: str, workflow: Dict[str, Any], client_id: Optional[str]):
+        await self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+        save_nodes = [nid for nid, node in workflow.items() if node.get("class_type") == "SaveImage"]
+        counts = {nid: _count_images(workflow, nid) for nid in save_nodes}
+        total = sum(counts.values()) or 1
+        work = sum(count * _sampling_scale(workflow, nid, self.reference_work) for nid, count in counts.items()) or 1
+
+        await asyncio.sleep(self.prompt_overhead.sample())
+        if random.random() < self.failure_rate:
+            self.prompts_failed += 1
+            self.history[prompt_id] = {"prompt": [0, prompt_id, workflow], "outputs": {},
+                                       "status": {"completed": False, "status_str": "error"}}
+            await self._send(client_id, "execution_error", {
+                "prompt_id": prompt_id, "exception_message": "simulated failure"
+            })
+            return
+        for step in range(self.steps):
+            await asyncio.sleep(self.per_image * work / self.steps)
+            await self._send(client_id, "progress", {
+                "prompt_id": prompt_id, "value": step + 1, "max": self.steps, "node": None
+            })
+
+        outputs = {}
+        for nid, count in counts.items():
+            images = []
+            for _ in range(count):
+                self._counter += 1
+                filename = f"ComfyUI_{self._counter:05d}_.png"
+                if self.output_dir:
+                    with open(os.path.join(self.output_dir, filename), "wb") as f:
+                        f.write(PNG_BYTES)
+                images.append({"filename": filename, "subfolder": "", "type": "output"})
+            outputs[nid] = {"images": images}
+            await self._send(client_id, "executed", {"prompt_id": prompt_id, "node": nid, "output": outputs[nid]})
+
+        self.history[prompt_id] = {"prompt": [0, prompt_id, workflow], "outputs": outputs, "status": {"completed": True}}
+        self.prompts_executed += 1
+        self.images_generated += sum(counts.values())
+        await self._send(client_id, "executing", {"prompt_id": prompt_id, "node": None})
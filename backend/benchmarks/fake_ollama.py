@@ -0,0 +1,189 @@
+"""本地 Ollama 替身，用于在没有 GPU 的环境下做基准测试
+
+支持 /api/generate 的普通与 NDJSON 流式响应，以及 OpenAI 兼容的 /v1/chat/completions
+（普通与 SSE 流式，可作为 OpenAIHandler 的替身）。耗时 = latency 抽样 + per_mb * 请求体MB数，
+用来模拟大图片的传输与模型端解码开销；failure_rate 比例的请求返回 500。
+
+模型首次使用时耗时 load_time 载入，请求结束后按请求中的 keep_alive（默认 keep_alive 秒，
+同 Ollama 默认的 5 分钟）计时，空闲超时后卸载。parallel > 0 时，同一模型同时处理的请求超过
+parallel 个后按比例变慢，并额外增加 thrash 比例的争抢开销。
+"""
+import json
+import time
+import random
+import asyncio
+from typing import Any, Dict, Union
+
+from aiohttp import web
+
+from benchmarks.latency import Latency
+
+_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def parse_keep_alive(value: Any, default: float) -> float:
+    """Ollama 的 keep_alive：秒数或 "10m" 形式的时长，负数表示常驻"""
+    if value is None or value == "":
+        return default
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    elif value[-1:] in _UNITS:
+        seconds = float(value[:-1]) * _UNITS[value[-1]]
+    else:
+        seconds = float(value)
+    return float("inf") if seconds < 0 else seconds
+
+
+class FakeOllama:
+    def __init__(
+        self,
+        latency: Union[float, str, Latency] = 0.5,
+        per_mb: float = 0.2,
+        tokens: int = 20,
+        failure_rate: float = 0.0,
+        load_time: float = 0.0,
+        keep_alive: float = 300.0,
+        parallel: int = 0,
+        thrash: float = 0.5,
+    ):
+        self.latency = Latency.of(latency)
+        self.per_mb = per_mb
+        self.tokens = tokens
+        self.failure_rate = failure_rate
+        # 模型首次使用时载入显存的耗时
+        self.load_time = load_time
+        self.loaded = set()
+        self.loads = 0
+        self.unloads = 0
+        self.keep_alive = keep_alive
+        self.keep_alive_seen = set()
+        self._expires: Dict[str, float] = {}
+        self.parallel = parallel
+        self.thrash = thrash
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.bytes_received = 0
+        self._runner = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/api/generate", self.handle_generate)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 11434):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _load(self, model: str, keep_alive: Any = None):
+        """模型未载入（或空闲超过 keep_alive 已被卸载）时先等待载入"""
+        if model in self.loaded and self._expires.get(model, float("inf")) <= time.monotonic():
+            self.loaded.discard(model)
+            self.unloads += 1
+        if model not in self.loaded:
+            self.loaded.add(model)
+            self.loads += 1
+            await asyncio.sleep(self.load_time)
+        self._touch(model, keep_alive)
+
+    def _touch(self, model: str, keep_alive: Any):
+        """重新开始空闲计时"""
+        if keep_alive is not None:
+            self.keep_alive_seen.add(keep_alive)
+        self._expires[model] = time.monotonic() + parse_keep_alive(keep_alive, self.keep_alive)
+
+    def _end(self, request: web.Request):
+        body = request.get("body")
+        if body is not None:
+            self.in_flight -= 1
+            self._touch(body.get("model"), body.get("keep_alive"))
+
+    async def _begin(self, request: web.Request):
+        """读取请求并抽样耗时；模拟失败时返回 500 响应"""
+        raw = await request.read()
+        body = json.loads(raw)
+        self.requests += 1
+        self.bytes_received += len(raw)
+        request["body"] = body
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await self._load(body.get("model"), body.get("keep_alive"))
+        delay = self.latency.sample() + self.per_mb * len(raw) / (1024 * 1024)
+        if self.parallel and self.in_flight > self.parallel:
+            excess = self.in_flight - self.parallel
+            delay *= self.in_flight / self.parallel * (1 + self.thrash * excess / self.parallel)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            await asyncio.sleep(delay / 2)
+            return body, delay, web.json_response({"error": "simulated failure"}, status=500)
+        return body, delay, None
+
+    async def handle_generate(self, request: web.Request) -> web.StreamResponse:
+        try:
+            return await self._generate(request)
+        finally:
+            self._end(request)
+
+    async def handle_chat_completions(self, request: web.Request) -> web.StreamResponse:
+        try:
+            return await self._chat_completions(request)
+        finally:
+            self._end(request)
+
+    async def _generate(self, request: web.Request) -> web.StreamResponse:
+        body = json.loads(await request.read())
+        if "prompt" not in body:
+            # 只带 model 的请求只载入模型（预热），或刷新 keep_alive
+            await self._load(body.get("model"), body.get("keep_alive"))
+            return web.json_response({"model": body.get("model"), "response": "", "done": True, "done_reason": "load"})
+        body, delay, failure = await self._begin(request)
+        if failure is not None:
+            return failure
+        words = [f"word{i} " for i in range(self.tokens)]
+
+        if not body.get("stream", True):
+            await asyncio.sleep(delay)
+            return web.json_response({"model": body.get("model"), "response": "".join(words), "done": True})
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        # 预填充阶段占大部分耗时，之后逐个输出 token
+        await asyncio.sleep(delay * 0.8)
+        for word in words:
+            await asyncio.sleep(delay * 0.2 / len(words))
+            await response.write((json.dumps({"response": word, "done": False}) + "\n").encode())
+        await response.write((json.dumps({"response": "", "done": True}) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def _chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body, delay, failure = await self._begin(request)
+        if failure is not None:
+            return failure
+        words = [f"word{i} " for i in range(self.tokens)]
+        base = {"id": f"chatcmpl-{self.requests}", "created": int(time.time()), "model": body.get("model")}
+
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response({**base, "object": "chat.completion", "choices": [{
+                "index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"
+            }]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(delay * 0.8)
+        for word in words:
+            await asyncio.sleep(delay * 0.2 / len(words))
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
@@ -0,0 +1,67 @@
+"""替身服务使用的延迟分布
+
+命令行中用字符串描述（单位秒）：
+    0.5                 固定 0.5 秒
+    uniform:0.2:0.8     均匀分布
+    normal:0.5:0.1      正态分布（均值、标准差，截断到 0 以上）
+    lognormal:0.5:0.4   对数正态分布（中位数、sigma），长尾
+    exp:0.5             指数分布（均值）
+"""
+import math
+import random
+from typing import Optional, Union
+
+
+class Latency:
+    KINDS = ("fixed", "uniform", "normal", "lognormal", "exp")
+
+    def __init__(self, kind: str = "fixed", a: float = 0.0, b: float = 0.0, rng: Optional[random.Random] = None):
+        if kind not in self.KINDS:
+            raise ValueError(f"不支持的延迟分布: {kind}，可选: {', '.join(self.KINDS)}")
+        self.kind = kind
+        self.a = a
+        self.b = b
+        self.rng = rng or random
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        parts = str(spec).split(":")
+        if len(parts) == 1:
+            return cls("fixed", float(parts[0]))
+        kind, args = parts[0], [float(value) for value in parts[1:]]
+        return cls(kind, *args)
+
+    @classmethod
+    def of(cls, value: Union[float, str, "Latency"]) -> "Latency":
+        """把数字、字符串或 Latency 统一为 Latency"""
+        if isinstance(value, Latency):
+            return value
+        if isinstance(value, (int, float)):
+            return cls("fixed", float(value))
+        return cls.parse(value)
+
+    @property
+    def mean(self) -> float:
+        if self.kind == "uniform":
+            return (self.a + self.b) / 2
+        if self.kind == "lognormal":
+            return self.a * math.exp(self.b ** 2 / 2)
+        return self.a
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.a
+        if self.kind == "uniform":
+            return self.rng.uniform(self.a, self.b)
+        if self.kind == "normal":
+            return max(self.rng.gauss(self.a, self.b), 0.0)
+        if self.kind == "lognormal":
+            return self.a * math.exp(self.rng.gauss(0, self.b))
+        return self.rng.expovariate(1 / self.a) if self.a > 0 else 0.0
+
+    def __str__(self) -> str:
+        if self.kind == "fixed":
+            return f"{self.a:g}"
+        if self.kind == "exp":
+            return f"exp:{self.a:g}"
+        return f"{self.kind}:{self.a:g}:{self.b:g}"
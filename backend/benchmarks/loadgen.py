@@ -0,0 +1,296 @@
+"""后端接口压测：按目标并发驱动 /upload、/analyze-image、/generate-image
+
+报告吞吐、p50/p95/p99 延迟与错误率，并把结果（含当前提交号与替身配置）保存为 JSON，
+可用 benchmarks.compare 对比不同提交的结果。
+
+在 backend 目录下运行，--spawn 会启动替身服务与一个独立的后端进程（工作目录在临时目录中）：
+    python -m benchmarks.loadgen --spawn --scenario generate-image --concurrency 8 --duration 30
+压测已运行的后端（替身可用 python -m benchmarks.stack 启动）：
+    python -m benchmarks.loadgen --target http://localhost:8000 --scenario analyze-image
+
+注意：项目根目录存在 .env 时，后端启动时会用它覆盖 --spawn 传入的环境变量。
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from benchmarks import stack as fake_stack
+
+SCENARIOS = ("upload", "analyze-image", "generate-image")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩法分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(q * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def git_revision() -> Dict[str, Any]:
+    """当前提交号，以及工作区是否有未提交的改动"""
+    def run(*args: str) -> str:
+        try:
+            return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": run("rev-parse", "--short", "HEAD") or "unknown",
+            "dirty": bool(run("status", "--porcelain", "--untracked-files=no"))}
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        target: str,
+        scenario: str,
+        concurrency: int,
+        duration: Optional[float] = None,
+        requests: Optional[int] = None,
+        unique: bool = True,
+        image_url: str = "",
+        photo: bytes = b"",
+        timeout: float = 300,
+    ):
+        if scenario not in SCENARIOS:
+            raise ValueError(f"不支持的场景: {scenario}，可选: {', '.join(SCENARIOS)}")
+        self.target = target.rstrip("/")
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.duration = duration
+        self.requests = requests
+        self.unique = unique
+        self.image_url = image_url
+        self.photo = photo
+        self.timeout = timeout
+        self._issued = 0
+        self._latencies: List[float] = []
+        self._errors: Dict[str, int] = {}
+
+    def _next_index(self) -> Optional[int]:
+        if self.requests is not None and self._issued >= self.requests:
+            return None
+        self._issued += 1
+        return self._issued
+
+    def _build(self, index: int) -> Tuple[str, aiohttp.FormData]:
+        """构建第 index 个请求；unique 时每次输入不同，避免命中缓存"""
+        key = str(index) if self.unique else "0"
+        form = aiohttp.FormData()
+        if self.scenario == "upload":
+            body = self.photo + key.encode() if self.unique else self.photo
+            form.add_field("image", body, filename=f"bench_{key}.jpg", content_type="image/jpeg")
+            return "/upload", form
+        if self.scenario == "analyze-image":
+            form.add_field("objectName", "cup")
+            form.add_field("image_url", self.image_url.format(i=key))
+            form.add_field("model_type", "olama")
+            return "/analyze-image", form
+        form.add_field("prompt", f"benchmark object {key}")
+        return "/generate-image", form
+
+    async def _one(self, session: aiohttp.ClientSession, index: int):
+        path, form = self._build(index)
+        started = time.perf_counter()
+        error = None
+        try:
+            async with session.post(self.target + path, data=form) as response:
+                text = await response.text()
+                if response.status != 200:
+                    error = f"HTTP {response.status}"
+                else:
+                    body = json.loads(text)
+                    if body.get("code") != 200:
+                        error = f"code {body.get('code')}: {str(body.get('message'))[:80]}"
+        except asyncio.TimeoutError:
+            error = "timeout"
+        except (aiohttp.ClientError, ValueError) as e:
+            error = type(e).__name__
+        self._latencies.append(time.perf_counter() - started)
+        if error:
+            self._errors[error] = self._errors.get(error, 0) + 1
+
+    async def _worker(self, session: aiohttp.ClientSession, deadline: Optional[float]):
+        while deadline is None or time.perf_counter() < deadline:
+            index = self._next_index()
+            if index is None:
+                return
+            await self._one(session, index)
+
+    async def run(self) -> Dict[str, Any]:
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            started = time.perf_counter()
+            deadline = started + self.duration if self.duration else None
+            await asyncio.gather(*[self._worker(session, deadline) for _ in range(self.concurrency)])
+            elapsed = time.perf_counter() - started
+
+        total = len(self._latencies)
+        failed = sum(self._errors.values())
+        return {
+            "scenario": self.scenario,
+            "concurrency": self.concurrency,
+            "unique_inputs": self.unique,
+            "elapsed": elapsed,
+            "requests": total,
+            "errors": failed,
+            "error_rate": failed / total if total else 0.0,
+            "throughput": (total - failed) / elapsed if elapsed else 0.0,
+            "latency": {
+                "mean": sum(self._latencies) / total if total else None,
+                "p50": percentile(self._latencies, 0.50),
+                "p95": percentile(self._latencies, 0.95),
+                "p99": percentile(self._latencies, 0.99),
+                "max": max(self._latencies) if total else None,
+            },
+            "error_kinds": self._errors,
+        }
+
+
+async def spawn_backend(
+    env: Dict[str, str], port: int, workdir: str, timeout: float = 30, poll_interval: float = 0.1,
+    uvicorn_args: Sequence[str] = (),
+) -> subprocess.Popen:
+    """在临时工作目录中启动后端，等待 /health 可用；uvicorn_args 为额外的 uvicorn 参数（如 --workers 4）"""
+    backend_cwd = os.path.join(workdir, "backend")
+    os.makedirs(backend_cwd, exist_ok=True)
+    log = open(os.path.join(workdir, "backend.log"), "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", *uvicorn_args],
+        cwd=backend_cwd, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}/health"
+    async with aiohttp.ClientSession() as session:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"后端启动失败，日志见 {log.name}")
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return process
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(poll_interval)
+    process.terminate()
+    raise RuntimeError(f"后端启动超时，日志见 {log.name}")
+
+
+async def stop_backend(process: subprocess.Popen, timeout: float = 30):
+    """终止后端并在线程中等待退出（替身服务与本进程共用事件循环，后端关闭时仍需它们响应）"""
+    process.terminate()
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, process.wait, timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        await loop.run_in_executor(None, process.wait)
+
+
+def save_result(result: Dict[str, Any], directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(directory, f"{stamp}-{result['commit']}-{result['scenario']}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def print_result(result: Dict[str, Any]):
+    latency = result["latency"]
+
+    def ms(value: Optional[float]) -> str:
+        return f"{value * 1000:8.0f}" if value is not None else "       -"
+
+    print(f"{result['scenario']:15s} c={result['concurrency']:<3d} {result['requests']:6d} req  "
+          f"{result['throughput']:7.2f} req/s  p50{ms(latency['p50'])} ms  p95{ms(latency['p95'])} ms  "
+          f"p99{ms(latency['p99'])} ms  errors {result['error_rate'] * 100:5.1f}%")
+    for kind, count in result["error_kinds"].items():
+        print(f"    {count:5d} x {kind}")
+
+
+async def _main(args: argparse.Namespace):
+    random.seed(args.seed)
+    stack = fake_stack.from_arguments(args)
+    image_url = args.image_url or stack.image_url("{i}")
+    process = None
+    target = args.target
+    if args.spawn:
+        await stack.start()
+        workdir = tempfile.mkdtemp(prefix="loadgen_")
+        process = await spawn_backend(stack.backend_env(), args.port, workdir)
+        target = f"http://127.0.0.1:{args.port}"
+        print(f"backend: {target} (工作目录 {workdir})")
+
+    try:
+        for scenario in args.scenario:
+            generator = LoadGenerator(
+                target, scenario, args.concurrency,
+                duration=None if args.requests else args.duration,
+                requests=args.requests,
+                unique=not args.repeat,
+                image_url=image_url,
+                photo=stack.photo,
+            )
+            result = await generator.run()
+            result.update(git_revision())
+            result["label"] = args.label
+            result["timestamp"] = datetime.now(timezone.utc).isoformat()
+            result["target"] = target
+            if args.spawn:
+                result["fakes"] = {
+                    "ollama_latency": args.ollama_latency,
+                    "comfy_latency": args.comfy_latency,
+                    "per_image": args.per_image,
+                    "failure_rate": args.failure_rate,
+                    **stack.stats(),
+                }
+            print_result(result)
+            if not args.no_save:
+                print(f"    saved {save_result(result, args.output)}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if args.spawn:
+            await stack.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="后端接口压测")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="已运行的后端地址")
+    parser.add_argument("--spawn", action="store_true", help="启动替身服务与独立的后端进程")
+    parser.add_argument("--port", type=int, default=18600, help="--spawn 时后端监听的端口")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="压测的接口，可重复指定；默认全部")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30, help="每个场景的持续时间（秒）")
+    parser.add_argument("--requests", type=int, default=None, help="改为按请求总数结束")
+    parser.add_argument("--repeat", action="store_true", help="每次发送相同的输入（测缓存命中路径）")
+    parser.add_argument("--image-url", default=None, help="analyze-image 使用的图片地址模板，{i} 为请求序号")
+    parser.add_argument("--label", default="", help="写入结果文件的备注")
+    parser.add_argument("--output", default=RESULTS_DIR, help="结果保存目录")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--seed", type=int, default=0, help="替身延迟与失败抽样的随机种子")
+    fake_stack.add_arguments(parser)
+    args = parser.parse_args()
+    args.scenario = args.scenario or list(SCENARIOS)
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""一键启动全部替身服务：Ollama、ComfyUI 与提供测试图片的图床
+
+单独运行时打印后端需要的环境变量，并持续提供服务：
+    python -m benchmarks.stack --ollama-latency lognormal:1.5:0.4 --comfy-latency uniform:2:4 --failure-rate 0.02
+"""
+import io
+import asyncio
+import argparse
+import tempfile
+from typing import Dict, Optional
+
+from aiohttp import web
+from PIL import Image
+
+from benchmarks.fake_comfyui import FakeComfyUI
+from benchmarks.fake_ollama import FakeOllama
+
+
+def make_photo(width: int = 1600, height: int = 1200) -> bytes:
+    """生成一张带噪声的测试照片"""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+class FakeStack:
+    def __init__(
+        self,
+        ollama_latency="lognormal:1.5:0.4",
+        comfy_latency="uniform:2:4",
+        per_image: float = 0.5,
+        failure_rate: float = 0.0,
+        output_dir: Optional[str] = None,
+        host: str = "127.0.0.1",
+        base_port: int = 18500,
+        image_latency: float = 0.0,
+    ):
+        self.host = host
+        # 图床每次下载的耗时
+        self.image_latency = image_latency
+        self.ports = {"ollama": base_port, "comfyui": base_port + 1, "images": base_port + 2}
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix="comfy_output_")
+        self.ollama = FakeOllama(latency=ollama_latency, failure_rate=failure_rate)
+        self.comfyui = FakeComfyUI(prompt_overhead=comfy_latency, per_image=per_image,
+                                   output_dir=self.output_dir, failure_rate=failure_rate)
+        self.photo = make_photo()
+        self._image_runner: Optional[web.AppRunner] = None
+
+    def url(self, service: str) -> str:
+        return f"http://{self.host}:{self.ports[service]}"
+
+    def image_url(self, name: str) -> str:
+        return f"{self.url('images')}/images/{name}.jpg"
+
+    def backend_env(self) -> Dict[str, str]:
+        """让后端指向替身服务的环境变量"""
+        return {
+            "VISION_MODEL_API_ENDPOINT": f"{self.url('ollama')}/api/generate",
+            "OLLAMA_API_ENDPOINT": f"{self.url('ollama')}/api/generate",
+            "COMFY_UI_ENDPOINT": self.url("comfyui"),
+            "COMFY_UI_WS_ENDPOINT": f"ws://{self.host}:{self.ports['comfyui']}/ws",
+            "COMFY_UI_API_ENDPOINT": f"{self.url('comfyui')}/api/predict",
+            "COMFY_UI_OUTPUT_DIR": self.output_dir,
+            # 负载全部来自本机同一 IP，不按客户端限流（bench_admission 会单独开启）
+            "ADMISSION_ENABLED": "false",
+            # 替身 Ollama 默认不限并行，不在后端排队（bench_ollama_lifecycle 会单独开启）
+            "OLLAMA_MODEL_CONCURRENCY": "0",
+        }
+
+    async def handle_image(self, request: web.Request) -> web.Response:
+        if self.image_latency:
+            await asyncio.sleep(self.image_latency)
+        name = request.match_info["name"]
+        # 以 missing 开头的图片不存在，用于测试单张图片失败
+        if name.startswith("missing"):
+            raise web.HTTPNotFound()
+        # 末尾附加图片名：仍是合法 JPEG，但内容哈希不同，可绕过描述缓存
+        body = self.photo + name.encode()
+        return web.Response(body=body, content_type="image/jpeg")
+
+    async def start(self):
+        await self.ollama.start(self.host, self.ports["ollama"])
+        await self.comfyui.start(self.host, self.ports["comfyui"])
+        app = web.Application()
+        app.router.add_get("/images/{name}.jpg", self.handle_image)
+        self._image_runner = web.AppRunner(app)
+        await self._image_runner.setup()
+        await web.TCPSite(self._image_runner, self.host, self.ports["images"]).start()
+
+    async def stop(self):
+        if self._image_runner:
+            await self._image_runner.cleanup()
+        await self.comfyui.stop()
+        await self.ollama.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "ollama_requests": self.ollama.requests,
+            "ollama_failures": self.ollama.failures,
+            "comfy_prompts": self.comfyui.prompts_executed,
+            "comfy_failures": self.comfyui.prompts_failed,
+            "comfy_deleted": self.comfyui.prompts_deleted,
+            "comfy_interrupted": self.comfyui.prompts_interrupted,
+        }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--ollama-latency", default="lognormal:1.5:0.4", help="Ollama 每次调用的延迟分布")
+    parser.add_argument("--comfy-latency", default="uniform:2:4", help="ComfyUI 每个 prompt 的固定开销分布")
+    parser.add_argument("--per-image", type=float, default=0.5, help="ComfyUI 每张图片的额外耗时")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="替身服务的失败比例")
+    parser.add_argument("--base-port", type=int, default=18500)
+
+
+def from_arguments(args: argparse.Namespace) -> FakeStack:
+    return FakeStack(
+        ollama_latency=args.ollama_latency,
+        comfy_latency=args.comfy_latency,
+        per_image=args.per_image,
+        failure_rate=args.failure_rate,
+        base_port=args.base_port,
+    )
+
+
+async def _serve(stack: FakeStack):
+    await stack.start()
+    for name, value in stack.backend_env().items():
+        print(f"{name}={value}")
+    print(f"# 测试图片: {stack.image_url('example')}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stack.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动 Ollama 与 ComfyUI 替身服务")
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(from_arguments(args)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import os
+import json
+import asyncio
+import logging
+import aiohttp
+from typing import Any, Dict, List, Optional
+from http_client import http_clients
+from comfy_ws import ComfyUIProgressTracker, ComfyUIConnectionLost
+from workflow_registry import serialize_workflow
+from metrics import COMFY_GPU_SECONDS_RECOVERED, COMFY_PROMPTS_CANCELLED, track_stage
+from logging_config import truncate
+
+logger = logging.getLogger(__name__)
+
+# 出现这些事件说明 prompt 已离开队列开始执行
+STARTED_EVENTS = ("execution_start", "executing", "progress")
+
+
+class ComfyUINode:
+    """单个 ComfyUI 实例：提交、等待完成、查询历史，以及队列深度与健康状态"""
+
+    def __init__(self, base_url: str, ws_url: Optional[str] = None):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = ws_url or self.base_url.replace("https://", "wss://").replace("http://", "ws://") + "/ws"
+        self.tracker = ComfyUIProgressTracker(self.ws_url)
+        self.healthy = True
+        self.failures = 0
+        # 轮询 /queue 得到的队列深度
+        self.queue_depth = 0
+        # 本进程 pick 时预占、执行结束时释放的名额；轮询结果不会覆盖
+        self.reserved = 0
+        self.submitted = 0
+        # 成功完成的执行耗时（不含被取消或出错的执行），用于估算取消时释放的 GPU 时间
+        self.executions = 0
+        self.execution_seconds = 0.0
+
+    @property
+    def expected_execution(self) -> Optional[float]:
+        """成功执行的平均耗时，尚无数据时返回 None"""
+        return self.execution_seconds / self.executions if self.executions else None
+
+    @property
+    def load(self) -> int:
+        """当前排队深度：轮询结果与 websocket 推送的 queue_remaining 取较大者，再加上本进程的预占"""
+        observed = self.queue_depth
+        if self.tracker.connected and self.tracker.queue_remaining is not None:
+            observed = max(self.tracker.queue_remaining, observed)
+        return observed + self.reserved
+
+    def image_url(self, filename: str) -> str:
+        return f"{self.base_url}/view?filename={filename}"
+
+    def session(self) -> aiohttp.ClientSession:
+        return http_clients.session(self.base_url)
+
+    async def refresh(self, failure_threshold: int):
+        """轮询 /queue 更新队列深度与健康状态"""
+        try:
+            async with self.session().get(f"{self.base_url}/queue") as response:
+                if response.status != 200:
+                    raise Exception(f"状态码 {response.status}")
+                queue_data = await response.json()
+            self.queue_depth = len(queue_data.get("queue_running", [])) + len(queue_data.get("queue_pending", []))
+            self.mark_success()
+        except Exception as e:
+            self.mark_failure(failure_threshold)
+            logger.warning("检查ComfyUI节点失败 %s: %s", self.base_url, e)
+
+    def mark_success(self):
+        if not self.healthy:
+            logger.info("ComfyUI节点已恢复: %s", self.base_url)
+        self.healthy = True
+        self.failures = 0
+
+    def release(self):
+        """撤销 pick 时的预占（提交失败或执行结束时调用）"""
+        self.reserved = max(self.reserved - 1, 0)
+
+    def mark_failure(self, failure_threshold: int):
+        self.failures += 1
+        if self.healthy and self.failures >= failure_threshold:
+            logger.warning("ComfyUI节点不可用，暂停派发: %s", self.base_url)
+            self.healthy = False
+
+    async def submit(self, workflow_data: Dict[str, Any]) -> str:
+        """提交工作流，返回 prompt_id"""
+        # 模板中未修改的节点复用预先序列化的片段
+        body = '{"prompt":%s,"client_id":%s}' % (
+            serialize_workflow(workflow_data),  # 工作流数据
+            json.dumps(self.tracker.client_id),  # 与 websocket 相同的客户端ID
+        )
+
+        logger.debug("Submitting workflow to %s: %s", self.base_url, truncate(body))
+
+        with track_stage("comfy_submit", self.base_url):
+            prompt_id = await self._post_prompt(body)
+        self.submitted += 1
+        return prompt_id
+
+    async def _post_prompt(self, body: str) -> str:
+        async with self.session().post(
+            f"{self.base_url}/prompt",
+            data=body.encode("utf-8"),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json"
+            }
+        ) as response:
+            response_text = await response.text()
+            logger.debug("ComfyUI Response: %s", truncate(response_text))
+
+            if response.status != 200:
+                raise Exception(f"提交工作流失败 (状态码: {response.status}): {response_text}")
+
+            try:
+                prompt_response = json.loads(response_text)
+            except json.JSONDecodeError:
+                raise Exception(f"解析响应失败: {response_text}")
+            prompt_id = prompt_response.get('prompt_id')
+            if not prompt_id:
+                raise Exception("未获取到prompt_id")
+            logger.debug("Got prompt_id: %s", prompt_id)
+        return prompt_id
+
+    async def fetch_outputs(self, prompt_id: str) -> Optional[Dict[str, List[str]]]:
+        """只查询单个 prompt 的历史记录，返回 {输出节点ID: [图片文件名]}"""
+        with track_stage("comfy_history", self.base_url):
+            async with self.session().get(f"{self.base_url}/history/{prompt_id}") as response:
+                if response.status != 200:
+                    return None
+                history = await response.json()
+        outputs = history.get(prompt_id, {}).get('outputs', {})
+        images = {}
+        for node_id, node_output in outputs.items():
+            if isinstance(node_output, dict) and node_output.get('images'):
+                images[node_id] = [image['filename'] for image in node_output['images']]
+        return images or None
+
+    async def poll_history(self, prompt_id: str, timeout: float) -> Optional[Dict[str, List[str]]]:
+        """websocket 不可用时的兜底：每秒轮询 /history/{prompt_id}"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            try:
+                outputs = await self.fetch_outputs(prompt_id)
+                if outputs:
+                    return outputs
+            except Exception as e:
+                logger.warning("检查历史记录失败: %s", e)
+            await asyncio.sleep(1)
+        return None
+
+    async def wait_for_outputs(self, prompt_id: str, timeout: float, on_event=None) -> Dict[str, List[str]]:
+        """等待完成，分别记录排队与执行两个阶段的耗时"""
+        timer = track_stage("comfy_queue_wait", self.base_url).__enter__()
+
+        def observe(event):
+            nonlocal timer
+            if timer.stage == "comfy_queue_wait" and event.get("type") in STARTED_EVENTS:
+                timer = timer.then("comfy_execution")
+            if on_event is not None:
+                return on_event(event)
+
+        try:
+            outputs = await self._wait_for_outputs(prompt_id, timeout, observe)
+        except asyncio.CancelledError as e:
+            # 调用方已放弃：释放 GPU 给后面排队的请求
+            running_for = timer.elapsed if timer.stage == "comfy_execution" else None
+            timer.__exit__(type(e), e, e.__traceback__)
+            await self.cancel(prompt_id, running_for)
+            raise
+        except BaseException as e:
+            timer.__exit__(type(e), e, e.__traceback__)
+            raise
+        if timer.stage == "comfy_execution":
+            self.executions += 1
+            self.execution_seconds += timer.elapsed
+        timer.__exit__(None, None, None)
+        return outputs
+
+    async def cancel(self, prompt_id: str, running_for: Optional[float] = None, expected: Optional[float] = None) -> str:
+        """排队中的 prompt 从队列删除，正在执行的调用 /interrupt
+
+        Args:
+            running_for: 已执行的时间，用于估算释放的 GPU 时间
+            expected: 预计的执行时间，默认取本节点成功执行的平均耗时
+
+        Returns:
+            执行的操作：deleted / interrupted / finished（已结束，无需处理）/ failed
+        """
+        try:
+            async with self.session().get(f"{self.base_url}/queue") as response:
+                queue = await response.json()
+            running = {item[1] for item in queue.get("queue_running", [])}
+            pending = {item[1] for item in queue.get("queue_pending", [])}
+            if prompt_id in pending:
+                action = "deleted"
+                request = self.session().post(f"{self.base_url}/queue", json={"delete": [prompt_id]})
+            elif prompt_id in running:
+                action = "interrupted"
+                # 新版 ComfyUI 只在 prompt_id 匹配时中断；旧版忽略请求体，中断当前任务（已确认是本 prompt）
+                request = self.session().post(f"{self.base_url}/interrupt", json={"prompt_id": prompt_id})
+            else:
+                return "finished"
+            async with request as response:
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning("取消 ComfyUI prompt 失败 %s: %s", prompt_id, e)
+            return "failed"
+
+        COMFY_PROMPTS_CANCELLED.labels(node=self.base_url, action=action).inc()
+        if expected is None:
+            expected = self.expected_execution
+        if expected is not None:
+            recovered = expected if action == "deleted" else max(expected - (running_for or 0.0), 0.0)
+            COMFY_GPU_SECONDS_RECOVERED.labels(node=self.base_url).inc(recovered)
+        logger.info("已取消 ComfyUI prompt %s (%s)", prompt_id, action)
+        return action
+
+    async def _wait_for_outputs(self, prompt_id: str, timeout: float, on_event=None) -> Dict[str, List[str]]:
+        """优先通过 websocket 等待完成，连接断开时退回轮询"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await self.tracker.wait_for_completion(prompt_id, timeout, on_event=on_event)
+            outputs = await self.fetch_outputs(prompt_id)
+            if outputs:
+                return outputs
+        except ComfyUIConnectionLost as e:
+            logger.warning("%s，改用轮询 /history/%s", e, prompt_id)
+        except asyncio.TimeoutError:
+            raise Exception("生成超时")
+
+        outputs = await self.poll_history(prompt_id, max(deadline - loop.time(), 0))
+        if not outputs:
+            raise Exception("生成超时")
+        return outputs
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "load": self.load,
+            "reserved": self.reserved,
+            "failures": self.failures,
+            "submitted": self.submitted,
+            "avg_execution_seconds": round(self.expected_execution, 3) if self.executions else None,
+            "websocket_connected": self.tracker.connected,
+        }
+
+
+class ComfyUIDispatcher:
+    """多个 ComfyUI 实例之间的派发：选择队列最短的健康节点
+
+    后台定期轮询各节点 /queue，连续失败的节点暂停派发，恢复后重新加入。
+    """
+
+    def __init__(
+        self,
+        endpoints: Optional[List[str]] = None,
+        check_interval: Optional[float] = None,
+        failure_threshold: Optional[int] = None,
+    ):
+        if endpoints is None:
+            configured = os.getenv("COMFY_UI_ENDPOINTS", "")
+            endpoints = [e.strip() for e in configured.split(",") if e.strip()]
+        if endpoints:
+            self.nodes = [ComfyUINode(endpoint) for endpoint in endpoints]
+        else:
+            # 未配置多节点时沿用单节点配置
+            self.nodes = [ComfyUINode(
+                os.getenv("COMFY_UI_ENDPOINT", "http://localhost:8188"),
+                os.getenv("COMFY_UI_WS_ENDPOINT") or None
+            )]
+        self.check_interval = check_interval or float(os.getenv("COMFY_UI_HEALTH_INTERVAL", "5"))
+        self.failure_threshold = failure_threshold or int(os.getenv("COMFY_UI_FAILURE_THRESHOLD", "2"))
+        self._monitor: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """建立各节点的 websocket 并启动健康检查（重复调用无副作用）"""
+        if self._monitor and not self._monitor.done():
+            return
+        self._monitor = asyncio.create_task(self._run_monitor())
+        started = [await node.tracker.start() for node in self.nodes]
+        await asyncio.gather(*[node.refresh(self.failure_threshold) for node in self.nodes])
+        if any(started):
+            await asyncio.gather(*[node.tracker.wait_connected(timeout=2) for node in self.nodes])
+
+    async def close(self):
+        if self._monitor:
+            self._monitor.cancel()
+            try:
+                await self._monitor
+            except asyncio.CancelledError:
+                pass
+            self._monitor = None
+        for node in self.nodes:
+            await node.tracker.close()
+
+    def pick(self, exclude: Optional[List[ComfyUINode]] = None) -> ComfyUINode:
+        """选择队列最短的健康节点，并立即预占一个名额，避免并发请求挤向同一节点"""
+        candidates = [node for node in self.nodes if node.healthy and node not in (exclude or [])]
+        if not candidates:
+            raise Exception("没有可用的ComfyUI节点")
+        node = min(candidates, key=lambda node: node.load)
+        node.reserved += 1
+        return node
+
+    def stats(self) -> Dict[str, Any]:
+        return {node.base_url: node.stats() for node in self.nodes}
+
+    async def _run_monitor(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await asyncio.gather(*[node.refresh(self.failure_threshold) for node in self.nodes])
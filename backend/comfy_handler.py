@@ -1,114 +1,137 @@
 import os
-import json
+import random
 import asyncio
+import logging
 import aiohttp
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+from comfy_dispatcher import ComfyUIDispatcher, STARTED_EVENTS
+from quality_controller import QualityController, sampling_work
+from workflow_registry import WorkflowRegistry
+
+logger = logging.getLogger(__name__)
 
 class ComfyUIHandler:
+    # 生成最长等待时间（秒）
+    GENERATION_TIMEOUT = 120
+
     def __init__(self):
-        self.base_url = os.getenv("COMFY_UI_ENDPOINT", "http://localhost:8188")
-        self.queue_endpoint = f"{self.base_url}/queue"
-        self.history_endpoint = f"{self.base_url}/history"
+        # 一个或多个 ComfyUI 实例（COMFY_UI_ENDPOINTS 逗号分隔）
+        self.dispatcher = ComfyUIDispatcher()
+        # 随机种子的工作流每次结果不同，不参与结果缓存
+        self.randomize_seed = os.getenv("COMFY_UI_RANDOM_SEED", "false").lower() in ("1", "true", "yes")
+        # 排队积压时降低步数/分辨率，保持生成延迟的 p95 目标
+        self.quality = QualityController()
         
-        # 加载工作流配置
-        workflow_path = os.path.join(os.path.dirname(__file__), "..", "workflows", "BasicImGen.json")
-        with open(workflow_path, 'r') as f:
-            self.workflow = json.load(f)
-
-    def _prepare_workflow(self, prompt: str) -> Dict[str, Any]:
-        """准备工作流数据，更新提示词"""
-        workflow = self.workflow.copy()
-        # 更新正面提示词节点
-        workflow["6"]["inputs"]["text"] = f"{prompt}, photorealistic, masterpiece, best quality"
-        # 更新负面提示词节点
-        workflow["7"]["inputs"]["text"] = "text, watermark, bad quality, blur, noise"
+        # 加载 workflows/ 下的所有工作流模板
+        self.workflows = WorkflowRegistry()
+        self.workflows.load()
+
+    @property
+    def deterministic(self) -> bool:
+        """相同提示词是否总是生成相同图片"""
+        return not self.randomize_seed
+
+    def prepare_workflow(self, prompt: str, workflow_name: Optional[str] = None) -> Dict[str, Any]:
+        """准备工作流数据，更新提示词（只复制被修改的节点，模板本身不变）
+
+        按当前负载选择质量档位，档位序号记录在返回值的 quality 属性上。
+
+        Args:
+            prompt: 提示词
+            workflow_name: workflows/ 下的工作流名称（不含扩展名），省略时使用默认工作流
+        """
+        template = self.workflows.get(workflow_name)
+        level, values = self.quality.select(template, self.queue_load())
+        values["positive"] = f"{prompt}, photorealistic, masterpiece, best quality"
+        if "negative" in template.patch_points:
+            values["negative"] = "text, watermark, bad quality, blur, noise"
+        if self.randomize_seed:
+            values["seed"] = random.randint(0, 2**50)
+        workflow = template.build(**values)
+        workflow.quality = level
         return workflow
 
-    async def _check_queue_status(self, session: aiohttp.ClientSession) -> bool:
-        """检查队列状态"""
-        try:
-            async with session.get(self.queue_endpoint) as response:
-                if response.status == 200:
-                    queue_data = await response.json()
-                    return len(queue_data['queue_running']) == 0
-                return False
-        except Exception as e:
-            print(f"检查队列状态失败: {str(e)}")
-            return False
+    def queue_load(self) -> int:
+        """新请求将进入的队列深度（健康节点中最短的队列）"""
+        loads = [node.load for node in self.dispatcher.nodes if node.healthy]
+        return min(loads) if loads else 0
+
+    def describe_quality(self, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """响应中报告的质量档位、步数与分辨率"""
+        return self.quality.describe(getattr(workflow, "quality", None) or 0, workflow)
+
+    async def start(self):
+        """建立到各 ComfyUI 实例的常驻 websocket 连接并启动健康检查"""
+        await self.dispatcher.start()
 
-    async def generate_image(self, prompt: str) -> str:
-        """生成图片"""
+    async def close(self):
+        await self.dispatcher.close()
+
+    async def generate_image(self, prompt: str, on_event=None, workflow_data: Optional[Dict[str, Any]] = None) -> str:
+        """生成图片
+
+        Args:
+            prompt: 提示词
+            on_event: 可选回调，接收 ComfyUI 的 executing/progress/executed 事件
+            workflow_data: 已通过 prepare_workflow 准备好的工作流，省略时按 prompt 生成
+        """
         try:
             # 准备工作流数据
-            workflow_data = self._prepare_workflow(prompt)
-            
-            async with aiohttp.ClientSession() as session:
-                # 1. 等待队列可用
-                retries = 0
-                while retries < 30:  # 最多等待30秒
-                    if await self._check_queue_status(session):
-                        break
-                    await asyncio.sleep(1)
-                    retries += 1
-                
-                # 2. 提交工作流
-                try:
-                    # 修改请求格式
-                    request_data = {
-                        "prompt": workflow_data,  # 工作流数据
-                        "client_id": "backend_api"  # 添加客户端ID
-                    }
-                    
-                    print(f"Debug - Submitting workflow: {json.dumps(request_data, indent=2)}")
-                    
-                    async with session.post(
-                        f"{self.base_url}/prompt",
-                        json=request_data,  # 使用包装后的请求数据
-                        headers={
-                            "Content-Type": "application/json",
-                            "Accept": "application/json"
-                        }
-                    ) as response:
-                        response_text = await response.text()
-                        print(f"Debug - ComfyUI Response: {response_text}")
-                        
-                        if response.status != 200:
-                            raise Exception(f"提交工作流失败 (状态码: {response.status}): {response_text}")
-                            
-                        try:
-                            prompt_response = json.loads(response_text)
-                            prompt_id = prompt_response.get('prompt_id')
-                            if not prompt_id:
-                                raise Exception("未获取到prompt_id")
-                            print(f"Debug - Got prompt_id: {prompt_id}")
-                        except json.JSONDecodeError:
-                            raise Exception(f"解析响应失败: {response_text}")
-                            
-                except Exception as e:
-                    print(f"Debug - Workflow submission error: {str(e)}")
-                    raise Exception(f"提交工作流失败: {str(e)}")
-
-                # 3. 等待生成完成
-                max_retries = 120  # 最多等待120秒
-                retries = 0
-                while retries < max_retries:
-                    try:
-                        async with session.get(self.history_endpoint) as response:
-                            if response.status == 200:
-                                history = await response.json()
-                                if prompt_id in history:
-                                    outputs = history[prompt_id].get('outputs', {})
-                                    for node_id, node_output in outputs.items():
-                                        if isinstance(node_output, dict) and node_output.get('images'):
-                                            image_name = node_output['images'][0]['filename']
-                                            return f"{self.base_url}/view?filename={image_name}"
-                    except Exception as e:
-                        print(f"检查历史记录失败: {str(e)}")
-                    
-                    await asyncio.sleep(1)
-                    retries += 1
-
-                raise Exception("生成超时")
-
+            if workflow_data is None:
+                workflow_data = self.prepare_workflow(prompt)
+            outputs = await self.run_workflow(workflow_data, on_event=on_event)
+            for image_urls in outputs.values():
+                return image_urls[0]
+            raise Exception("未找到输出图片")
         except Exception as e:
             raise Exception(f"图片生成失败: {str(e)}")
+
+    async def run_workflow(self, workflow_data: Dict[str, Any], on_event=None) -> Dict[str, List[str]]:
+        """提交工作流并等待完成，返回 {输出节点ID: [图片URL]}
+
+        直接提交到队列最短的健康节点（ComfyUI 自身会排队），
+        之后的等待与历史查询都固定在该节点上。
+        """
+        await self.start()
+
+        tried = []
+        while True:
+            try:
+                node = self.dispatcher.pick(exclude=tried)
+            except Exception as e:
+                raise Exception(f"提交工作流失败: {str(e)}")
+            try:
+                prompt_id = await node.submit(workflow_data)
+                break
+            except aiohttp.ClientError as e:
+                # 连接层面的失败换一个节点重试
+                logger.warning("Workflow submission error on %s: %s", node.base_url, e)
+                node.release()
+                node.mark_failure(self.dispatcher.failure_threshold)
+                tried.append(node)
+            except Exception as e:
+                node.release()
+                logger.error("Workflow submission error: %s", e)
+                raise Exception(f"提交工作流失败: {str(e)}")
+
+        # 记录执行阶段的耗时，用于按工作量估算各质量档位的延迟
+        loop = asyncio.get_running_loop()
+        execution_started: Optional[float] = None
+
+        def observe(event):
+            nonlocal execution_started
+            if execution_started is None and event.get("type") in STARTED_EVENTS:
+                execution_started = loop.time()
+            if on_event is not None:
+                return on_event(event)
+
+        try:
+            outputs = await node.wait_for_outputs(prompt_id, self.GENERATION_TIMEOUT, on_event=observe)
+        finally:
+            node.release()
+        if execution_started is not None:
+            self.quality.record_execution(loop.time() - execution_started, sampling_work(workflow_data))
+        return {
+            node_id: [node.image_url(filename) for filename in filenames]
+            for node_id, filenames in outputs.items()
+        }
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import uuid
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+from http_client import http_clients
+
+logger = logging.getLogger(__name__)
+
+# 会结束一个 prompt 的消息类型
+_TERMINAL_ERROR_TYPES = {"execution_error", "execution_interrupted"}
+
+
+class ComfyUIConnectionLost(Exception):
+    """websocket 连接在等待期间断开，调用方应退回到轮询"""
+
+
+class PromptWatch:
+    """单个 prompt 的事件订阅"""
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+    def feed(self, event: Dict[str, Any]):
+        self.events.put_nowait(event)
+
+
+class ComfyUIProgressTracker:
+    """维护一条到 ComfyUI /ws 的常驻连接，把 executing/progress/executed 事件分发给等待中的 prompt"""
+
+    # 未被认领的 prompt 事件最多缓存多少个（提交返回前事件就可能到达）
+    MAX_ORPHANS = 256
+
+    def __init__(self, ws_url: str, client_id: Optional[str] = None, reconnect_delay: float = 1.0):
+        self.ws_url = ws_url
+        self.client_id = client_id or f"backend_api_{uuid.uuid4().hex[:8]}"
+        self.reconnect_delay = reconnect_delay
+        self._task: Optional[asyncio.Task] = None
+        self._watches: Dict[str, PromptWatch] = {}
+        self._orphans: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._connected = asyncio.Event()
+        self._closed = False
+        # 最近一次 status 消息中的剩余队列长度
+        self.queue_remaining: Optional[int] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def start(self):
+        """启动后台连接任务（重复调用无副作用），返回是否新建了连接任务"""
+        if self._task and not self._task.done():
+            return False
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def close(self):
+        """停止后台任务并释放连接"""
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._connected.clear()
+
+    async def wait_connected(self, timeout: float) -> bool:
+        """等待连接建立，超时返回 False"""
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def watch(self, prompt_id: str) -> PromptWatch:
+        """订阅某个 prompt 的事件，并回放提前到达的事件"""
+        watch = PromptWatch(prompt_id)
+        self._watches[prompt_id] = watch
+        for event in self._orphans.pop(prompt_id, []):
+            watch.feed(event)
+        return watch
+
+    def unwatch(self, prompt_id: str):
+        self._watches.pop(prompt_id, None)
+
+    async def wait_for_completion(
+        self,
+        prompt_id: str,
+        timeout: float,
+        on_event: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ):
+        """等待 prompt 执行结束
+
+        Raises:
+            ComfyUIConnectionLost: 连接断开，需改用轮询
+            asyncio.TimeoutError: 超时
+            Exception: ComfyUI 报告执行失败
+        """
+        watch = self.watch(prompt_id)
+        try:
+            if not self.connected:
+                raise ComfyUIConnectionLost("ComfyUI websocket 未连接")
+            await asyncio.wait_for(self._consume(watch, on_event), timeout=timeout)
+        finally:
+            self.unwatch(prompt_id)
+
+    async def _consume(self, watch: PromptWatch, on_event):
+        while True:
+            event = await watch.events.get()
+            event_type = event.get("type")
+            if event_type == "_disconnected":
+                raise ComfyUIConnectionLost("ComfyUI websocket 连接已断开")
+            if on_event is not None:
+                result = on_event(event)
+                if asyncio.iscoroutine(result):
+                    await result
+            if event_type in _TERMINAL_ERROR_TYPES:
+                data = event.get("data", {})
+                raise Exception(f"ComfyUI执行失败: {data.get('exception_message') or event_type}")
+            if _is_finished(event):
+                return
+
+    async def _run(self):
+        url = f"{self.ws_url}?clientId={self.client_id}"
+        while not self._closed:
+            try:
+                session = http_clients.session(self.ws_url)
+                async with session.ws_connect(url, heartbeat=30) as ws:
+                    self._connected.set()
+                    logger.info("ComfyUI websocket connected: %s", self.ws_url)
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+                        # 二进制消息为预览图，忽略
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("ComfyUI websocket 连接失败: %s", e)
+            finally:
+                self.queue_remaining = None
+                if self._connected.is_set():
+                    self._connected.clear()
+                    self._notify_disconnected()
+            if not self._closed:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _dispatch(self, raw: str):
+        try:
+            event = json.loads(raw)
+        except json.JSONDecodeError:
+            return
+        data = event.get("data")
+        if event.get("type") == "status" and isinstance(data, dict):
+            exec_info = data.get("status", {}).get("exec_info", {})
+            if "queue_remaining" in exec_info:
+                self.queue_remaining = exec_info["queue_remaining"]
+            return
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        if not prompt_id:
+            return
+        watch = self._watches.get(prompt_id)
+        if watch is not None:
+            watch.feed(event)
+            return
+        self._orphans.setdefault(prompt_id, []).append(event)
+        self._orphans.move_to_end(prompt_id)
+        while len(self._orphans) > self.MAX_ORPHANS:
+            self._orphans.popitem(last=False)
+
+    def _notify_disconnected(self):
+        for watch in list(self._watches.values()):
+            watch.feed({"type": "_disconnected"})
+
+
+def _is_finished(event: Dict[str, Any]) -> bool:
+    """executing 且 node 为空，或 execution_success，表示 prompt 已完成"""
+    event_type = event.get("type")
+    if event_type == "execution_success":
+        return True
+    if event_type == "executing":
+        return event.get("data", {}).get("node") is None
+    return False
@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from shared_state import connect, shared_path
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(data: bytes) -> str:
+    """图片内容哈希"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class DescriptionCache:
+    """图片描述缓存，按 (图片内容哈希, 提示词, 模型) 寻址
+
+    内存层为带 TTL 的 LRU，按条目数和字节数淘汰；
+    SQLite 磁盘层（VISION_CACHE_DB，默认在共享状态目录中，设为空时禁用）由所有 worker 进程共用，重启后仍可命中。
+    另外记录 URL -> 内容哈希 的映射，已知 URL 无需重新下载即可命中。
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        disk_path: Optional[str] = None,
+    ):
+        self.max_entries = max_entries or int(os.getenv("VISION_CACHE_MAX_ENTRIES", "1024"))
+        self.max_bytes = max_bytes or int(os.getenv("VISION_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+        self.ttl = ttl or float(os.getenv("VISION_CACHE_TTL", "86400"))
+        self.disk_path = disk_path if disk_path is not None else os.getenv("VISION_CACHE_DB", shared_path("descriptions.sqlite3"))
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._urls: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "url_hits": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if self.disk_path:
+            self._open_db()
+
+    @staticmethod
+    def make_key(image_hash: str, prompt: str, model: str) -> str:
+        """由内容哈希、提示词和模型名生成缓存键"""
+        digest = hashlib.sha256()
+        for part in (image_hash, prompt, model):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def lookup_url(self, url: str) -> Optional[str]:
+        """返回已知 URL 对应的内容哈希"""
+        item = self._urls.get(url)
+        if item is None:
+            return None
+        image_hash, expires_at = item
+        if expires_at < time.time():
+            del self._urls[url]
+            return None
+        self._urls.move_to_end(url)
+        self._counters["url_hits"] += 1
+        return image_hash
+
+    def remember_url(self, url: str, image_hash: str):
+        self._urls[url] = (image_hash, time.time() + self.ttl)
+        self._urls.move_to_end(url)
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        """依次查询内存层和磁盘层"""
+        item = self._entries.get(key)
+        if item is not None:
+            description, expires_at, size = item
+            if expires_at >= time.time():
+                self._entries.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return description
+            self._drop(key)
+            self._counters["expired"] += 1
+
+        if self._db is not None:
+            row = await self._run_db(self._db_get, key)
+            if row is not None:
+                description, created_at = row
+                if created_at + self.ttl >= time.time():
+                    self._put_memory(key, description, created_at + self.ttl)
+                    self._counters["disk_hits"] += 1
+                    return description
+                self._counters["expired"] += 1
+
+        self._counters["misses"] += 1
+        return None
+
+    async def set(self, key: str, description: str):
+        now = time.time()
+        self._put_memory(key, description, now + self.ttl)
+        if self._db is not None:
+            await self._run_db(self._db_set, key, description, now)
+
+    def stats(self) -> Dict[str, int]:
+        result = dict(self._counters)
+        result["entries"] = len(self._entries)
+        result["bytes"] = self._bytes
+        result["known_urls"] = len(self._urls)
+        result["disk_enabled"] = self._db is not None
+        return result
+
+    def _put_memory(self, key: str, description: str, expires_at: float):
+        size = len(description.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (description, expires_at, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self._counters["evictions"] += 1
+
+    def _drop(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    # ---- 磁盘层 ----
+
+    def _open_db(self):
+        self._db = connect(self.disk_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions ("
+            "key TEXT PRIMARY KEY, description TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    async def _run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, func, *args)
+        except sqlite3.Error as e:
+            logger.warning("描述缓存磁盘层错误: %s", e)
+            return None
+
+    def _db_get(self, key: str):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT description, created_at FROM descriptions WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _db_set(self, key: str, description: str, created_at: float):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO descriptions (key, description, created_at) VALUES (?, ?, ?)",
+                (key, description, created_at),
+            )
+            self._db.execute("DELETE FROM descriptions WHERE created_at < ?", (created_at - self.ttl,))
+            self._db.commit()
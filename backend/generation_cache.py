@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from workflow_registry import serialize_workflow
+from image_store import link_or_copy
+
+
+class GenerationCache:
+    """生成结果缓存，以最终提交的工作流的规范化哈希为键
+
+    固定种子的工作流对同一输入总是产出同一张图片，命中时直接返回本地存储的图片，
+    不再占用 ComfyUI。按字节预算做 LRU 淘汰，访问时间记录在文件 mtime 上，重启后可恢复顺序。
+    缓存目录由所有 worker 进程共用：查询以磁盘上的文件为准；容量与 LRU 顺序保存在内存索引中，
+    读写时增量更新，其他 worker 写入的文件在命中时或定期重新扫描目录时计入。
+    文件系统操作都在线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None,
+                 rescan_interval: Optional[float] = None):
+        self.directory = Path(directory or os.getenv("GENERATION_CACHE_DIR", "static/generation_cache"))
+        self.max_bytes = max_bytes or int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+        # 写入时重新扫描目录的最短间隔（秒）
+        self.rescan_interval = rescan_interval if rescan_interval is not None else float(
+            os.getenv("GENERATION_CACHE_RESCAN_SECONDS", "60"))
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._scanned_at: Optional[float] = None
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    async def start(self):
+        """创建缓存目录，按 mtime 恢复 LRU 索引"""
+        await self._rescan()
+
+    @staticmethod
+    def workflow_key(workflow: Dict[str, Any]) -> str:
+        """工作流图的规范化哈希（键排序、无多余空白）"""
+        return hashlib.sha256(serialize_workflow(workflow).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Path]:
+        """命中时返回缓存图片路径（包括其他 worker 写入的结果）"""
+        path = self._path(key)
+        try:
+            size = await asyncio.to_thread(self._touch, path)
+        except FileNotFoundError:
+            # 不存在或已被其他 worker 淘汰
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)
+            self._counters["misses"] += 1
+            return None
+        self._index(key, size)
+        self._counters["hits"] += 1
+        return path
+
+    async def put(self, key: str, source_path: str) -> Optional[Path]:
+        """把生成结果存入缓存，超出预算时淘汰最久未使用的条目"""
+        path = self._path(key)
+        size = await asyncio.to_thread(self._store, source_path, path)
+        if size is None:
+            return None
+        self._counters["stores"] += 1
+        if self._scanned_at is None or time.monotonic() - self._scanned_at >= self.rescan_interval:
+            # 容量包括其他 worker 写入的文件
+            await self._rescan()
+        else:
+            self._index(key, size)
+            await self._evict()
+        return path
+
+    def stats(self) -> Dict[str, int]:
+        result = dict(self._counters)
+        result["entries"] = len(self._entries)
+        result["bytes"] = self._bytes
+        result["max_bytes"] = self.max_bytes
+        return result
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def _index(self, key: str, size: int):
+        """记录条目为最近使用"""
+        self._bytes += size - self._entries.get(key, 0)
+        self._entries[key] = size
+        self._entries.move_to_end(key)
+
+    @staticmethod
+    def _touch(path: Path) -> int:
+        """更新访问时间，返回文件大小"""
+        os.utime(path)
+        return path.stat().st_size
+
+    def _store(self, source_path: str, path: Path) -> Optional[int]:
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            return None
+        # 与 ComfyUI 输出目录在同一文件系统时为硬链接
+        link_or_copy(source_path, path)
+        return size
+
+    def _scan(self) -> "OrderedDict[str, int]":
+        """按 mtime 排列目录中的文件（在线程中执行）"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.glob("*.png"):
+            try:
+                files.append((path.stat(), path.stem))
+            except FileNotFoundError:
+                # 已被其他 worker 淘汰
+                continue
+        files.sort(key=lambda item: item[0].st_mtime)
+        return OrderedDict((key, stat.st_size) for stat, key in files)
+
+    async def _rescan(self):
+        self._entries = await asyncio.to_thread(self._scan)
+        self._bytes = sum(self._entries.values())
+        self._scanned_at = time.monotonic()
+        await self._evict()
+
+    async def _evict(self):
+        victims: List[Path] = []
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._counters["evictions"] += 1
+            victims.append(self._path(key))
+        if victims:
+            await asyncio.to_thread(self._unlink, victims)
+
+    @staticmethod
+    def _unlink(paths: List[Path]):
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
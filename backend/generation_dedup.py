@@ -0,0 +1,114 @@
+import os
+import asyncio
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+from workflow_registry import serialize_workflow
+
+
+def _workflow_hash(workflow: Dict[str, Any]) -> str:
+    return hashlib.sha256(serialize_workflow(workflow).encode("utf-8")).hexdigest()
+
+
+class _Pending:
+    def __init__(self, key: str, on_event):
+        self.key = key
+        self.on_event = on_event
+        self.future: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+        # 已提交时所在的分组（执行生成的 Task 与全部成员）
+        self.group: Optional[Tuple[asyncio.Task, List["_Pending"]]] = None
+
+
+class GenerationDeduplicator:
+    """ComfyUIHandler 前的请求去重（默认关闭）
+
+    在 window 秒内到达、最终提交的工作流完全相同（提示词、参数与种子都相同）的请求只生成一次，
+    各调用方共享同一张图片。随机种子的请求互不相同，不会合并。
+    提示词不同的请求不合并为一次提交：ComfyUI 对同一张图中的并行分支与 latent batch
+    都没有明显的吞吐收益（见 benchmarks/bench_dedup.py）。
+    """
+
+    def __init__(self, handler, window: Optional[float] = None):
+        self.handler = handler
+        self.window = window if window is not None else float(os.getenv("COMFY_UI_DEDUP_WINDOW_MS", "0")) / 1000
+        self._groups: Dict[str, List[_Pending]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._counters = {"requests": 0, "generations": 0, "deduplicated": 0, "largest_group": 0, "abandoned": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def generate_image(self, workflow: Dict[str, Any], on_event=None) -> str:
+        """提交一个已准备好的工作流（prepare_workflow 的返回值），返回生成图片的URL"""
+        self._counters["requests"] += 1
+        if not self.enabled:
+            return await self.handler.generate_image("", on_event=on_event, workflow_data=workflow)
+
+        key = _workflow_hash(workflow)
+        pending = _Pending(key, on_event)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = []
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key, workflow)
+        group.append(pending)
+        try:
+            return await pending.future
+        except asyncio.CancelledError:
+            self._abandon(pending)
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        result = dict(self._counters)
+        result["window_ms"] = int(self.window * 1000)
+        result["pending"] = sum(len(group) for group in self._groups.values())
+        return result
+
+    def _flush(self, key: str, workflow: Dict[str, Any]):
+        self._timers.pop(key, None)
+        group = self._groups.pop(key, [])
+        if group:
+            task = asyncio.create_task(self._generate(workflow, group))
+            for pending in group:
+                pending.group = (task, group)
+
+    def _abandon(self, pending: _Pending):
+        """调用方已放弃：未提交的请求移出窗口；全部调用方都放弃时取消生成（由 ComfyUI 节点删除或中断 prompt）"""
+        self._counters["abandoned"] += 1
+        group = self._groups.get(pending.key)
+        if group is not None and pending in group:
+            group.remove(pending)
+            if not group:
+                self._groups.pop(pending.key)
+                timer = self._timers.pop(pending.key, None)
+                if timer is not None:
+                    timer.cancel()
+            return
+        if pending.group is not None:
+            task, members = pending.group
+            if all(member.future.cancelled() for member in members):
+                task.cancel()
+
+    async def _generate(self, workflow: Dict[str, Any], group: List[_Pending]):
+        self._counters["generations"] += 1
+        self._counters["largest_group"] = max(self._counters["largest_group"], len(group))
+        self._counters["deduplicated"] += len(group) - 1
+
+        callbacks = [pending.on_event for pending in group if pending.on_event is not None]
+
+        async def fan_out(event):
+            for callback in callbacks:
+                result = callback(event)
+                if asyncio.iscoroutine(result):
+                    await result
+
+        try:
+            image_url = await self.handler.generate_image("", on_event=fan_out if callbacks else None, workflow_data=workflow)
+        except Exception as e:
+            for pending in group:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+
+        for pending in group:
+            if not pending.future.done():
+                pending.future.set_result(image_url)
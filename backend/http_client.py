@@ -0,0 +1,162 @@
+import os
+import json
+import asyncio
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# websocket 与 http 共用同一主机的连接池
+_SCHEME_ALIASES = {"ws": "http", "wss": "https"}
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class _HostStats:
+    """单个主机连接池的使用统计"""
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "errors": self.errors,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+        }
+
+
+class HTTPClientManager:
+    """应用级共享的 HTTP 客户端，为每个主机维护一个带 keep-alive 的连接池
+
+    在 FastAPI 的 startup 中调用 start()，shutdown 中调用 close()。
+    所有外部调用通过 session(url) 获取对应主机的 ClientSession。
+    配置在 start() 或首次创建连接池时读取（.env 加载之后），未传入的参数读取环境变量。
+    """
+
+    def __init__(
+        self,
+        limit_per_host: Optional[int] = None,
+        keepalive_timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        total_timeout: Optional[float] = None,
+    ):
+        self._overrides = (limit_per_host, keepalive_timeout, connect_timeout, total_timeout)
+        self._configured = False
+        self._sessions: Dict[Tuple[str, str, int], aiohttp.ClientSession] = {}
+        self._stats: Dict[Tuple[str, str, int], _HostStats] = {}
+        self._closed = False
+
+    def configure(self):
+        limit_per_host, keepalive_timeout, connect_timeout, total_timeout = self._overrides
+        self.limit_per_host = limit_per_host or int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "32"))
+        self.keepalive_timeout = keepalive_timeout or float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+        self.connect_timeout = connect_timeout or float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+        self.total_timeout = total_timeout or float(os.getenv("HTTP_TOTAL_TIMEOUT", "300"))
+        self._configured = True
+
+    async def start(self):
+        """读取配置并启用客户端；各主机的连接池在首次使用时创建"""
+        self.configure()
+        self._closed = False
+
+    async def close(self):
+        """关闭所有连接池"""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        self._closed = True
+        for session in sessions:
+            await session.close()
+        # 给底层连接留出关闭时间，避免 "Unclosed connector" 警告
+        await asyncio.sleep(0.25)
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """返回 url 所在主机的共享 ClientSession（必须在事件循环中调用）"""
+        if self._closed:
+            raise RuntimeError("HTTP客户端已关闭")
+        key = _host_key(url)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            session = self._create_session(key)
+            self._sessions[key] = session
+        return session
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """各主机连接池的使用统计"""
+        result = {}
+        for key, host_stats in self._stats.items():
+            scheme, host, port = key
+            entry = host_stats.as_dict()
+            session = self._sessions.get(key)
+            connector = session.connector if session is not None else None
+            # aiohttp 未公开空闲连接数，这里读取其内部结构，仅用于观测
+            idle = getattr(connector, "_conns", {}) if connector is not None else {}
+            entry["idle_connections"] = sum(len(conns) for conns in idle.values())
+            entry["limit"] = self.limit_per_host
+            result[f"{scheme}://{host}:{port}"] = entry
+        return result
+
+    def _create_session(self, key: Tuple[str, str, int]) -> aiohttp.ClientSession:
+        if not self._configured:
+            self.configure()
+        host_stats = self._stats.setdefault(key, _HostStats())
+        connector = aiohttp.TCPConnector(
+            limit=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(total=self.total_timeout, connect=self.connect_timeout)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            trace_configs=[_trace_config(host_stats)],
+        )
+
+
+def _host_key(url: str) -> Tuple[str, str, int]:
+    parts = urlsplit(url)
+    scheme = _SCHEME_ALIASES.get(parts.scheme, parts.scheme) or "http"
+    port = parts.port or _DEFAULT_PORTS.get(scheme, 80)
+    return scheme, parts.hostname or "", port
+
+
+def _trace_config(host_stats: _HostStats) -> aiohttp.TraceConfig:
+    async def on_request_start(session, ctx, params):
+        host_stats.requests += 1
+        host_stats.in_flight += 1
+
+    async def on_request_end(session, ctx, params):
+        host_stats.in_flight -= 1
+
+    async def on_request_exception(session, ctx, params):
+        host_stats.in_flight -= 1
+        host_stats.errors += 1
+
+    async def on_connection_create_end(session, ctx, params):
+        host_stats.connections_created += 1
+
+    async def on_connection_reuseconn(session, ctx, params):
+        host_stats.connections_reused += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+# 全局共享实例
+http_clients = HTTPClientManager()
+
+
+async def iter_ndjson(response: aiohttp.ClientResponse):
+    """逐行解析 NDJSON 流式响应（Ollama stream 模式）"""
+    async for line in response.content:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
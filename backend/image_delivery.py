@@ -0,0 +1,190 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+from image_preprocess import warm_process_pool
+from image_store import ImageStore
+from metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+# 格式名 -> (PIL 编码器, Content-Type)
+VARIANT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+# 内容寻址的图片与派生图片内容永不改变
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 旧文件名的内容可能被覆盖，每次使用前需用 ETag 验证
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+
+def _render_variant(source: str, target: str, width: int, encoder: str, quality: int) -> int:
+    """缩小到宽度不超过 width 并重新编码，写入 target（在子进程中执行），返回字节数"""
+    from PIL import Image, ImageOps
+
+    temp = os.path.join(os.path.dirname(target), f".tmp-{os.getpid()}-{os.path.basename(target)}")
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if encoder == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA")
+        if image.width > width:
+            image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+        if encoder == "WEBP":
+            image.save(temp, format=encoder, quality=quality, method=4)
+        else:
+            image.save(temp, format=encoder, quality=quality, optimize=True, progressive=True)
+    os.replace(temp, target)
+    return os.path.getsize(target)
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # 弱比较：忽略 W/ 前缀
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class ImageDelivery:
+    """图片存储的 HTTP 分发：强 ETag、长期缓存头、304 协商，以及按宽度缩小的 WebP/JPEG 派生图片
+
+    派生图片在首次请求时由进程池生成并缓存在存储目录中，同一图片的并发请求只生成一次；
+    请求的宽度向上取到配置的档位，避免任意宽度产生大量缓存文件。
+    """
+
+    def __init__(
+        self,
+        store: ImageStore,
+        widths: Optional[List[int]] = None,
+        quality: Optional[int] = None,
+        workers: Optional[int] = None,
+    ):
+        self.store = store
+        if widths is None:
+            widths = [int(w) for w in os.getenv("IMAGE_VARIANT_WIDTHS", "160,320,640,1024").split(",") if w.strip()]
+        self.widths = sorted(widths)
+        self.quality = quality or int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+        self.workers = workers or int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._rendering: Dict[Path, asyncio.Future] = {}
+        self._counters = {"not_modified": 0, "originals": 0, "variants": 0, "variants_rendered": 0, "render_failures": 0}
+
+    async def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def warm_up(self):
+        """提前启动缩略图子进程"""
+        await self.start()
+        await warm_process_pool(self._executor, self.workers)
+
+    def pick_width(self, width: int) -> int:
+        """不小于请求宽度的最小档位；超过最大档位时取最大档位"""
+        for candidate in self.widths:
+            if candidate >= width:
+                return candidate
+        return self.widths[-1]
+
+    @staticmethod
+    def negotiate_format(requested: Optional[str], accept: str) -> str:
+        """未指定格式时，浏览器支持 WebP 则用 WebP，否则用 JPEG"""
+        if requested:
+            requested = requested.lower().replace("jpg", "jpeg")
+            if requested not in VARIANT_FORMATS:
+                raise ValueError(f"不支持的图片格式: {requested}，可选: {', '.join(VARIANT_FORMATS)}")
+            return requested
+        return "webp" if "image/webp" in accept else "jpeg"
+
+    async def respond(self, request: Request, name: str, width: Optional[int] = None, fmt: Optional[str] = None) -> Optional[Response]:
+        """返回图片响应；图片不存在时返回 None
+
+        Raises:
+            ValueError: 宽度或格式参数不合法
+        """
+        if width is not None and width <= 0:
+            raise ValueError("宽度必须为正整数")
+        path = self.store.path(name)
+        if path is None:
+            return None
+
+        immutable = self.store.is_content_addressed(name)
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL}
+        variant: Optional[Tuple[int, str]] = None
+        if width is not None or fmt is not None:
+            variant = (self.pick_width(width or self.widths[-1]), self.negotiate_format(fmt, request.headers.get("accept", "")))
+            if fmt is None:
+                headers["Vary"] = "Accept"
+
+        if immutable:
+            # 名称即内容哈希，无需读取文件即可得到强 ETag
+            original_tag = name.split(".")[0]
+        else:
+            stat = path.stat()
+            original_tag = f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+        tag = original_tag if variant is None else f"{original_tag}-w{variant[0]}.{variant[1]}"
+        headers["ETag"] = f'"{tag}"'
+
+        if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            self._counters["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+
+        if variant is None:
+            self._counters["originals"] += 1
+            return FileResponse(path, headers=headers)
+        variant_path = await self._variant(path, name, *variant, check_mtime=not immutable)
+        if variant_path is None:
+            # 无法生成派生图片时退回原图
+            self._counters["originals"] += 1
+            headers["ETag"] = f'"{original_tag}"'
+            return FileResponse(path, headers=headers)
+        self._counters["variants"] += 1
+        return FileResponse(variant_path, media_type=VARIANT_FORMATS[variant[1]][1], headers=headers)
+
+    async def _variant(self, source: Path, name: str, width: int, fmt: str, check_mtime: bool) -> Optional[Path]:
+        target = self.store.variant_path(name, f"w{width}.{fmt}")
+        try:
+            if target.is_file() and (not check_mtime or target.stat().st_mtime >= source.stat().st_mtime):
+                return target
+        except FileNotFoundError:
+            pass
+
+        pending = self._rendering.get(target)
+        if pending is None:
+            pending = self._rendering[target] = asyncio.ensure_future(self._render(source, target, width, fmt))
+            pending.add_done_callback(lambda _: self._rendering.pop(target, None))
+        # 等待方取消时不中断生成，其他请求仍可复用结果
+        return await asyncio.shield(pending)
+
+    async def _render(self, source: Path, target: Path, width: int, fmt: str) -> Optional[Path]:
+        await self.start()
+        loop = asyncio.get_running_loop()
+        try:
+            with track_stage("image_variant", "local"):
+                await loop.run_in_executor(
+                    self._executor, _render_variant, str(source), str(target), width, VARIANT_FORMATS[fmt][0], self.quality
+                )
+        except Exception as e:
+            self._counters["render_failures"] += 1
+            logger.warning("生成派生图片失败 %s (w%d %s): %s", source.name, width, fmt, e)
+            return None
+        self._counters["variants_rendered"] += 1
+        return target
+
+    def stats(self) -> Dict[str, int]:
+        result = dict(self._counters)
+        result["widths"] = self.widths
+        result["rendering"] = len(self._rendering)
+        return result
@@ -0,0 +1,125 @@
+import io
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Union
+
+from metrics import PREPROCESS_BYTES_SAVED, track_stage
+
+logger = logging.getLogger(__name__)
+
+
+def _preprocess(data: Union[bytes, str], max_edge: int, quality: int) -> Optional[bytes]:
+    """校正方向、缩小到 max_edge 并重新编码为 JPEG（在子进程中执行）
+
+    data 为图片内容或文件路径（传路径时只把路径发给子进程）；结果不比原图小时返回 None。
+    """
+    from PIL import Image, ImageOps
+
+    if isinstance(data, str):
+        original_size = os.path.getsize(data)
+        source = data
+    else:
+        original_size = len(data)
+        source = io.BytesIO(data)
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    result = output.getvalue()
+    # 已经足够小的图片重新编码可能反而变大
+    return result if len(result) < original_size else None
+
+
+def _load_codecs() -> int:
+    """在子进程中导入 PIL 并注册全部图片格式，返回进程号"""
+    from PIL import Image
+
+    Image.init()
+    return os.getpid()
+
+
+async def warm_process_pool(executor: ProcessPoolExecutor, workers: int) -> int:
+    """启动进程池的全部子进程并预先导入 PIL，返回就绪的子进程数
+
+    子进程在提交任务时才启动（没有空闲子进程时每次提交启动一个），因此一次提交 workers 个任务。
+    """
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(*[loop.run_in_executor(executor, _load_codecs) for _ in range(workers)])
+    return len(set(pids))
+
+
+class ImagePreprocessor:
+    """视觉推理前的图片预处理：缩放与重新编码，在进程池中执行以免阻塞事件循环"""
+
+    def __init__(
+        self,
+        max_edge: Optional[int] = None,
+        quality: Optional[int] = None,
+        workers: Optional[int] = None,
+        enabled: Optional[bool] = None,
+    ):
+        self.max_edge = max_edge or int(os.getenv("VISION_IMAGE_MAX_EDGE", "1024"))
+        self.quality = quality or int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+        self.workers = workers or int(os.getenv("VISION_PREPROCESS_WORKERS", "2"))
+        if enabled is None:
+            enabled = os.getenv("VISION_PREPROCESS", "true").lower() in ("1", "true", "yes")
+        self.enabled = enabled
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._counters = {"requests": 0, "failures": 0, "bytes_in": 0, "bytes_out": 0}
+
+    async def start(self):
+        if self.enabled and self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def warm_up(self):
+        """提前启动预处理子进程"""
+        if self.enabled:
+            await self.start()
+            await warm_process_pool(self._executor, self.workers)
+
+    async def process(self, data: bytes) -> bytes:
+        """返回预处理后的图片；无法解码时原样返回"""
+        if not self.enabled:
+            return data
+        result = await self._run(data, len(data))
+        return data if result is None else result
+
+    async def process_file(self, path: str, size: int) -> Optional[bytes]:
+        """预处理磁盘上的图片，返回缩小后的内容；未启用、失败或无法缩小时返回 None（应使用原文件）"""
+        if not self.enabled:
+            return None
+        return await self._run(path, size)
+
+    async def _run(self, source: Union[bytes, str], size: int) -> Optional[bytes]:
+        await self.start()
+        loop = asyncio.get_running_loop()
+        try:
+            with track_stage("preprocess", "local"):
+                result = await loop.run_in_executor(self._executor, _preprocess, source, self.max_edge, self.quality)
+        except Exception as e:
+            self._counters["failures"] += 1
+            logger.warning("图片预处理失败，使用原图: %s", e)
+            result = None
+        output_size = size if result is None else len(result)
+        self._counters["requests"] += 1
+        self._counters["bytes_in"] += size
+        self._counters["bytes_out"] += output_size
+        PREPROCESS_BYTES_SAVED.observe(size - output_size)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        result = dict(self._counters)
+        result["bytes_saved"] = result["bytes_in"] - result["bytes_out"]
+        result["max_edge"] = self.max_edge
+        result["enabled"] = self.enabled
+        return result
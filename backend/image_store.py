@@ -0,0 +1,289 @@
+import os
+import re
+import glob
+import time
+import uuid
+import errno
+import shutil
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from shared_state import connect
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = ".index.sqlite3"
+VARIANTS_DIR = ".variants"
+
+# 内容寻址的文件名：内容不变，可长期缓存
+CONTENT_NAME = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]+$")
+
+# 对账时只清理早于此时间（秒）的临时文件与孤立缩略图，其他 worker 可能正在写入较新的文件
+STALE_FILE_AGE = 3600
+
+
+def link_or_copy(source_path, target_path) -> bool:
+    """同一文件系统上用硬链接（不写数据），否则复制；先写临时文件再原子替换
+
+    Returns:
+        是否使用了硬链接
+    """
+    target = Path(target_path)
+    temp = target.with_name(f".tmp-{uuid.uuid4().hex}")
+    try:
+        try:
+            os.link(source_path, temp)
+            linked = True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+                raise
+            shutil.copyfile(source_path, temp)
+            linked = False
+        os.replace(temp, target)
+        return linked
+    except BaseException:
+        try:
+            temp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _unlink_if_older(entry: os.DirEntry, before: float):
+    try:
+        if entry.stat().st_mtime < before:
+            os.unlink(entry.path)
+    except FileNotFoundError:
+        pass
+
+
+def _file_hash(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageStore:
+    """生成图片的内容寻址存储
+
+    每张图片以内容哈希命名，只写入一次（与 ComfyUI 输出目录在同一文件系统时为硬链接）；
+    SQLite 索引记录大小与最近访问时间，后台清理任务按时间与字节预算淘汰最久未访问的图片，
+    正在被查看的图片不会被清掉。访问时间先记在内存中，由清理任务批量写入索引。
+    目录与索引（WAL 模式）由所有 worker 进程共用，各进程的清理任务可以同时运行。
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        sweep_interval: Optional[float] = None,
+    ):
+        self.directory = Path(directory or os.getenv("IMAGE_STORE_DIR", "static/images"))
+        self.max_bytes = max_bytes or int(os.getenv("IMAGE_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+        # 0 表示不按时间淘汰
+        self.max_age = max_age if max_age is not None else float(os.getenv("IMAGE_STORE_MAX_AGE", str(7 * 86400)))
+        self.sweep_interval = sweep_interval or float(os.getenv("IMAGE_STORE_SWEEP_INTERVAL", "60"))
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # 访问时间先记在内存中，清理时批量写入；事件循环与线程池都会写入
+        self._touched: Dict[str, float] = {}
+        self._touched_lock = threading.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._counters = {"stored": 0, "linked": 0, "deduplicated": 0, "served": 0, "evicted_age": 0, "evicted_size": 0}
+
+    async def start(self):
+        """打开索引、与磁盘上的文件对账，并启动后台清理（重复调用无副作用）"""
+        if self._sweeper and not self._sweeper.done():
+            return
+        if self._db is None:
+            await self._run(self._open)
+        self._sweeper = asyncio.create_task(self._run_sweeper())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        if self._db is not None:
+            await self._run(self._flush_access)
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    async def add(self, source_path) -> str:
+        """存入图片，返回对外的文件名（内容哈希 + 原扩展名）；相同内容只存一份"""
+        return await self._run(self._add, str(source_path))
+
+    @staticmethod
+    def is_content_addressed(name: str) -> bool:
+        return CONTENT_NAME.match(name) is not None
+
+    def variant_path(self, name: str, suffix: str) -> Path:
+        """派生图片（如缩略图）的缓存路径，原图被淘汰时一并删除"""
+        return self.directory / VARIANTS_DIR / f"{name}.{suffix}"
+
+    def path(self, name: str) -> Optional[Path]:
+        """已存储图片的路径，并记录一次访问；文件名不合法或不存在时返回 None"""
+        if not name or os.path.basename(name) != name or name.startswith("."):
+            return None
+        path = self.directory / name
+        if not path.is_file():
+            return None
+        self._touch(name, time.time())
+        self._counters["served"] += 1
+        return path
+
+    async def sweep(self) -> Dict[str, int]:
+        """写入访问时间并按时间与字节预算淘汰，返回本次淘汰的数量"""
+        return await self._run(self._sweep)
+
+    async def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = dict(self._counters)
+        if self._db is not None:
+            count, total = await self._run(self._totals)
+            result.update(images=count, bytes=total)
+        result.update(max_bytes=self.max_bytes, max_age=self.max_age)
+        return result
+
+    def _touch(self, name: str, at: float):
+        with self._touched_lock:
+            self._touched[name] = at
+
+    # ---- 以下在线程池中执行 ----
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def _open(self):
+        (self.directory / VARIANTS_DIR).mkdir(parents=True, exist_ok=True)
+        self._db = connect(str(self.directory / INDEX_NAME))
+        with self._db_lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "name TEXT PRIMARY KEY, size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)")
+            self._db.commit()
+        self._reconcile()
+
+    def _reconcile(self):
+        """索引中缺失文件的条目删除；目录中未登记的图片（含旧版本复制的文件）按 mtime 补登记"""
+        files: Dict[str, os.stat_result] = {}
+        stale_before = time.time() - STALE_FILE_AGE
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    _unlink_if_older(entry, stale_before)
+                elif not entry.name.startswith("."):
+                    files[entry.name] = entry.stat()
+        with self._db_lock:
+            known = {name for (name,) in self._db.execute("SELECT name FROM images")}
+            missing = known - files.keys()
+            self._db.executemany("DELETE FROM images WHERE name = ?", [(name,) for name in missing])
+            self._db.executemany(
+                "INSERT OR IGNORE INTO images (name, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                [(name, st.st_size, st.st_mtime, st.st_mtime) for name, st in files.items() if name not in known],
+            )
+            self._db.commit()
+        # 原图已不存在的派生图片，以及中断的派生图片临时文件
+        with os.scandir(self.directory / VARIANTS_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.rsplit(".", 2)[0] not in files:
+                    _unlink_if_older(entry, stale_before)
+        if missing or len(files) > len(known):
+            logger.info("图片存储对账: 移除 %d 条失效记录，登记 %d 个文件", len(missing), len(files.keys() - known))
+
+    def _add(self, source_path: str) -> str:
+        name = _file_hash(source_path)[:32] + (os.path.splitext(source_path)[1].lower() or ".png")
+        target = self.directory / name
+        now = time.time()
+        with self._db_lock:
+            exists = self._db.execute("SELECT 1 FROM images WHERE name = ?", (name,)).fetchone() is not None
+        if exists and target.is_file():
+            self._counters["deduplicated"] += 1
+            self._touch(name, now)
+            return name
+        if link_or_copy(source_path, target):
+            self._counters["linked"] += 1
+        self._counters["stored"] += 1
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO images (name, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (name, target.stat().st_size, now, now),
+            )
+            self._db.commit()
+        return name
+
+    def _totals(self) -> Tuple[int, int]:
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+
+    def _flush_access(self):
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        with self._db_lock:
+            self._db.executemany(
+                "UPDATE images SET last_access = MAX(last_access, ?) WHERE name = ?",
+                [(at, name) for name, at in touched.items()],
+            )
+            self._db.commit()
+
+    def _sweep(self) -> Dict[str, int]:
+        self._flush_access()
+        expired: List[Tuple[str, int]] = []
+        over_budget: List[Tuple[str, int]] = []
+        with self._db_lock:
+            if self.max_age > 0:
+                expired = self._db.execute(
+                    "SELECT name, size FROM images WHERE last_access < ?", (time.time() - self.max_age,)
+                ).fetchall()
+            (total,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()
+            total -= sum(size for _, size in expired)
+            if total > self.max_bytes:
+                skip = {name for name, _ in expired}
+                for name, size in self._db.execute("SELECT name, size FROM images ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    if name in skip:
+                        continue
+                    over_budget.append((name, size))
+                    total -= size
+            victims = expired + over_budget
+            self._db.executemany("DELETE FROM images WHERE name = ?", [(name,) for name, _ in victims])
+            self._db.commit()
+        for name, _ in victims:
+            pattern = str(self.directory / VARIANTS_DIR / (glob.escape(name) + ".*"))
+            for path in [self.directory / name] + [Path(p) for p in glob.glob(pattern)]:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        self._counters["evicted_age"] += len(expired)
+        self._counters["evicted_size"] += len(over_budget)
+        if victims:
+            logger.info("图片存储清理: 过期 %d 张，超出容量 %d 张", len(expired), len(over_budget))
+        return {"expired": len(expired), "over_budget": len(over_budget)}
+
+    async def _run_sweeper(self):
+        while True:
+            try:
+                await self.sweep()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("图片存储清理失败: %s", e)
+            await asyncio.sleep(self.sweep_interval)
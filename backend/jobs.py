@@ -0,0 +1,469 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from admission import FairQueue
+from metrics import record_stage
+from logging_config import request_id_var
+from shared_state import connect, shared_path, worker_id
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = {SUCCEEDED, FAILED, CANCELLED}
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class JobQueueFull(Exception):
+    """任务队列已满，调用方应返回 429"""
+
+
+class Job:
+    """一次异步生成任务"""
+    def __init__(self, params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = QUEUED
+        self.progress: Optional[Dict[str, int]] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # 提交任务的请求ID，执行时沿用，便于关联日志
+        self.request_id = request_id_var.get()
+        self._task: Optional[asyncio.Task] = None
+        self._subscribers: List["asyncio.Queue[Dict[str, Any]]"] = []
+        self._done = asyncio.Event()
+        # 由 JobQueue 设置，用于把状态变化写入共享存储
+        self._on_publish: Optional[Callable[["Job", str], None]] = None
+        self._persisted_at = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        self.updated_at = time.time()
+        for queue in self._subscribers:
+            queue.put_nowait({"event": event, "data": data})
+        if self._on_publish is not None:
+            self._on_publish(self, event)
+
+    def on_comfy_event(self, event: Dict[str, Any]):
+        """把 ComfyUI 的采样进度转发给订阅者"""
+        if event.get("type") != "progress":
+            return
+        data = event.get("data", {})
+        self.progress = {"value": data.get("value", 0), "max": data.get("max", 0)}
+        self.publish("progress", self.progress)
+
+
+class JobStore:
+    """任务状态的共享存储（SQLite，WAL 模式），同一目录下的所有 worker 进程共用
+
+    任务只在提交它的 worker 中执行，其他 worker 从这里读取状态；
+    其他 worker 收到的取消请求记为 cancel_requested，由所属 worker 定期取走并执行。
+    各 worker 定期写入心跳，心跳超时的 worker 留下的未完成任务标记为失败。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    # ---- 以下为同步调用，由 JobQueue 在单独的线程中执行 ----
+
+    def open(self):
+        self._db = connect(self.path)
+        with self._lock:
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL, params TEXT NOT NULL, "
+                "progress TEXT, result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0);"
+                "CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, status);"
+                "CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (status, updated_at);"
+                "CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL);"
+            )
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+            self._db = None
+
+    def save(self, job: Dict[str, Any], params: Dict[str, Any], owner: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, owner, status, params, progress, result, error, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET status = excluded.status, "
+                "progress = excluded.progress, result = excluded.result, error = excluded.error, "
+                "updated_at = excluded.updated_at",
+                (job["job_id"], owner, job["status"], json.dumps(params, ensure_ascii=False),
+                 json.dumps(job["progress"]), json.dumps(job["result"], ensure_ascii=False), job["error"],
+                 job["created_at"], job["updated_at"]),
+            )
+            self._db.commit()
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """与 Job.as_dict 格式相同；任务不存在时返回 None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, progress, result, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "status": row[1],
+            "progress": json.loads(row[2]) if row[2] else None,
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+            "created_at": row[5],
+            "updated_at": row[6],
+        }
+
+    def request_cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN (?, ?)", (job_id, *ACTIVE_STATES)
+            )
+            self._db.commit()
+        return self.load(job_id)
+
+    def take_cancel_requests(self, owner: str) -> List[str]:
+        with self._lock:
+            ids = [job_id for (job_id,) in self._db.execute(
+                "SELECT id FROM jobs WHERE owner = ? AND cancel_requested = 1", (owner,)
+            )]
+            if ids:
+                self._db.executemany("UPDATE jobs SET cancel_requested = 0 WHERE id = ?", [(job_id,) for job_id in ids])
+                self._db.commit()
+        return ids
+
+    def heartbeat(self, owner: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO workers (id, heartbeat_at) VALUES (?, ?)", (owner, time.time())
+            )
+            self._db.commit()
+
+    def fail_orphans(self, stale_before: float) -> int:
+        """心跳早于 stale_before 的 worker 已退出：其未完成的任务标记为失败，返回任务数"""
+        with self._lock:
+            self._db.execute("DELETE FROM workers WHERE heartbeat_at < ?", (stale_before,))
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? "
+                "WHERE status IN (?, ?) AND owner NOT IN (SELECT id FROM workers)",
+                (FAILED, "执行任务的 worker 已退出", time.time(), *ACTIVE_STATES),
+            )
+            self._db.commit()
+        return cursor.rowcount
+
+    def release(self, owner: str):
+        """worker 关闭：其未完成的任务标记为失败，并删除心跳"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE owner = ? AND status IN (?, ?)",
+                (FAILED, "worker 已关闭，任务未完成", time.time(), owner, *ACTIVE_STATES),
+            )
+            self._db.execute("DELETE FROM workers WHERE id = ?", (owner,))
+            self._db.commit()
+
+    def trim(self, keep: int):
+        """只保留最近 keep 个已结束的任务"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?, ?) AND id NOT IN "
+                "(SELECT id FROM jobs WHERE status IN (?, ?, ?) ORDER BY updated_at DESC LIMIT ?)",
+                (*FINISHED_STATES, *FINISHED_STATES, keep),
+            )
+            self._db.commit()
+
+
+class JobQueue:
+    """有界的进程内任务队列
+
+    submit 立即返回任务，队列满时抛出 JobQueueFull（上限按 worker 进程计算）；
+    参数中带有 client 的任务按客户端轮流出队，单个客户端排队的任务数不超过 max_per_client；
+    固定数量的 worker 从队列中取任务执行，已结束的任务保留最近 history_size 个供查询。
+    启用共享存储（JOB_STORE_DB，默认在 SHARED_STATE_DIR 下）时，任务状态同步写入其中，
+    多个 worker 进程中任一个都可以查询、订阅和取消任务。
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[Job], Awaitable[Any]],
+        max_pending: Optional[int] = None,
+        workers: Optional[int] = None,
+        max_per_client: Optional[int] = None,
+        history_size: Optional[int] = None,
+        store_path: Optional[str] = None,
+        sync_interval: Optional[float] = None,
+    ):
+        """
+        Args:
+            store_path: 共享存储路径，默认读取 JOB_STORE_DB；空字符串表示只在进程内保存任务
+            sync_interval: 心跳、取消请求与远程订阅的轮询间隔（秒），默认读取 JOB_SYNC_INTERVAL
+        """
+        self.runner = runner
+        self.max_pending = max_pending or int(os.getenv("JOB_QUEUE_MAX_PENDING", "32"))
+        self.workers = workers or int(os.getenv("JOB_WORKERS", "8"))
+        self.max_per_client = max_per_client if max_per_client is not None else int(os.getenv("JOB_QUEUE_MAX_PER_CLIENT", "8"))
+        self.history_size = history_size or int(os.getenv("JOB_HISTORY_SIZE", "256"))
+        self.sync_interval = sync_interval or float(os.getenv("JOB_SYNC_INTERVAL", "0.5"))
+        # 超过该时间没有心跳的 worker 视为已退出
+        self.worker_timeout = float(os.getenv("JOB_WORKER_TIMEOUT", "10"))
+        if store_path is None:
+            store_path = os.getenv("JOB_STORE_DB", shared_path("jobs.sqlite3"))
+        self._store = JobStore(store_path) if store_path else None
+        self._store_executor: Optional[ThreadPoolExecutor] = None
+        self._queue: Optional[FairQueue] = None
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+        self._counters = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0, "cancelled": 0}
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = FairQueue(self.max_pending, key=lambda job: job.params.get("client"), max_per_key=self.max_per_client)
+        if self._store is not None:
+            # 写入在单个线程中按提交顺序执行，不阻塞事件循环
+            self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+            await self._run_store(self._store.open)
+            await self._run_store(self._store.heartbeat, worker_id())
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        if self._store is not None:
+            self._tasks.append(asyncio.create_task(self._sync()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._store_executor is not None:
+            try:
+                await self._run_store(self._store.release, worker_id())
+            except sqlite3.Error as e:
+                logger.warning("释放共享任务状态失败: %s", e)
+            await self._run_store(self._store.close)
+            self._store_executor.shutdown(wait=False)
+            self._store_executor = None
+
+    def submit(self, params: Dict[str, Any]) -> Job:
+        """提交任务，队列满时抛出 JobQueueFull"""
+        if self._queue is None:
+            raise RuntimeError("任务队列未启动")
+        job = Job(params)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._counters["rejected"] += 1
+            if self._queue.full():
+                raise JobQueueFull("生成任务过多，请稍后重试")
+            raise JobQueueFull("排队中的生成任务过多，请等待已提交的任务完成")
+        self._counters["submitted"] += 1
+        self._jobs[job.id] = job
+        if self._store_executor is not None:
+            job._on_publish = self._published
+            self._persist(job)
+        self._trim()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """本 worker 中的任务"""
+        return self._jobs.get(job_id)
+
+    async def snapshot(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务状态：本 worker 的任务直接读取，其他 worker 的任务从共享存储读取"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.as_dict()
+        if self._store_executor is None:
+            return None
+        return await self._run_store(self._store.load, job_id)
+
+    async def request_cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取消其他 worker 上的任务：写入取消请求，由所属 worker 在下一个同步周期执行
+
+        Returns:
+            任务当前状态；任务不存在时返回 None
+        """
+        if self._store_executor is None:
+            return None
+        return await self._run_store(self._store.request_cancel, job_id)
+
+    def cancel(self, job: Job) -> bool:
+        """取消任务：排队中的直接标记为已取消，执行中的取消其协程（由下游负责释放 ComfyUI 资源）
+
+        Returns:
+            任务是否仍在进行、已被取消
+        """
+        if job.finished:
+            return False
+        if job._task is not None:
+            job._task.cancel()
+            return True
+        # 仍在队列中：worker 取到时会跳过
+        self._finish_cancelled(job)
+        return True
+
+    async def wait(self, job: Job) -> Any:
+        """等待任务结束，失败或被取消时抛出异常"""
+        await job._done.wait()
+        if job.status in (FAILED, CANCELLED):
+            raise Exception(job.error)
+        return job.result
+
+    async def events(self, job: Job) -> AsyncIterator[Dict[str, Any]]:
+        """订阅任务事件：先发送当前状态，之后依次推送直到任务结束"""
+        queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        job._subscribers.append(queue)
+        try:
+            yield {"event": "status", "data": job.as_dict()}
+            while not job.finished:
+                yield await queue.get()
+            # 结束前的剩余事件
+            while not queue.empty():
+                yield queue.get_nowait()
+        finally:
+            job._subscribers.remove(queue)
+
+    async def remote_events(self, job_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """订阅其他 worker 上的任务：轮询共享存储，状态或进度变化时推送（格式同 events），直到任务结束"""
+        last: Optional[Dict[str, Any]] = None
+        while True:
+            data = await self.snapshot(job_id)
+            if data is None:
+                return
+            if last is None or data["status"] != last["status"]:
+                yield {"event": "status", "data": data}
+            elif data["progress"] != last["progress"]:
+                yield {"event": "progress", "data": data["progress"]}
+            if data["status"] in FINISHED_STATES:
+                return
+            last = data
+            await asyncio.sleep(self.sync_interval)
+
+    def stats(self) -> Dict[str, int]:
+        result = dict(self._counters)
+        result["pending"] = self._queue.qsize() if self._queue else 0
+        result["max_pending"] = self.max_pending
+        result["max_per_client"] = self.max_per_client
+        result["running"] = sum(1 for job in self._jobs.values() if job.status == RUNNING)
+        result["shared_store"] = self._store.path if self._store is not None else None
+        return result
+
+    async def _run_store(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._store_executor, func, *args)
+
+    def _persist(self, job: Job):
+        """把任务状态写入共享存储（不等待写入完成）"""
+        job._persisted_at = time.monotonic()
+        future = self._store_executor.submit(self._store.save, job.as_dict(), job.params, worker_id())
+        future.add_done_callback(_log_store_error)
+
+    def _published(self, job: Job, event: str):
+        # 采样进度每步都会推送，每个同步周期最多写入一次；状态变化总是写入
+        if event == "progress" and time.monotonic() - job._persisted_at < self.sync_interval:
+            return
+        if self._store_executor is not None:
+            self._persist(job)
+
+    async def _sync(self):
+        """定期写入心跳、执行其他 worker 转来的取消请求，并把已退出的 worker 留下的任务标记为失败"""
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                me = worker_id()
+                await self._run_store(self._store.heartbeat, me)
+                for job_id in await self._run_store(self._store.take_cancel_requests, me):
+                    job = self._jobs.get(job_id)
+                    if job is not None and self.cancel(job):
+                        logger.info("Job %s cancelled by another worker", job_id)
+                orphaned = await self._run_store(self._store.fail_orphans, time.time() - self.worker_timeout)
+                if orphaned:
+                    logger.warning("%d 个任务所属的 worker 已退出，标记为失败", orphaned)
+                await self._run_store(self._store.trim, self.history_size)
+            except sqlite3.Error as e:
+                logger.warning("任务状态同步失败: %s", e)
+
+    def _finish_cancelled(self, job: Job):
+        job.status = CANCELLED
+        job.error = "任务已取消"
+        self._counters["cancelled"] += 1
+        job.publish("status", job.as_dict())
+        job._done.set()
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            if job.finished:
+                # 排队期间已被取消
+                record_stage("job_queue_wait", "jobs", time.time() - job.created_at, "cancelled")
+                self._queue.task_done()
+                continue
+            record_stage("job_queue_wait", "jobs", time.time() - job.created_at)
+            request_id_var.set(job.request_id)
+            job.status = RUNNING
+            job.publish("status", job.as_dict())
+            # 任务在独立的 Task 中执行，cancel() 只取消该任务，不影响 worker
+            job._task = asyncio.ensure_future(self.runner(job))
+            try:
+                job.result = await job._task
+                job.status = SUCCEEDED
+                self._counters["succeeded"] += 1
+            except asyncio.CancelledError:
+                if not job._task.cancelled():
+                    # worker 自身被取消（关闭队列）
+                    job._task.cancel()
+                    job.status = FAILED
+                    job.error = "任务已取消"
+                    raise
+                job.status = CANCELLED
+                job.error = "任务已取消"
+                self._counters["cancelled"] += 1
+            except Exception as e:
+                job.status = FAILED
+                job.error = str(e)
+                self._counters["failed"] += 1
+            finally:
+                job._task = None
+                job.publish("status", job.as_dict())
+                job._done.set()
+                self._queue.task_done()
+
+    def _trim(self):
+        """只保留最近的已结束任务"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.history_size, 0)]:
+            del self._jobs[job_id]
+
+
+def _log_store_error(future: Future):
+    if future.exception() is not None:
+        logger.warning("写入共享任务状态失败: %s", future.exception())
@@ -1,18 +1,38 @@
 from abc import ABC, abstractmethod
 import os
-import requests
 import base64
-from PIL import Image
 import io
-import openai
 import asyncio
-from typing import Optional, Union
-from tenacity import retry, stop_after_attempt, wait_exponential
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import time
+from typing import AsyncIterator, Dict, List, Optional, Union
+from http_client import http_clients, iter_ndjson
+from metrics import TIME_TO_FIRST_TOKEN, track_stage
+from ollama_models import ollama_models
 
-import google.generativeai as genai
+# 厂商SDK（openai、google.generativeai、PIL）导入耗时较长，在处理器首次创建时才导入
+
+# 仅提供同步接口的厂商SDK在有界线程池中执行，避免阻塞事件循环；
+# 首次使用时创建（LLM_BLOCKING_WORKERS 可能来自导入本模块之后才加载的 .env）
+_blocking_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _blocking_executor
+    if _blocking_executor is None:
+        _blocking_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("LLM_BLOCKING_WORKERS", "8")),
+            thread_name_prefix="llm-blocking"
+        )
+    return _blocking_executor
 
 class LLMHandler(ABC):
     """大语言模型处理器的抽象基类"""
+    def __init__(self):
+        # 单次调用超时（秒）；流式输出时为相邻两段之间的最长间隔
+        self.timeout = float(os.getenv("LLM_TIMEOUT", "30"))
+
     @abstractmethod
     async def generate_description(self, image_data: Optional[str], prompt: str) -> str:
         """生成图片或文本描述
@@ -24,79 +44,193 @@ class LLMHandler(ABC):
         """
         pass
 
-    async def _handle_timeout(self, coroutine, timeout: int = 30):
+    async def generate_description_stream(self, image_data: Optional[str], prompt: str) -> AsyncIterator[str]:
+        """流式生成描述，逐段产出文本；默认实现一次性产出完整结果"""
+        yield await self.generate_description(image_data, prompt)
+
+    # 指标中的后端名称
+    backend_name = "llm"
+
+    # 创建时不导入SDK、开销很小的处理器，由 LLMProviderManager 立即创建（而不是首次使用时）
+    eager = False
+
+    async def _handle_timeout(self, coroutine, timeout: Optional[float] = None):
         """处理超时的通用方法"""
         try:
-            return await asyncio.wait_for(coroutine, timeout=timeout)
+            with track_stage("llm_generate", self.backend_name):
+                return await asyncio.wait_for(coroutine, timeout=timeout or self.timeout)
         except asyncio.TimeoutError:
             raise Exception("请求超时")
 
+    @staticmethod
+    async def _run_blocking(func, *args, **kwargs):
+        """在有界线程池中执行同步调用"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor(), partial(func, *args, **kwargs))
+
+    @staticmethod
+    async def _iterate_blocking(func, *args) -> AsyncIterator:
+        """在线程池中消费同步迭代器，逐项转交给事件循环"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        end = object()
+
+        def produce():
+            try:
+                for item in func(*args):
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, end)
+
+        loop.run_in_executor(_executor(), produce)
+        while True:
+            item = await queue.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def _stream_with_timeout(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        """为每一段输出施加超时，并记录首个 token 延迟"""
+        started = time.perf_counter()
+        first = True
+        iterator = chunks.__aiter__()
+        with track_stage("llm_stream", self.backend_name):
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=self.timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise Exception("请求超时")
+                if not chunk:
+                    continue
+                if first:
+                    TIME_TO_FIRST_TOKEN.labels(backend=self.backend_name).observe(time.perf_counter() - started)
+                    first = False
+                yield chunk
+
 class OllamaHandler(LLMHandler):
     """本地Ollama模型处理器"""
+    backend_name = "ollama"
+    # 立即创建，使模型在启动时随视觉模型一起预载入
+    eager = True
+
     def __init__(self):
+        super().__init__()
         self.api_endpoint = os.getenv("OLLAMA_API_ENDPOINT")
         self.model = os.getenv("OLLAMA_MODEL", "phi4")
+        # 与 VisionModelHandler 共用模型的预载入、保活与并发上限
+        self.ollama = ollama_models.register(self.api_endpoint, self.model) if self.api_endpoint else None
+
+    def _slot(self):
+        if self.ollama is None:
+            raise Exception("未配置 OLLAMA_API_ENDPOINT")
+        return ollama_models.slot(self.ollama)
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def generate_description(self, image_data: Optional[str], prompt: str) -> str:
         async def _generate():
             headers = {"Content-Type": "application/json"}
-            payload = {
+            payload = ollama_models.with_keep_alive({
                 "model": self.model,
                 "prompt": prompt,
                 "stream": False
-            }
+            })
 
             if image_data:
                 payload["image"] = image_data
 
             try:
-                response = requests.post(
-                    self.api_endpoint,
-                    headers=headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                return response.json().get("response", "")
+                async with self._slot():
+                    async with http_clients.session(self.api_endpoint).post(
+                        self.api_endpoint,
+                        headers=headers,
+                        json=payload
+                    ) as response:
+                        response.raise_for_status()
+                        result = await response.json()
+                        return result.get("response", "")
             except Exception as e:
                 raise Exception(f"Ollama API错误: {str(e)}")
         
         return await self._handle_timeout(_generate())
 
+    async def generate_description_stream(self, image_data: Optional[str], prompt: str) -> AsyncIterator[str]:
+        """使用 Ollama 的 NDJSON 流式输出"""
+        async def _chunks():
+            payload = ollama_models.with_keep_alive({
+                "model": self.model,
+                "prompt": prompt,
+                "stream": True
+            })
+            if image_data:
+                payload["image"] = image_data
+
+            async with self._slot():
+                async with http_clients.session(self.api_endpoint).post(
+                    self.api_endpoint,
+                    headers={"Content-Type": "application/json"},
+                    json=payload
+                ) as response:
+                    response.raise_for_status()
+                    async for chunk in iter_ndjson(response):
+                        if chunk.get("error"):
+                            raise Exception(chunk["error"])
+                        yield chunk.get("response", "")
+                        if chunk.get("done"):
+                            break
+
+        try:
+            async for text in self._stream_with_timeout(_chunks()):
+                yield text
+        except Exception as e:
+            raise Exception(f"Ollama API错误: {str(e)}")
+
 class OpenAIHandler(LLMHandler):
     """OpenAI API处理器"""
+    backend_name = "openai"
+
     def __init__(self):
-        openai.api_base = os.getenv("OPENAI_API_ENDPOINT")
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        self.model = "gpt-4-vision-preview"
+        super().__init__()
+        import openai
+
+        self.client = openai.AsyncOpenAI(
+            base_url=os.getenv("OPENAI_API_ENDPOINT") or None,
+            api_key=os.getenv("OPENAI_API_KEY"),
+            # 失败切换与熔断由 LLMProviderManager 负责，SDK 不再退避重试
+            max_retries=0
+        )
+        self.model = os.getenv("OPENAI_MODEL", "gpt-4-vision-preview")
+
+    @staticmethod
+    def _build_messages(image_data: Optional[str], prompt: str) -> list:
+        if image_data:
+            return [{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_data}"
+                        }
+                    }
+                ]
+            }]
+        return [{
+            "role": "user",
+            "content": prompt
+        }]
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def generate_description(self, image_data: Optional[str], prompt: str) -> str:
         async def _generate():
             try:
-                messages = []
-                if image_data:
-                    messages.append({
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_data}"
-                                }
-                            }
-                        ]
-                    })
-                else:
-                    messages.append({
-                        "role": "user",
-                        "content": prompt
-                    })
-
-                response = await openai.chat.completions.create(
+                response = await self.client.chat.completions.create(
                     model=self.model,
-                    messages=messages,
+                    messages=self._build_messages(image_data, prompt),
                     max_tokens=300
                 )
                 return response.choices[0].message.content
@@ -105,29 +239,66 @@ class OpenAIHandler(LLMHandler):
         
         return await self._handle_timeout(_generate())
 
+    async def generate_description_stream(self, image_data: Optional[str], prompt: str) -> AsyncIterator[str]:
+        async def _chunks():
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(image_data, prompt),
+                max_tokens=300,
+                stream=True
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        try:
+            async for text in self._stream_with_timeout(_chunks()):
+                yield text
+        except Exception as e:
+            raise Exception(f"OpenAI API错误: {str(e)}")
+
 class GeminiHandler(LLMHandler):
     """Google Gemini API处理器"""
+    backend_name = "gemini"
+
     def __init__(self):
+        super().__init__()
         api_key = os.getenv("GEMINI_API_KEY")
         api_endpoint = os.getenv("GEMINI_API_ENDPOINT")
         if not api_key:
             raise ValueError("未找到GEMINI_API_KEY")
+        import google.generativeai as genai
+
         genai.configure(api_key=api_key)
         self.vision_model = genai.GenerativeModel('gemini-pro-vision')
         self.text_model = genai.GenerativeModel('gemini-pro')
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    def _generate_with_image(self, image_data: str, prompt: str, stream: bool = False):
+        """同步调用，需在线程池中执行"""
+        from PIL import Image
+
+        image_bytes = base64.b64decode(image_data)
+        image = Image.open(io.BytesIO(image_bytes))
+        return self.vision_model.generate_content([prompt, image], stream=stream)
+
+    def _stream_texts(self, image_data: Optional[str], prompt: str):
+        """同步的流式生成器，需在线程池中消费"""
+        if image_data:
+            response = self._generate_with_image(image_data, prompt, stream=True)
+        else:
+            response = self.text_model.generate_content(prompt, stream=True)
+        for chunk in response:
+            yield chunk.text
+
     async def generate_description(self, image_data: Optional[str], prompt: str) -> str:
         async def _generate():
             try:
                 if image_data:
-                    # 处理图片输入
-                    image_bytes = base64.b64decode(image_data)
-                    image = Image.open(io.BytesIO(image_bytes))
-                    response = self.vision_model.generate_content([prompt, image])
+                    # 处理图片输入（解码与请求都在线程池中完成）
+                    response = await self._run_blocking(self._generate_with_image, image_data, prompt)
                 else:
                     # 处理纯文本输入
-                    response = self.text_model.generate_content(prompt)
+                    response = await self._run_blocking(self.text_model.generate_content, prompt)
 
                 if response.prompt_feedback.block_reason:
                     raise Exception(f"内容被阻止: {response.prompt_feedback.block_reason}")
@@ -138,18 +309,38 @@ class GeminiHandler(LLMHandler):
         
         return await self._handle_timeout(_generate())
 
+    async def generate_description_stream(self, image_data: Optional[str], prompt: str) -> AsyncIterator[str]:
+        try:
+            async for text in self._stream_with_timeout(self._iterate_blocking(self._stream_texts, image_data, prompt)):
+                yield text
+        except Exception as e:
+            raise Exception(f"Gemini API错误: {str(e)}")
+
 class LLMFactory:
-    """LLM处理器工厂类"""
+    """LLM处理器工厂类
+
+    处理器在首次使用时创建（同时导入对应的SDK）并在进程内复用（SDK 客户端与模型对象只初始化一次）。
+    失败切换、熔断与对冲请求见 llm_providers.LLMProviderManager。
+    """
     _handlers = {
         'olama': OllamaHandler,
         'openai': OpenAIHandler,
         'gemini': GeminiHandler
     }
+    _instances: Dict[str, LLMHandler] = {}
 
     @classmethod
-    def get_handler(cls, model_type: str) -> LLMHandler:
+    def supported(cls) -> List[str]:
+        return list(cls._handlers.keys())
+
+    @classmethod
+    def handler_class(cls, model_type: str) -> Optional[type]:
+        return cls._handlers.get(model_type.lower())
+
+    @classmethod
+    def create_handler(cls, model_type: str) -> LLMHandler:
         """
-        获取指定类型的LLM处理器实例
+        创建指定类型的LLM处理器新实例
         
         Args:
             model_type: 模型类型 ('olama', 'openai', 'gemini')
@@ -169,16 +360,11 @@ class LLMFactory:
         
         return handler_class()
 
-# 使用示例
-if __name__ == "__main__":
-    
-    async def test():
-        # 测试纯文本生成
-        handler = LLMFactory.get_handler('olama')
-        description = await handler.generate_description(
-            None, 
-            "描述一个美丽的春天场景"
-        )
-        print(f"生成的描述: {description}")
-    
-    asyncio.run(test())
\ No newline at end of file
+    @classmethod
+    def get_handler(cls, model_type: str) -> LLMHandler:
+        """获取指定类型的LLM处理器（共享实例，参数与异常同 create_handler）"""
+        key = model_type.lower()
+        handler = cls._instances.get(key)
+        if handler is None:
+            handler = cls._instances[key] = cls.create_handler(key)
+        return handler
@@ -0,0 +1,317 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from llm_handlers import LLMFactory, LLMHandler
+from metrics import LLM_CIRCUIT_STATE, LLM_HEDGED_REQUESTS, LLM_PROVIDER_CALLS
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 图片分析时由视觉模型处理器承担的服务（Ollama 上的视觉模型）
+VISION_PROVIDER = "olama"
+# 前端传入的模型类型与 LLMFactory 类型名不一致的写法
+PROVIDER_ALIASES = {"ollama": "olama"}
+
+
+class CircuitBreaker:
+    """单个服务的熔断器
+
+    连续失败达到阈值后熔断（open），期间直接跳过该服务；
+    reset_timeout 秒后放行一个试探请求（half_open），成功则恢复，失败则继续熔断。
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        LLM_CIRCUIT_STATE.labels(provider=name).set(0)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.info("LLM服务 %s 熔断状态: %s -> %s", self.name, self.state, state)
+            self.state = state
+            LLM_CIRCUIT_STATE.labels(provider=self.name).set(_STATE_VALUES[state])
+
+    def acquire(self) -> bool:
+        """是否允许发起请求；允许时调用方必须以 record_success / record_failure / release 结束"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self._trial_in_flight = False
+        self.failures = 0
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self._trial_in_flight = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning("LLM服务 %s 连续失败 %d 次，暂停 %.0f 秒", self.name, self.failures, self.reset_timeout)
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self):
+        """请求被取消（如对冲中落败），不计成功也不计失败"""
+        self._trial_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures}
+
+
+class LLMProviderManager:
+    """按优先级使用多个 LLM 服务：共享处理器实例、失败切换、熔断与对冲请求
+
+    - 按 providers 顺序尝试，失败时立即切换到下一个（不做退避重试）
+    - 每个服务一个熔断器，熔断中的服务直接跳过
+    - hedge_delay > 0 时，首个请求超过该时间未返回就并行请求下一个服务，采用先返回的结果
+    - 图片分析（analyze_image）中 "olama" 使用视觉模型处理器（描述缓存、图片预处理与 Ollama 并发上限），
+      其他服务收到预处理后的 base64 图片
+    """
+
+    def __init__(
+        self,
+        providers: Optional[List[str]] = None,
+        hedge_delay: Optional[float] = None,
+        failure_threshold: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+        handlers: Optional[Dict[str, LLMHandler]] = None,
+        vision=None,
+    ):
+        """
+        Args:
+            providers: 服务优先级，默认读取 LLM_PROVIDERS（逗号分隔的 LLMFactory 类型名）
+            hedge_delay: 对冲延迟（秒），默认读取 LLM_HEDGE_DELAY_MS，0 表示不对冲
+            handlers: 预先创建的处理器（如指向替身服务）；未提供的由 LLMFactory 按需创建
+            vision: 图片分析使用的 VisionModelHandler
+        """
+        if providers is None:
+            providers = [p.strip() for p in os.getenv("LLM_PROVIDERS", "olama").split(",") if p.strip()]
+        unsupported = [p for p in providers if p.lower() not in LLMFactory.supported() and p not in (handlers or {})]
+        if unsupported:
+            raise ValueError(f"不支持的模型类型: {', '.join(unsupported)}。支持的模型类型有: {', '.join(LLMFactory.supported())}")
+        self.providers = providers
+        self.hedge_delay = hedge_delay if hedge_delay is not None else float(os.getenv("LLM_HEDGE_DELAY_MS", "0")) / 1000
+        threshold = failure_threshold or int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+        reset = reset_timeout or float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+        self.breakers = {name: CircuitBreaker(name, threshold, reset) for name in providers}
+        self._handlers: Dict[str, LLMHandler] = dict(handlers or {})
+        self.vision = vision
+        for name in providers:
+            handler_class = LLMFactory.handler_class(name)
+            if name not in self._handlers and handler_class is not None and handler_class.eager:
+                self.handler(name)
+
+    def handler(self, name: str) -> LLMHandler:
+        handler = self._handlers.get(name)
+        if handler is None:
+            handler = self._handlers[name] = LLMFactory.get_handler(name)
+        return handler
+
+    async def warm_up(self):
+        """提前创建全部服务的处理器
+
+        处理器创建时才导入对应的SDK（openai 等导入需要数百毫秒），放在线程中执行，
+        避免首个使用该服务的请求阻塞事件循环。无法创建的服务只记录警告。
+        """
+        loop = asyncio.get_running_loop()
+        for name in self.providers:
+            try:
+                await loop.run_in_executor(None, self.handler, name)
+            except Exception as e:
+                logger.warning("LLM服务 %s 预热失败: %s", name, e)
+
+    def resolve(self, model_type: Optional[str]) -> Optional[str]:
+        """请求中的模型类型对应的已配置服务；未指定或未配置时返回 None（按配置顺序）"""
+        if not model_type:
+            return None
+        name = PROVIDER_ALIASES.get(model_type.lower(), model_type.lower())
+        if name not in self.breakers:
+            logger.debug("模型类型 %s 未配置，按配置顺序使用LLM服务", model_type)
+            return None
+        return name
+
+    def _order(self, provider: Optional[str]) -> List[str]:
+        """指定的服务优先，其余按配置顺序作为备用"""
+        if provider is None:
+            return list(self.providers)
+        if provider not in self.breakers:
+            raise ValueError(f"未配置的LLM服务: {provider}。已配置: {', '.join(self.providers)}")
+        return [provider] + [name for name in self.providers if name != provider]
+
+    def _candidates(self, provider: Optional[str], errors: List[str]) -> Iterator[tuple]:
+        """逐个产出允许请求的 (服务名, 处理器)；熔断中或无法创建的服务被跳过"""
+        for name in self._order(provider):
+            breaker = self.breakers[name]
+            if not breaker.acquire():
+                LLM_PROVIDER_CALLS.labels(provider=name, outcome="rejected").inc()
+                errors.append(f"{name}: 熔断中")
+                continue
+            try:
+                handler = self.handler(name)
+            except Exception as e:
+                breaker.record_failure()
+                LLM_PROVIDER_CALLS.labels(provider=name, outcome="error").inc()
+                errors.append(f"{name}: {e}")
+                continue
+            yield name, handler
+
+    async def _attempt(self, name: str, coroutine) -> Any:
+        """执行一次请求，并把结果记入熔断器与指标"""
+        breaker = self.breakers[name]
+        try:
+            result = await coroutine
+        except asyncio.CancelledError:
+            breaker.release()
+            LLM_PROVIDER_CALLS.labels(provider=name, outcome="cancelled").inc()
+            raise
+        except Exception as e:
+            breaker.record_failure()
+            LLM_PROVIDER_CALLS.labels(provider=name, outcome="error").inc()
+            logger.warning("LLM服务 %s 请求失败: %s", name, e)
+            raise
+        breaker.record_success()
+        LLM_PROVIDER_CALLS.labels(provider=name, outcome="success").inc()
+        return result
+
+    async def _race(self, call: Callable[[str, LLMHandler], Any], provider: Optional[str]) -> Any:
+        errors: List[str] = []
+        candidates = self._candidates(provider, errors)
+        pending: Dict[asyncio.Task, str] = {}
+        launched: List[str] = []
+
+        def launch() -> bool:
+            for name, handler in candidates:
+                pending[asyncio.ensure_future(self._attempt(name, call(name, handler)))] = name
+                launched.append(name)
+                return True
+            return False
+
+        launch()
+        hedged = False
+        hedge: Optional[str] = None
+        try:
+            while pending:
+                # 只对冲一次：之后的并行请求只来自失败切换
+                timeout = self.hedge_delay if self.hedge_delay > 0 and not hedged else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 没有可对冲的服务时继续等待
+                    hedged = True
+                    if launch():
+                        hedge = launched[-1]
+                        logger.debug("LLM服务 %s 超过 %.0f ms 未返回，对冲请求 %s", launched[0], self.hedge_delay * 1000, hedge)
+                    continue
+                succeeded = None
+                for task in done:
+                    name = pending.pop(task)
+                    if task.exception() is not None:
+                        errors.append(f"{name}: {task.exception()}")
+                    elif succeeded is None:
+                        succeeded = (name, task.result())
+                if succeeded is not None:
+                    if hedge is not None:
+                        LLM_HEDGED_REQUESTS.labels(winner="hedge" if succeeded[0] == hedge else "primary").inc()
+                    return succeeded[1]
+                if not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise Exception(f"没有可用的LLM服务（{'; '.join(errors) or '未配置服务'}）")
+
+    async def generate_description(self, image_data: Optional[str], prompt: str, provider: Optional[str] = None) -> str:
+        """生成描述；provider 指定优先使用的服务，其余服务作为备用"""
+        return await self._race(lambda name, handler: handler.generate_description(image_data, prompt), provider)
+
+    async def generate_description_stream(
+        self, image_data: Optional[str], prompt: str, provider: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """流式生成描述；只在产出第一段之前失败切换，流式输出不做对冲"""
+        stream = lambda name, handler: handler.generate_description_stream(image_data, prompt)
+        async for chunk in self._stream(stream, provider):
+            yield chunk
+
+    async def analyze_image(self, image_data, prompt: Optional[str] = None, provider: Optional[str] = None) -> str:
+        """分析图片（URL、图片内容或 SpooledUpload），按服务优先级、熔断与对冲调用
+
+        图片在调用服务之前下载，图片本身的错误（如 URL 无法访问）不计入服务的熔断。
+        """
+        image_data = await self.vision.prefetch(image_data)
+
+        async def call(name: str, handler: LLMHandler) -> str:
+            if name == VISION_PROVIDER:
+                return await self.vision.analyze_image(image_data, prompt)
+            image = await self.vision.encode_image(image_data)
+            return await handler.generate_description(image, prompt or self.vision.default_prompt)
+
+        return await self._race(call, provider)
+
+    async def analyze_image_stream(
+        self, image_data, prompt: Optional[str] = None, provider: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """流式分析图片；失败切换规则同 generate_description_stream"""
+        image_data = await self.vision.prefetch(image_data)
+
+        async def stream(name: str, handler: LLMHandler) -> AsyncIterator[str]:
+            if name == VISION_PROVIDER:
+                async for chunk in self.vision.analyze_image_stream(image_data, prompt):
+                    yield chunk
+                return
+            image = await self.vision.encode_image(image_data)
+            async for chunk in handler.generate_description_stream(image, prompt or self.vision.default_prompt):
+                yield chunk
+
+        async for chunk in self._stream(stream, provider):
+            yield chunk
+
+    async def _stream(
+        self, stream: Callable[[str, LLMHandler], AsyncIterator[str]], provider: Optional[str]
+    ) -> AsyncIterator[str]:
+        errors: List[str] = []
+        for name, handler in self._candidates(provider, errors):
+            breaker = self.breakers[name]
+            started = False
+            try:
+                async for chunk in stream(name, handler):
+                    started = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                breaker.release()
+                LLM_PROVIDER_CALLS.labels(provider=name, outcome="cancelled").inc()
+                raise
+            except Exception as e:
+                breaker.record_failure()
+                LLM_PROVIDER_CALLS.labels(provider=name, outcome="error").inc()
+                logger.warning("LLM服务 %s 流式请求失败: %s", name, e)
+                if started:
+                    raise
+                errors.append(f"{name}: {e}")
+                continue
+            breaker.record_success()
+            LLM_PROVIDER_CALLS.labels(provider=name, outcome="success").inc()
+            return
+        raise Exception(f"没有可用的LLM服务（{'; '.join(errors) or '未配置服务'}）")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "providers": self.providers,
+            "hedge_delay_ms": self.hedge_delay * 1000,
+            "breakers": {name: breaker.stats() for name, breaker in self.breakers.items()},
+        }
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from contextvars import ContextVar
+from typing import Any, Optional
+
+# 当前请求的ID，由 main.py 的中间件设置；后台任务中为 "-"
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s [%(request_id)s] %(name)s: %(message)s"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class RequestIdFilter(logging.Filter):
+    """把当前请求ID写入日志记录（在调用方线程中执行，contextvar 才可见）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _Truncated:
+    """延迟截断：只有日志真正输出时才格式化，长字符串与二进制数据只保留摘要"""
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value: Any, limit: int):
+        self.value = value
+        self.limit = limit
+
+    def _shorten(self, value: Any, depth: int = 0) -> Any:
+        if isinstance(value, (bytes, bytearray)):
+            return f"<{len(value)} bytes>"
+        if isinstance(value, str):
+            if len(value) > self.limit:
+                return f"{value[:self.limit]}...(+{len(value) - self.limit} chars)"
+            return value
+        if depth >= 4:
+            return "..."
+        if isinstance(value, dict):
+            return {key: self._shorten(item, depth + 1) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._shorten(item, depth + 1) for item in value[:20]] + (["..."] if len(value) > 20 else [])
+        return value
+
+    def __str__(self) -> str:
+        shortened = self._shorten(self.value)
+        if isinstance(shortened, str):
+            return shortened
+        try:
+            text = json.dumps(shortened, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            text = str(shortened)
+        return self._shorten(text) if len(text) > self.limit * 4 else text
+
+
+def truncate(value: Any, limit: Optional[int] = None) -> _Truncated:
+    """用于日志参数：logger.debug("payload: %s", truncate(payload))"""
+    return _Truncated(value, limit or int(os.getenv("LOG_PAYLOAD_LIMIT", "256")))
+
+
+def _stream_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return handler
+
+
+def _replace_handlers(root: logging.Logger, handler: logging.Handler):
+    handler.addFilter(RequestIdFilter())
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+
+
+def setup_logging(level: Optional[str] = None):
+    """配置根日志：调用方只把记录放入队列，由后台线程写出，避免同步 stdout I/O 阻塞事件循环
+
+    重复调用只更新日志级别；shutdown_logging 之后再次调用会重新启用队列。
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+    if _listener is not None:
+        return
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    _replace_handlers(root, logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, _stream_handler(), respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止后台写出线程（会先写完队列中剩余的记录），之后的日志直接同步写出，不会丢失"""
+    global _listener
+    if _listener is not None:
+        _replace_handlers(logging.getLogger(), _stream_handler())
+        _listener.stop()
+        _listener = None
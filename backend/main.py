@@ -1,34 +1,128 @@
-from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi import FastAPI, File, UploadFile, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from typing import Optional  # 添加这行导入
-import requests
+from typing import List, Optional  # 添加这行导入
 import os
 from dotenv import load_dotenv
-from llm_handlers import LLMFactory
+from llm_providers import LLMProviderManager
+from metrics import ADMISSION_REJECTED, COMFY_GENERATIONS_BY_QUALITY, TIME_TO_FIRST_TOKEN, HTTP_IN_FLIGHT, HTTP_REQUEST_SECONDS, REQUESTS_CANCELLED, render_prometheus, track_stage
 from vision_handler import VisionModelHandler
 from comfy_handler import ComfyUIHandler
-import base64
-import shutil
+from http_client import http_clients
+from ollama_models import ollama_models
+from generation_cache import GenerationCache
+from image_store import ImageStore
+from image_delivery import ImageDelivery
+from generation_dedup import GenerationDeduplicator
+from jobs import FINISHED_STATES, JobQueue, JobQueueFull
+from admission import AdmissionController, AdmissionRejected
+from batch_analysis import BatchAnalyzer, BatchItem
+from uploads import BodySizeLimitMiddleware, SpooledUpload, UploadTooLarge
+import json
+import time
+import uuid
+import asyncio
+import contextlib
+import logging
 from pathlib import Path
+from logging_config import request_id_var, setup_logging, shutdown_logging
+from shared_state import worker_id
 
 # 获取项目根目录的绝对路径
 ROOT_DIR = Path(__file__).resolve().parent.parent
 ENV_PATH = ROOT_DIR / '.env'
 
-print(f"Looking for .env file at: {ENV_PATH}")
-if not ENV_PATH.exists():
-    print(f"Warning: .env file not found at {ENV_PATH}")
-else:
-    print(f"Found .env file at {ENV_PATH}")
+if ENV_PATH.exists():
     # 使用绝对路径加载环境变量
     load_dotenv(ENV_PATH, override=True)
-    print(f"Loaded BACKEND_ENDPOINT: {os.getenv('BACKEND_ENDPOINT')}")
+
+# LOG_LEVEL 可能来自 .env，因此在加载之后再配置日志
+setup_logging()
+logger = logging.getLogger(__name__)
+
+logger.info("Looking for .env file at: %s", ENV_PATH)
+if not ENV_PATH.exists():
+    logger.warning(".env file not found at %s", ENV_PATH)
+else:
+    logger.info("Found .env file at %s", ENV_PATH)
+    logger.info("Loaded BACKEND_ENDPOINT: %s", os.getenv('BACKEND_ENDPOINT'))
 
 app = FastAPI()
 
-# 允许前端访问
+# 各组件在启动时创建（见 create_components），导入 main 时不读取配置、不访问磁盘与网络
+
+# 生成图片的内容寻址存储（按容量与时间自动清理）与 HTTP 分发（缓存头、304、缩略图）
+image_store: Optional[ImageStore] = None
+image_delivery: Optional[ImageDelivery] = None
+
+async def image_response(request: Request, name: str, width: Optional[int], fmt: Optional[str]):
+    try:
+        response = await image_delivery.respond(request, name, width, fmt)
+    except ValueError as e:
+        return ResponseModel.error(str(e), 400)
+    if response is None:
+        return ResponseModel.error("Image not found", 404)
+    return response
+
+@app.get("/static/images/{name}")
+async def serve_image(
+    request: Request,
+    name: str,
+    w: Optional[int] = Query(None, description="最大宽度，取到不小于它的档位"),
+    fmt: Optional[str] = Query(None, alias="format", description="webp 或 jpeg；只指定 w 时按 Accept 选择"),
+):
+    """从图片存储读取（前端开发服务器的 /static/images 也代理到这里）；需在 /static 挂载之前注册"""
+    return await image_response(request, name, w, fmt)
+
+# 挂载静态文件目录（目录在启动时创建）
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
+
+# 单独添加文件大小限制配置（按实际读取的字节数计算，分块上传同样受限）
+app.add_middleware(BodySizeLimitMiddleware)
+
+# 准入控制：按客户端与接口限流、各后端的并发上限与按客户端轮转的等待队列
+admission: Optional[AdmissionController] = None
+
+def too_many_requests(message: str, retry_after: int):
+    return ResponseModel.error(message, 429, headers={"Retry-After": str(retry_after)})
+
+@app.middleware("http")
+async def admit_request(request, call_next):
+    """超出客户端在该接口的速率时，在读取请求体之前返回 429"""
+    retry_after = admission.check(request) if admission is not None else 0
+    if retry_after:
+        return too_many_requests("请求过于频繁，请稍后重试", retry_after)
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_metrics(request, call_next):
+    """按路由模板记录接口耗时（不用原始路径，避免路径参数导致标签膨胀）"""
+    started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc(key=(request.method,))
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec(key=(request.method,))
+        route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, (request.method, route, status))
+
+@app.middleware("http")
+async def assign_request_id(request, call_next):
+    """为每个请求分配ID（沿用客户端的 X-Request-ID），写入该请求期间的所有日志"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:12]
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# 允许前端访问；最后添加，位于最外层，限流（429）与上传超限（413）等提前返回的响应也带上 CORS 头
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 允许所有源
@@ -38,48 +132,151 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
-# 创建图片存储目录（如果不存在）
-IMAGES_DIR = Path("static/images")
-IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+def create_components():
+    """创建各组件（读取环境变量、加载工作流模板等），在启动时调用"""
+    global image_store, image_delivery, vision_handler, llm_providers, comfy_handler
+    global generation_dedup, generation_cache, generation_jobs, admission, batch_analyzer
+    admission = AdmissionController()
+    image_store = ImageStore()
+    image_delivery = ImageDelivery(image_store)
+    vision_handler = VisionModelHandler()
+    batch_analyzer = BatchAnalyzer()
+    llm_providers = LLMProviderManager(vision=vision_handler)
+    comfy_handler = ComfyUIHandler()
+    generation_dedup = GenerationDeduplicator(comfy_handler)
+    generation_cache = GenerationCache()
+    generation_jobs = JobQueue(_run_generation_job)
 
-# 挂载静态文件目录
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 启动后预热的组件（BACKEND_WARMUP，逗号分隔或 all；默认不预热）：
+# vision 载入视觉模型并启动预处理子进程，llm 创建各 LLM 服务的处理器（导入SDK），images 启动缩略图子进程
+WARMUP_TARGETS = ("vision", "llm", "images")
+warmup_status = {"state": "disabled", "targets": [], "seconds": {}, "errors": {}}
+_warmup_task: Optional[asyncio.Task] = None
 
-# 添加前端静态目录配置
-FRONTEND_STATIC_DIR = Path("../frontend/public/static/images")
-FRONTEND_STATIC_DIR.mkdir(parents=True, exist_ok=True)
+async def warm_up(targets):
+    """并行预热各组件；失败只记录，不影响服务"""
+    actions = {"vision": vision_handler.warm_up, "llm": llm_providers.warm_up, "images": image_delivery.warm_up}
+    warmup_status.update(state="running", targets=list(targets))
 
-# 单独添加文件大小限制配置
-@app.middleware("http")
-async def add_request_size_limit(request, call_next):
-    if request.method == "POST":
-        content_length = request.headers.get("content-length")
-        if (content_length and int(content_length) > 10_000_000):  # 10MB
-            return JSONResponse(
-                status_code=413,
-                content={"detail": "File too large. Maximum size allowed is 10MB"}
-            )
-    response = await call_next(request)
-    return response
+    async def run(target):
+        started = time.perf_counter()
+        try:
+            await actions[target]()
+        except Exception as e:
+            warmup_status["errors"][target] = str(e)
+            logger.warning("预热 %s 失败: %s", target, e)
+        warmup_status["seconds"][target] = round(time.perf_counter() - started, 3)
+
+    await asyncio.gather(*[run(target) for target in targets])
+    warmup_status["state"] = "done"
+    logger.info("Warm-up finished: %s", warmup_status["seconds"])
+
+def warmup_targets():
+    targets = [t.strip().lower() for t in os.getenv("BACKEND_WARMUP", "").split(",") if t.strip()]
+    if "all" in targets:
+        return list(WARMUP_TARGETS)
+    unknown = [t for t in targets if t not in WARMUP_TARGETS]
+    if unknown:
+        logger.warning("忽略未知的预热项: %s（可选: %s, all）", ", ".join(unknown), ", ".join(WARMUP_TARGETS))
+    return [t for t in targets if t in WARMUP_TARGETS]
 
 # 添加在中间件配置后
 @app.on_event("startup")
 async def startup():
     """应用启动时的初始化操作"""
+    global _warmup_task
+    # 同一进程中再次启动时（上次关闭已停止日志队列）重新启用队列
+    setup_logging()
+    create_components()
+    Path("static").mkdir(exist_ok=True)
+
     # 检查必要的环境变量
     comfy_output_dir = os.getenv('COMFY_UI_OUTPUT_DIR')
     if not comfy_output_dir:
-        print("警告: COMFY_UI_OUTPUT_DIR 环境变量未设置，将使用默认路径")
+        logger.warning("COMFY_UI_OUTPUT_DIR 环境变量未设置，将使用默认路径")
     else:
-        print(f"ComfyUI 输出目录: {comfy_output_dir}")
+        logger.info("ComfyUI 输出目录: %s", comfy_output_dir)
         if not os.path.exists(comfy_output_dir):
-            print(f"警告: ComfyUI 输出目录不存在: {comfy_output_dir}")
+            logger.warning("ComfyUI 输出目录不存在: %s", comfy_output_dir)
+
+    # 共享的 HTTP 连接池
+    await http_clients.start()
+
+    # 图片存储索引与后台清理，缩略图进程池
+    await image_store.start()
+    await image_delivery.start()
+
+    # 生成结果缓存的 LRU 索引
+    await generation_cache.start()
+
+    # 图片预处理进程池
+    await vision_handler.start()
+
+    # 后台预载入视觉模型与 Ollama LLM 模型，有流量期间定期保活
+    await ollama_models.start()
+
+    # 建立到 ComfyUI 的常驻 websocket，用于推送式完成通知
+    await comfy_handler.start()
+
+    # 异步生成任务队列
+    await generation_jobs.start()
+
+    # 预热默认在后台进行，/health 立即可用；BACKEND_WARMUP_WAIT=true 时预热完成后才开始接受请求
+    targets = warmup_targets()
+    if targets:
+        if os.getenv("BACKEND_WARMUP_WAIT", "false").lower() in ("1", "true", "yes"):
+            await warm_up(targets)
+        else:
+            _warmup_task = asyncio.create_task(warm_up(targets))
+
+@app.on_event("shutdown")
+async def shutdown():
+    """应用关闭时释放连接"""
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+    await generation_jobs.close()
+    await comfy_handler.close()
+    await ollama_models.close()
+    await vision_handler.close()
+    await image_delivery.close()
+    await image_store.close()
+    await http_clients.close()
+    shutdown_logging()
 
 @app.get("/health")
 async def health_check():
     """健康检查接口"""
     return {"status": "ok"}
 
+@app.get("/stats")
+async def stats():
+    """运行状态统计"""
+    return {
+        # 各项统计只包含处理本请求的 worker 进程
+        "worker": {"id": worker_id(), "pid": os.getpid()},
+        "http": http_clients.stats(),
+        "vision_cache": vision_handler.cache.stats(),
+        "vision_preprocess": vision_handler.preprocessor.stats(),
+        "batch_analysis": batch_analyzer.stats(),
+        "generation_cache": generation_cache.stats(),
+        "image_store": await image_store.stats(),
+        "image_delivery": image_delivery.stats(),
+        "generation_dedup": generation_dedup.stats(),
+        "comfyui": comfy_handler.dispatcher.stats(),
+        "generation_quality": comfy_handler.quality.stats(),
+        "jobs": generation_jobs.stats(),
+        "admission": admission.stats(),
+        "llm_providers": llm_providers.stats(),
+        "ollama": ollama_models.stats(),
+        "warmup": warmup_status,
+        "time_to_first_token": TIME_TO_FIRST_TOKEN.snapshot()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的指标"""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
 # 统一响应格式
 class ResponseModel:
     @staticmethod
@@ -91,166 +288,466 @@ class ResponseModel:
         })
 
     @staticmethod
-    def error(message, code=500):
+    def error(message, code=500, headers=None):
         return JSONResponse(
             content={
                 "code": code,
                 "message": message,
                 "data": None
             },
-            status_code=code
+            status_code=code,
+            headers=headers
         )
 
-# 创建vision模型处理器实例
-vision_handler = VisionModelHandler()
+class ClientDisconnected(Exception):
+    """客户端在请求完成前断开了连接"""
+
+async def _wait_for_disconnect(request: Request):
+    """请求体已读完后，下一条 ASGI 消息只会是 http.disconnect
+
+    不用 request.is_disconnected()：经过 @app.middleware("http") 包装后，它的非阻塞检查收不到断开消息。
+    """
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+async def cancel_on_disconnect(request: Request, awaitable, on_disconnect=None):
+    """等待 awaitable 完成；客户端断开时取消它（进行中的视觉请求随之中止），并抛出 ClientDisconnected
+
+    Args:
+        on_disconnect: 可选回调，用于取消不在本协程内执行的工作（如生成任务）
+    """
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task.done() or watcher.exception() is not None:
+        return await task
+    REQUESTS_CANCELLED.labels(route=request.url.path).inc()
+    logger.info("Client disconnected, cancelling %s", request.url.path)
+    task.cancel()
+    if on_disconnect is not None:
+        on_disconnect()
+    raise ClientDisconnected("客户端已断开连接")
+
+# vision模型处理器
+vision_handler: Optional[VisionModelHandler] = None
+
+# 文本/多模态 LLM 服务（处理器共享、失败切换、熔断与对冲，见 LLM_PROVIDERS 等配置）
+llm_providers: Optional[LLMProviderManager] = None
 
-# 创建ComfyUI处理器实例
-comfy_handler = ComfyUIHandler()
+# ComfyUI处理器
+comfy_handler: Optional[ComfyUIHandler] = None
+
+# 合并短时间内的并发生成请求
+generation_dedup: Optional[GenerationDeduplicator] = None
+
+# 生成结果缓存（仅用于固定种子的工作流）
+generation_cache: Optional[GenerationCache] = None
+
+async def publish_image(source_path) -> str:
+    """把图片放入图片存储，返回对外的文件名"""
+    with track_stage("image_publish", "local"):
+        return await image_store.add(source_path)
 
 @app.post("/analyze-image")
 async def analyze_image(
+    request: Request,
     objectName: str = Form(...), 
     image_url: str = Form(...),
     model_type: str = Form(...)
 ):
-    """分析图片生成描述"""
+    """分析图片生成描述（model_type 指定优先使用的 LLM 服务，其余已配置的服务作为备用）"""
+    async def analyze():
+        async with admission.slot("ollama", admission.client_id(request), request.url.path):
+            return await llm_providers.analyze_image(
+                image_url,
+                f"Please describe this {objectName} in detail, focusing on its visual characteristics.",
+                llm_providers.resolve(model_type)
+            )
+
     try:
-        description = await vision_handler.analyze_image(
-            image_url,
-            f"Please describe this {objectName} in detail, focusing on its visual characteristics."
-        )
+        description = await cancel_on_disconnect(request, analyze())
         return ResponseModel.success({"prompt": description})
+    except AdmissionRejected as e:
+        return too_many_requests(str(e), e.retry_after)
+    except ClientDisconnected as e:
+        return ResponseModel.error(str(e), 499)
     except Exception as e:
         return ResponseModel.error(str(e))
 
-@app.post("/generate-image")
-async def generate_image(prompt: str = Form(...)):
-    """使用ComfyUI生成图片并保存到本地"""
+# 批量图片分析（/analyze-images）
+batch_analyzer: Optional[BatchAnalyzer] = None
+
+def describe_prompt(object_name: Optional[str]) -> Optional[str]:
+    """按物体名称构建视觉模型的提示词；未提供时使用视觉处理器的默认提示词"""
+    if not object_name:
+        return None
+    return f"Please describe this {object_name} in detail, focusing on its visual characteristics."
+
+@app.post("/analyze-images")
+async def analyze_images(
+    request: Request,
+    image_url: Optional[List[str]] = Form(None),
+    images: Optional[List[UploadFile]] = File(None),
+    objectName: Optional[List[str]] = Form(None),
+    model_type: Optional[str] = Form(None)
+):
+    """批量分析图片：以 NDJSON 逐行返回每张图片的结果（按完成顺序），最后一行为汇总
+
+    图片为多个 image_url 与/或多个上传的 images（URL 在前）；objectName 只给一个时用于所有图片，
+    给出与图片数量相同的多个时按顺序对应。单张图片失败时该行 status 为 error，不影响其他图片。
+    """
+    urls = image_url or []
+    files = images or []
+    names = objectName or []
+    count = len(urls) + len(files)
+    if not count:
+        return ResponseModel.error("请提供 image_url 或 images", 400)
+    if count > batch_analyzer.max_items:
+        return ResponseModel.error(f"一次最多分析 {batch_analyzer.max_items} 张图片", 413)
+    if len(names) not in (0, 1, count):
+        return ResponseModel.error("objectName 的数量需为 1 或与图片数量相同", 400)
+    client = admission.client_id(request)
+    retry_after = admission.admissible("ollama", client, request.url.path)
+    if retry_after:
+        return too_many_requests("ollama 繁忙，请稍后重试", retry_after)
+
+    uploads = []
     try:
-        # 获取 ComfyUI 生成的图片
-        comfy_image_url = await comfy_handler.generate_image(prompt)
-        print(f"Debug - ComfyUI returned URL: {comfy_image_url}")
+        # 上传的图片在开始返回结果之前检查大小并计算哈希，请求结束时删除预处理用的副本
+        for image in files:
+            uploads.append(await SpooledUpload.from_upload(image))
+    except UploadTooLarge as e:
+        for upload in uploads:
+            upload.close()
+        return ResponseModel.error(str(e), 413)
+    sources = [(url, url) for url in urls]
+    sources += [(image.filename or f"upload-{index}", upload) for index, (image, upload) in enumerate(zip(files, uploads))]
+    if len(names) == 1:
+        names = names * count
+    items = [
+        BatchItem(index, source, data, describe_prompt(names[index] if names else None))
+        for index, (source, data) in enumerate(sources)
+    ]
+
+    provider = llm_providers.resolve(model_type)
+
+    async def analyze(data, prompt):
+        # 批量已通过准入检查，各图片只排队等待名额，不再因等待队列已满被拒绝
+        async with admission.slot("ollama", client, request.url.path, bounded=False):
+            return await llm_providers.analyze_image(data, prompt, provider)
+
+    async def lines():
+        try:
+            async for result in batch_analyzer.run(items, vision_handler.prefetch, analyze):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            for upload in uploads:
+                upload.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+def sse_event(event: str, data) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/analyze-image/stream")
+async def analyze_image_stream(
+    request: Request,
+    objectName: str = Form(...),
+    image_url: str = Form(...),
+    model_type: str = Form(...)
+):
+    """流式分析图片：以 SSE 逐段推送描述，最后推送完整提示词"""
+    client = admission.client_id(request)
+    # 名额在流开始后才占用，排不上队时在响应开始之前返回 429
+    retry_after = admission.admissible("ollama", client, request.url.path)
+    if retry_after:
+        return too_many_requests("ollama 繁忙，请稍后重试", retry_after)
+
+    async def event_stream():
+        parts = []
+        try:
+            async with admission.slot("ollama", client, request.url.path):
+                async for text in llm_providers.analyze_image_stream(
+                    image_url,
+                    f"Please describe this {objectName} in detail, focusing on its visual characteristics.",
+                    llm_providers.resolve(model_type)
+                ):
+                    parts.append(text)
+                    yield sse_event("token", {"text": text})
+            yield sse_event("done", {"prompt": "".join(parts)})
+        except Exception as e:
+            yield sse_event("error", {"message": str(e)})
+
+    return sse_response(event_stream())
+
+async def run_generation(prompt: str, on_event=None, workflow_name: Optional[str] = None, slot=None) -> dict:
+    """使用ComfyUI生成图片并保存到本地，返回 {"image_url": 文件名, "quality": 质量档位}
+
+    slot: 调用 ComfyUI 期间占用的名额（异步上下文管理器）；命中生成缓存时不进入
+    """
+    workflow = comfy_handler.prepare_workflow(prompt, workflow_name)
+    quality = comfy_handler.describe_quality(workflow)
+    cache_key = GenerationCache.workflow_key(workflow) if comfy_handler.deterministic else None
+    if cache_key:
+        cached_path = await generation_cache.get(cache_key)
+        if cached_path:
+            filename = await publish_image(cached_path)
+            logger.debug("Generation cache hit: %s", filename)
+            return {"image_url": filename, "quality": quality}
+
+    # 获取 ComfyUI 生成的图片
+    async with slot or contextlib.nullcontext():
+        started = time.monotonic()
+        comfy_image_url = await generation_dedup.generate_image(workflow, on_event=on_event)
+    comfy_handler.quality.record(quality["level"], time.monotonic() - started)
+    COMFY_GENERATIONS_BY_QUALITY.labels(tier=quality["tier"]).inc()
+    logger.debug("ComfyUI returned URL: %s", comfy_image_url)
+    
+    if comfy_image_url:
+        # 从 URL 中提取实际的文件名
+        from urllib.parse import urlparse, parse_qs
+        parsed_url = urlparse(comfy_image_url)
+        query_params = parse_qs(parsed_url.query)
+        filename = query_params.get('filename', [''])[0]
         
-        if comfy_image_url:
-            # 从 URL 中提取实际的文件名
-            from urllib.parse import urlparse, parse_qs
-            parsed_url = urlparse(comfy_image_url)
-            query_params = parse_qs(parsed_url.query)
-            filename = query_params.get('filename', [''])[0]
-            
-            print(f"Debug - Extracted filename: {filename}")
-            
-            # 使用环境变量中的输出目录，如果未设置则使用默认路径
-            comfy_output_dir = os.getenv('COMFY_UI_OUTPUT_DIR')
-            if not comfy_output_dir:
-                comfy_output_dir = os.path.join(os.path.expanduser('~'), 'Documents/ComfyUI/output')
-                print(f"Debug - Using default output directory: {comfy_output_dir}")
-            else:
-                print(f"Debug - Using configured output directory: {comfy_output_dir}")
-            
-            if not os.path.exists(comfy_output_dir):
-                print(f"Warning - Directory does not exist: {comfy_output_dir}")
-                os.makedirs(comfy_output_dir, exist_ok=True)
-                print(f"Created directory: {comfy_output_dir}")
+        logger.debug("Extracted filename: %s", filename)
+        
+        # 使用环境变量中的输出目录，如果未设置则使用默认路径
+        comfy_output_dir = os.getenv('COMFY_UI_OUTPUT_DIR')
+        if not comfy_output_dir:
+            comfy_output_dir = os.path.join(os.path.expanduser('~'), 'Documents/ComfyUI/output')
+            logger.debug("Using default output directory: %s", comfy_output_dir)
+        else:
+            logger.debug("Using configured output directory: %s", comfy_output_dir)
+        
+        if not os.path.exists(comfy_output_dir):
+            logger.warning("Directory does not exist: %s", comfy_output_dir)
+            os.makedirs(comfy_output_dir, exist_ok=True)
+            logger.info("Created directory: %s", comfy_output_dir)
+        
+        local_comfy_path = os.path.join(comfy_output_dir, filename)
+        logger.debug("Looking for file at: %s", local_comfy_path)
+        
+        if os.path.exists(local_comfy_path):
+            logger.debug("File found at %s", local_comfy_path)
+            # 存入图片存储（同一文件系统时为硬链接，不复制数据）
+            public_name = await publish_image(local_comfy_path)
             
-            local_comfy_path = os.path.join(comfy_output_dir, filename)
-            print(f"Debug - Looking for file at: {local_comfy_path}")
+            if cache_key:
+                await generation_cache.put(cache_key, local_comfy_path)
+
+            # 返回可访问的URL
+            logger.debug("Public URL: %s/static/images/%s", os.getenv('BACKEND_ENDPOINT'), public_name)
             
-            if os.path.exists(local_comfy_path):
-                print(f"Debug - File found at {local_comfy_path}")
-                # 确保目标目录存在
-                os.makedirs(IMAGES_DIR, exist_ok=True)
-                
-                # 复制到后端静态目录
-                dest_path = IMAGES_DIR / filename
-                print(f"Debug - Copying to: {dest_path}")
-                
-                shutil.copy2(local_comfy_path, dest_path)
-                print(f"Debug - File copied successfully")
-                
-                # 复制文件到前端静态目录
-                frontend_path = FRONTEND_STATIC_DIR / filename
-                shutil.copy2(local_comfy_path, frontend_path)
-                
-                # 返回可访问的URL
-                public_url = f"{os.getenv('BACKEND_ENDPOINT')}/static/images/{filename}"
-                print(f"Debug - Public URL: {public_url}")
-                print(f"Debug - File exists in static dir: {os.path.exists(dest_path)}")  # 添加调试日志
-                
-                return ResponseModel.success({
-                    "image_url": filename  # 只返回文件名，不包含完整路径
-                })
-            else:
-                print(f"Debug - File not found at {local_comfy_path}")
-                # 列出目录内容以帮助调试
-                if os.path.exists(comfy_output_dir):
-                    print(f"Debug - Contents of {comfy_output_dir}:")
-                    print(os.listdir(comfy_output_dir))
-                else:
-                    print(f"Debug - Directory {comfy_output_dir} does not exist")
-                raise FileNotFoundError(f"ComfyUI生成的图片未找到: {local_comfy_path}")
+            return {
+                "image_url": public_name,  # 只返回文件名，不包含完整路径
+                "quality": quality,
+            }
         else:
-            raise Exception("图片生成失败")
+            logger.error("File not found at %s", local_comfy_path)
+            # 列出目录内容以帮助调试（输出目录可能很大，只在 DEBUG 级别列出少量条目）
+            if logger.isEnabledFor(logging.DEBUG) and os.path.exists(comfy_output_dir):
+                with os.scandir(comfy_output_dir) as entries:
+                    sample = [entry.name for _, entry in zip(range(20), entries)]
+                logger.debug("First entries of %s: %s", comfy_output_dir, sample)
+            raise FileNotFoundError(f"ComfyUI生成的图片未找到: {local_comfy_path}")
+    else:
+        raise Exception("图片生成失败")
+
+async def _run_generation_job(job) -> dict:
+    # 任务已在队列中按客户端轮流排过队，等待名额时不再拒绝；命中生成缓存时不占用 ComfyUI 名额
+    slot = admission.slot("comfyui", job.params.get("client"), bounded=False)
+    with track_stage("generation", "comfyui"):
+        return await run_generation(job.params["prompt"], on_event=job.on_comfy_event,
+                                    workflow_name=job.params.get("workflow"), slot=slot)
+
+# 有界的生成任务队列，满时返回 429
+generation_jobs: Optional[JobQueue] = None
+
+def submit_generation(request: Request, prompt: str, workflow: Optional[str]):
+    """校验工作流名称后提交生成任务；开启准入控制时同一客户端的任务与其他客户端轮流执行"""
+    comfy_handler.workflows.get(workflow)
+    params = {"prompt": prompt, "workflow": workflow}
+    if admission.enabled:
+        params["client"] = admission.client_id(request)
+    return generation_jobs.submit(params)
+
+def job_queue_full(request: Request, e: JobQueueFull):
+    ADMISSION_REJECTED.labels(route=request.url.path, reason="queue_full").inc()
+    return too_many_requests(str(e), admission.retry_after("comfyui", generation_jobs.stats()["pending"]))
+
+@app.get("/workflows")
+async def list_workflows():
+    """可用的工作流及其可修改项的默认值"""
+    return ResponseModel.success({
+        "default": comfy_handler.workflows.default,
+        "workflows": comfy_handler.workflows.describe(),
+    })
+
+@app.post("/generate-image")
+async def generate_image(request: Request, prompt: str = Form(...), workflow: Optional[str] = Form(None)):
+    """使用ComfyUI生成图片并保存到本地（同步等待任务完成；客户端断开时取消任务）"""
+    try:
+        job = submit_generation(request, prompt, workflow)
+    except ValueError as e:
+        return ResponseModel.error(str(e), 400)
+    except JobQueueFull as e:
+        return job_queue_full(request, e)
+    try:
+        result = await cancel_on_disconnect(
+            request, generation_jobs.wait(job), on_disconnect=lambda: generation_jobs.cancel(job)
+        )
+        return ResponseModel.success(result)
+    except ClientDisconnected as e:
+        return ResponseModel.error(str(e), 499)
     except Exception as e:
-        print(f"Error generating image: {str(e)}")
+        logger.error("Error generating image: %s", e)
         return ResponseModel.error(str(e))
 
+@app.post("/jobs/generate-image")
+async def submit_generation_job(request: Request, prompt: str = Form(...), workflow: Optional[str] = Form(None)):
+    """提交异步生成任务，立即返回任务ID"""
+    try:
+        job = submit_generation(request, prompt, workflow)
+    except ValueError as e:
+        return ResponseModel.error(str(e), 400)
+    except JobQueueFull as e:
+        return job_queue_full(request, e)
+    return ResponseModel.success({"job_id": job.id, "status": job.status})
+
+@app.get("/jobs/{job_id}")
+async def get_generation_job(job_id: str):
+    """查询任务状态（任务可以由任一 worker 进程提交）"""
+    data = await generation_jobs.snapshot(job_id)
+    if data is None:
+        return ResponseModel.error("Job not found", 404)
+    return ResponseModel.success(data)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_generation_job(job_id: str):
+    """取消任务：排队中的不再执行，执行中的从 ComfyUI 队列删除或中断"""
+    job = generation_jobs.get(job_id)
+    if job is None:
+        # 其他 worker 上的任务由其所属 worker 在下一个同步周期取消
+        data = await generation_jobs.request_cancel(job_id)
+        if data is None:
+            return ResponseModel.error("Job not found", 404)
+        if data["status"] not in FINISHED_STATES:
+            REQUESTS_CANCELLED.labels(route="/jobs/{job_id}").inc()
+        return ResponseModel.success(data)
+    if generation_jobs.cancel(job):
+        REQUESTS_CANCELLED.labels(route="/jobs/{job_id}").inc()
+    return ResponseModel.success(job.as_dict())
+
+@app.get("/jobs/{job_id}/events")
+async def stream_generation_job(job_id: str):
+    """以 Server-Sent Events 推送任务状态与逐步采样进度"""
+    job = generation_jobs.get(job_id)
+    if job is not None:
+        events = generation_jobs.events(job)
+    elif await generation_jobs.snapshot(job_id) is not None:
+        # 其他 worker 上的任务：轮询共享存储
+        events = generation_jobs.remote_events(job_id)
+    else:
+        return ResponseModel.error("Job not found", 404)
+
+    async def event_stream():
+        async for event in events:
+            yield sse_event(event["event"], event["data"])
+
+    return sse_response(event_stream())
+
 # 添加一个图片代理接口（可选，用于调试）
 @app.get("/proxy-image/{filename}")
-async def proxy_image(filename: str):
+async def proxy_image(
+    request: Request,
+    filename: str,
+    w: Optional[int] = None,
+    fmt: Optional[str] = Query(None, alias="format"),
+):
     """代理 ComfyUI 图片访问"""
-    file_path = IMAGES_DIR / filename
-    if not file_path.exists():
-        return ResponseModel.error("Image not found", 404)
-    return FileResponse(file_path)
+    return await image_response(request, filename, w, fmt)
+
+async def describe_and_generate(upload: SpooledUpload, client: str) -> dict:
+    # 先用vision模型分析图片
+    async with admission.slot("ollama", client, "/upload"):
+        description = await llm_providers.analyze_image(upload)
+    
+    # 调用ComfyUI生成新图像
+    comfy_api_endpoint = os.getenv("COMFY_UI_API_ENDPOINT")
+    async with admission.slot("comfyui", client, "/upload"):
+        async with http_clients.session(comfy_api_endpoint).post(
+            comfy_api_endpoint,
+            json={"prompt": description}
+        ) as comfy_response:
+            comfy_result = await comfy_response.json()
+    
+    return {
+        "description": description,
+        "image": comfy_result.get("image_url")
+    }
 
 @app.post("/upload")
-async def upload_image(image: UploadFile = File(...)):
-    """处理图片上传并生成新图片"""
+async def upload_image(request: Request, image: UploadFile = File(...)):
+    """处理图片上传并生成新图片（客户端断开时中止视觉与生成请求）"""
+    upload = None
+    client = admission.client_id(request)
+    # 视觉模型排不上队时立即返回，不再写入临时文件
+    retry_after = admission.admissible("ollama", client, request.url.path)
+    if retry_after:
+        return too_many_requests("ollama 繁忙，请稍后重试", retry_after)
     try:
-        # 先用vision模型分析图片
-        image_data = await image.file.read()
-        description = await vision_handler.analyze_image(image_data)
-        
-        # 调用ComfyUI生成新图像
-        comfy_response = requests.post(
-            os.getenv("COMFY_UI_API_ENDPOINT"),
-            json={"prompt": description}
-        )
-        
-        return ResponseModel.success({
-            "description": description,
-            "image": comfy_response.json().get("image_url")
-        })
+        # 在框架已落盘的上传文件上检查大小并计算哈希，不在内存中保留整份图片
+        upload = await SpooledUpload.from_upload(image)
+        return ResponseModel.success(await cancel_on_disconnect(request, describe_and_generate(upload, client)))
+    except AdmissionRejected as e:
+        return too_many_requests(str(e), e.retry_after)
+    except ClientDisconnected as e:
+        return ResponseModel.error(str(e), 499)
+    except UploadTooLarge as e:
+        return ResponseModel.error(str(e), 413)
     except Exception as e:
         return ResponseModel.error(str(e))
+    finally:
+        if upload is not None:
+            upload.close()
 
 # 添加一个用于测试的端点
 @app.get("/test-image/{filename}")
-async def test_image(filename: str):
+async def test_image(
+    request: Request,
+    filename: str,
+    w: Optional[int] = None,
+    fmt: Optional[str] = Query(None, alias="format"),
+):
     """测试图片访问"""
-    file_path = IMAGES_DIR / filename
-    if file_path.exists():
-        return FileResponse(file_path)
-    return ResponseModel.error("Image not found", 404)
+    return await image_response(request, filename, w, fmt)
 
 @app.post("/clear-images")
 async def clear_images():
-    """清理所有生成的图片"""
+    """立即执行一次图片存储清理
+
+    只淘汰过期或超出容量的最久未访问图片；不再删除全部图片，避免其他玩家正在查看的图片失效。
+    """
     try:
-        # 清理前端static目录下的图片
-        for file in FRONTEND_STATIC_DIR.glob("*"):
-            if file.is_file() and not file.name.startswith('.'):
-                file.unlink()
-        
-        # 清理后端static目录下的图片
-        for file in IMAGES_DIR.glob("*"):
-            if file.is_file() and not file.name.startswith('.'):
-                file.unlink()
-                
-        return ResponseModel.success(message="图片清理完成")
+        evicted = await image_store.sweep()
+        return ResponseModel.success(evicted, message="图片清理完成")
     except Exception as e:
-        print(f"清理图片出错: {str(e)}")
+        logger.error("清理图片出错: %s", e)
         return ResponseModel.error(f"清理图片失败: {str(e)}")
 
 if __name__ == "__main__":
@@ -263,31 +760,3 @@ if __name__ == "__main__":
         reload=True,         # 开发模式下启用热重载
         access_log=True
     )
-
-#                 return ResponseModel.error(f"图片生成失败: {str(e)}")
-import os
-from pathlib import Path
-
-print("Current working directory:", os.getcwd())
-print("Script location:", Path(__file__).resolve())
-print("Project root:", Path(__file__).resolve().parent.parent)
-
-                
-#         except Exception as e:
-#             print(f"Debug - Processing error: {str(e)}")
-#             return ResponseModel.error(f"处理失败: {str(e)}")
-            
-#     except Exception as e:
-#         print(f"Debug - General error: {str(e)}")
-#         return ResponseModel.error(f"生成失败: {str(e)}")
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(
-        app, 
-        host="0.0.0.0",     # 修改为监听所有网络接口
-        log_level="debug",
-        port=8000,
-        reload=True,         # 开发模式下启用热重载
-        access_log=True
-    )
@@ -0,0 +1,371 @@
+import time
+import bisect
+import asyncio
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 秒级延迟的默认分桶
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 所有已创建的指标，按创建顺序输出到 /metrics
+REGISTRY: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类：名称、说明与标签名，创建时自动注册"""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels_text(self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self.samples()
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def labels(self, **labels: str) -> "_Bound":
+        return _Bound(self, self._key(labels))
+
+    def inc(self, amount: float = 1, key: Tuple[str, ...] = ()):
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels_text(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """可增可减的瞬时值（如进行中的请求数）"""
+    type = "gauge"
+
+    def dec(self, amount: float = 1, key: Tuple[str, ...] = ()):
+        self._values[key] = self._values.get(key, 0) - amount
+
+    def set(self, value: float, key: Tuple[str, ...] = ()):
+        self._values[key] = value
+
+
+class _HistogramChild:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """带标签的直方图（Prometheus 语义：累计分桶、总和与计数）"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children: Dict[Tuple[str, ...], _HistogramChild] = {}
+
+    def labels(self, **labels: str) -> "_Bound":
+        return _Bound(self, self._key(labels))
+
+    def observe(self, value: float, key: Tuple[str, ...] = ()):
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = _HistogramChild(len(self.buckets) + 1)
+        child.counts[bisect.bisect_left(self.buckets, value)] += 1
+        child.sum += value
+        child.count += 1
+
+    def mean(self, **labels: str) -> Optional[float]:
+        """某个标签组合的平均值，尚无数据时返回 None"""
+        child = self._children.get(self._key(labels))
+        return child.sum / child.count if child and child.count else None
+
+    def snapshot(self) -> List[Dict]:
+        """各标签组合的计数、均值与近似分位数"""
+        result = []
+        for key, child in self._children.items():
+            entry = dict(zip(self.labelnames, key))
+            entry["count"] = child.count
+            entry["avg"] = child.sum / child.count if child.count else 0.0
+            entry["p50"] = self._quantile(child, 0.5)
+            entry["p95"] = self._quantile(child, 0.95)
+            result.append(entry)
+        return result
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels_text(key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels_text(key)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{self._labels_text(key)} {child.count}")
+        return lines
+
+    def _quantile(self, child: _HistogramChild, q: float) -> Optional[float]:
+        """按分桶上界估计分位数"""
+        if not child.count:
+            return None
+        target = q * child.count
+        seen = 0
+        for index, count in enumerate(child.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class _Bound:
+    """绑定了标签值的指标"""
+    __slots__ = ("_metric", "_key")
+
+    def __init__(self, metric: _Metric, key: Tuple[str, ...]):
+        self._metric = metric
+        self._key = key
+
+    def observe(self, value: float):
+        self._metric.observe(value, self._key)
+
+    def inc(self, amount: float = 1):
+        self._metric.inc(amount, self._key)
+
+    def dec(self, amount: float = 1):
+        self._metric.dec(amount, self._key)
+
+    def set(self, value: float):
+        self._metric.set(value, self._key)
+
+
+def render_prometheus() -> str:
+    """所有指标的 Prometheus 文本格式"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# 流式输出的首个 token 延迟
+TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from request start to the first streamed token",
+    labelnames=("backend",),
+)
+
+# 视觉推理前预处理节省的字节数
+PREPROCESS_BYTES_SAVED = Histogram(
+    "vision_preprocess_bytes_saved",
+    "Bytes removed from each image by resizing and re-encoding before vision inference",
+    buckets=(0, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024),
+)
+
+# 请求链路各阶段（下载、预处理、推理、排队、采样、历史查询、图片发布等）
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_duration_seconds",
+    "Time spent in each stage of the upload, describe and generate pipeline",
+    labelnames=("stage", "backend"),
+)
+STAGE_IN_FLIGHT = Gauge(
+    "pipeline_stage_in_flight",
+    "Number of operations currently inside each pipeline stage",
+    labelnames=("stage", "backend"),
+)
+STAGE_TOTAL = Counter(
+    "pipeline_stage_total",
+    "Completed pipeline stage operations by outcome",
+    labelnames=("stage", "backend", "outcome"),
+)
+
+# HTTP 接口（流式响应只计到响应头发出）
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to produce the response for each API route",
+    labelnames=("method", "route", "status"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Number of API requests currently being handled",
+    labelnames=("method",),
+)
+
+# 取消：客户端断开或任务被取消后释放的工作
+REQUESTS_CANCELLED = Counter(
+    "requests_cancelled_total",
+    "Requests whose work was cancelled because the client disconnected or cancelled the job",
+    labelnames=("route",),
+)
+COMFY_PROMPTS_CANCELLED = Counter(
+    "comfy_prompts_cancelled_total",
+    "ComfyUI prompts removed from the queue or interrupted after every caller went away",
+    labelnames=("node", "action"),
+)
+COMFY_GPU_SECONDS_RECOVERED = Counter(
+    "comfy_gpu_seconds_recovered_total",
+    "Estimated ComfyUI execution time freed by cancelling abandoned prompts (based on the node's mean successful execution time)",
+    labelnames=("node",),
+)
+
+
+# 生成质量：按负载调整的档位（0 为完整质量，数字越大质量越低）
+COMFY_QUALITY_TIER = Gauge(
+    "comfy_quality_tier",
+    "Current generation quality tier chosen by the adaptive controller (0 is full quality)",
+)
+COMFY_GENERATIONS_BY_QUALITY = Counter(
+    "comfy_generations_by_quality_total",
+    "Completed ComfyUI generations by the quality tier their workflow was prepared with (cache hits excluded)",
+    labelnames=("tier",),
+)
+
+
+# 准入控制：被拒绝的请求（限流或后端等待队列已满）与等待后端并发名额的请求数
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total",
+    "Requests answered with 429 by admission control, by route and reason",
+    labelnames=("route", "reason"),
+)
+ADMISSION_WAITING = Gauge(
+    "admission_waiting",
+    "Requests waiting for a backend concurrency slot",
+    labelnames=("backend",),
+)
+
+
+# Ollama 模型：按模型的并发上限排队、进行中的请求，以及预载入与保活 ping
+OLLAMA_QUEUE_SECONDS = Histogram(
+    "ollama_queue_seconds",
+    "Time requests waited for a per-model Ollama concurrency slot",
+    labelnames=("model",),
+)
+OLLAMA_WAITING = Gauge(
+    "ollama_waiting",
+    "Requests waiting for a per-model Ollama concurrency slot",
+    labelnames=("model",),
+)
+OLLAMA_IN_FLIGHT = Gauge(
+    "ollama_in_flight",
+    "Requests currently sent to Ollama, by model",
+    labelnames=("model",),
+)
+OLLAMA_MODEL_REQUESTS = Counter(
+    "ollama_model_requests_total",
+    "Load-only requests sent to Ollama to preload a model or keep it resident, by kind and outcome",
+    labelnames=("model", "kind", "outcome"),
+)
+
+# 批量图片分析：各图片的结果与批量中已下载、等待分析的图片数
+BATCH_ANALYZE_ITEMS = Counter(
+    "batch_analyze_items_total",
+    "Images processed by /analyze-images, by outcome",
+    labelnames=("outcome",),
+)
+BATCH_ANALYZE_PREFETCHED = Gauge(
+    "batch_analyze_prefetched",
+    "Images downloaded ahead and waiting for a vision analysis slot",
+)
+
+
+# LLM 服务：各服务的调用结果、熔断状态与对冲请求
+LLM_PROVIDER_CALLS = Counter(
+    "llm_provider_calls_total",
+    "LLM provider calls by outcome (rejected means skipped because the circuit was open)",
+    labelnames=("provider", "outcome"),
+)
+LLM_CIRCUIT_STATE = Gauge(
+    "llm_circuit_state",
+    "Circuit breaker state per LLM provider (0 closed, 1 half-open, 2 open)",
+    labelnames=("provider",),
+)
+LLM_HEDGED_REQUESTS = Counter(
+    "llm_hedged_requests_total",
+    "Requests that raced a second provider after the hedge delay, by which attempt answered first",
+    labelnames=("winner",),
+)
+
+def record_stage(stage: str, backend: str, seconds: float, outcome: str = "success"):
+    """直接记录一次已结束的阶段（耗时在别处测得时使用）"""
+    STAGE_SECONDS.observe(seconds, (stage, backend))
+    STAGE_TOTAL.inc(key=(stage, backend, outcome))
+
+
+class track_stage:
+    """记录一个阶段的耗时、进行中数量与结果（success / error / cancelled）
+
+    同步与异步 with 皆可使用，开销为两次 perf_counter 与几次字典更新：
+        async with track_stage("vision_inference", "ollama"):
+            ...
+    """
+    __slots__ = ("_key", "_started")
+
+    def __init__(self, stage: str, backend: str = ""):
+        self._key = (stage, backend)
+        self._started = 0.0
+
+    @property
+    def stage(self) -> str:
+        return self._key[0]
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def then(self, stage: str) -> "track_stage":
+        """以成功结束当前阶段，并开始同一后端的下一个阶段"""
+        self.__exit__(None, None, None)
+        return track_stage(stage, self._key[1]).__enter__()
+
+    def __enter__(self) -> "track_stage":
+        STAGE_IN_FLIGHT.inc(key=self._key)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        STAGE_IN_FLIGHT.dec(key=self._key)
+        if exc_type is None:
+            outcome = "success"
+        elif issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+        record_stage(self._key[0], self._key[1], time.perf_counter() - self._started, outcome)
+        return False
+
+    async def __aenter__(self) -> "track_stage":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        return self.__exit__(exc_type, exc, tb)
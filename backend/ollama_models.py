@@ -0,0 +1,229 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple, Union
+
+from http_client import http_clients
+from metrics import OLLAMA_IN_FLIGHT, OLLAMA_MODEL_REQUESTS, OLLAMA_QUEUE_SECONDS, OLLAMA_WAITING, track_stage
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_keep_alive(value: str) -> Union[int, str]:
+    """Ollama 的 keep_alive：纯数字为秒数，否则为时长字符串（如 10m、1h，-1 表示常驻）；空表示使用 Ollama 的默认值"""
+    value = value.strip()
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _parse_concurrency(spec: str) -> Tuple[int, Dict[str, int]]:
+    """解析 "默认上限,模型=上限,..."，返回 (默认上限, {模型: 上限})；0 表示不限"""
+    default = 0
+    overrides = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, value = item.rpartition("=")
+        try:
+            if sep:
+                overrides[name.strip()] = int(value)
+            else:
+                default = int(value)
+        except ValueError:
+            raise ValueError(f"无法解析 Ollama 并发配置 {item!r}（格式为 默认上限,模型=上限）")
+    return default, overrides
+
+
+class OllamaModel:
+    """某个 Ollama 实例上的一个模型：并发上限、使用情况与载入状态"""
+
+    def __init__(self, endpoint: str, name: str, concurrency: int):
+        self.endpoint = endpoint
+        self.name = name
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.loads = 0
+        self.pings = 0
+        self.errors = 0
+        # 最近一次请求结束（或开始）的时间，用于判断是否仍有流量
+        self.last_used: Optional[float] = None
+        # 最近一次请求、预载入或 ping 的时间：之后 keep_alive 时长内 Ollama 不会卸载模型
+        self.last_touched: Optional[float] = None
+
+    def touch(self):
+        self.last_used = self.last_touched = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "endpoint": self.endpoint,
+            "concurrency": self.concurrency or None,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "loads": self.loads,
+            "pings": self.pings,
+            "errors": self.errors,
+            "idle_seconds": round(now - self.last_used, 1) if self.last_used is not None else None,
+        }
+
+
+class OllamaModelManager:
+    """VisionModelHandler 与 OllamaHandler 共用的 Ollama 模型生命周期管理
+
+    - 启动时在后台预载入已登记的模型（OLLAMA_PRELOAD），首个请求不必等待模型载入显存
+    - 每个请求带上 keep_alive（OLLAMA_KEEP_ALIVE）；最近 OLLAMA_TRAFFIC_WINDOW 秒内有流量时，
+      每 OLLAMA_PING_INTERVAL 秒对空闲的模型发送一次只载入不推理的请求，避免在流量间隙被卸载
+    - 每个模型一个并发上限（OLLAMA_MODEL_CONCURRENCY），多出的请求在本进程排队，
+      不让突发的并行请求挤到 Ollama 上互相争抢显存
+    配置在首次登记模型或 start() 时读取（.env 加载之后）。
+    """
+
+    def __init__(self):
+        self._models: Dict[Tuple[str, str], OllamaModel] = {}
+        self._configured = False
+        self._tasks = []
+
+    def configure(
+        self,
+        keep_alive: Optional[str] = None,
+        ping_interval: Optional[float] = None,
+        traffic_window: Optional[float] = None,
+        concurrency: Optional[str] = None,
+        preload: Optional[bool] = None,
+    ):
+        self.keep_alive = _parse_keep_alive(keep_alive if keep_alive is not None else os.getenv("OLLAMA_KEEP_ALIVE", "10m"))
+        self.ping_interval = ping_interval if ping_interval is not None else float(os.getenv("OLLAMA_PING_INTERVAL", "120"))
+        self.traffic_window = traffic_window or float(os.getenv("OLLAMA_TRAFFIC_WINDOW", "1800"))
+        self.default_concurrency, self.concurrency = _parse_concurrency(
+            concurrency if concurrency is not None else os.getenv("OLLAMA_MODEL_CONCURRENCY", "2")
+        )
+        if preload is None:
+            preload = os.getenv("OLLAMA_PRELOAD", "true").lower() in ("1", "true", "yes")
+        self.preload = preload
+        self._configured = True
+
+    def register(self, endpoint: str, name: str) -> OllamaModel:
+        """登记某个 Ollama 接口上使用的模型；同一接口与模型只登记一次"""
+        if not self._configured:
+            self.configure()
+        key = (endpoint, name)
+        model = self._models.get(key)
+        if model is None:
+            model = self._models[key] = OllamaModel(endpoint, name, self.concurrency.get(name, self.default_concurrency))
+        return model
+
+    def with_keep_alive(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """在请求中带上 keep_alive（未配置时不带，由 Ollama 使用默认值）"""
+        if self.keep_alive != "":
+            payload.setdefault("keep_alive", self.keep_alive)
+        return payload
+
+    @asynccontextmanager
+    async def slot(self, model: OllamaModel):
+        """占用模型的一个并发名额直到退出，记录排队时间"""
+        model.requests += 1
+        if model.semaphore is not None:
+            model.waiting += 1
+            OLLAMA_WAITING.labels(model=model.name).inc()
+            started = time.perf_counter()
+            try:
+                await model.semaphore.acquire()
+            finally:
+                model.waiting -= 1
+                OLLAMA_WAITING.labels(model=model.name).dec()
+                OLLAMA_QUEUE_SECONDS.labels(model=model.name).observe(time.perf_counter() - started)
+        model.in_flight += 1
+        OLLAMA_IN_FLIGHT.labels(model=model.name).inc()
+        model.touch()
+        try:
+            yield
+        finally:
+            model.in_flight -= 1
+            OLLAMA_IN_FLIGHT.labels(model=model.name).dec()
+            model.touch()
+            if model.semaphore is not None:
+                model.semaphore.release()
+
+    async def load(self, model: OllamaModel, kind: str = "preload"):
+        """发送只带 model 的请求：模型未载入时载入显存，已载入时刷新 keep_alive"""
+        try:
+            with track_stage("ollama_model_load", model.name):
+                async with http_clients.session(model.endpoint).post(
+                    model.endpoint,
+                    json=self.with_keep_alive({"model": model.name})
+                ) as response:
+                    if response.status != 200:
+                        raise Exception(f"Ollama模型 {model.name} 载入失败: {response.status}, {await response.text()}")
+                    await response.read()
+        except Exception:
+            model.errors += 1
+            OLLAMA_MODEL_REQUESTS.labels(model=model.name, kind=kind, outcome="error").inc()
+            raise
+        model.last_touched = time.monotonic()
+        if kind == "ping":
+            model.pings += 1
+        else:
+            model.loads += 1
+        OLLAMA_MODEL_REQUESTS.labels(model=model.name, kind=kind, outcome="success").inc()
+
+    async def start(self):
+        """后台预载入已登记的模型并开始保活（重复调用无副作用）"""
+        if self._tasks:
+            return
+        if not self._configured:
+            self.configure()
+        if self.preload:
+            self._tasks.append(asyncio.create_task(self._preload()))
+        if self.ping_interval > 0:
+            self._tasks.append(asyncio.create_task(self._keep_warm()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _preload(self):
+        async def one(model: OllamaModel):
+            try:
+                await self.load(model)
+                logger.info("Ollama model preloaded: %s", model.name)
+            except Exception as e:
+                logger.warning("预载入 Ollama 模型 %s 失败: %s", model.name, e)
+
+        await asyncio.gather(*[one(model) for model in list(self._models.values())])
+
+    async def _keep_warm(self):
+        """有流量期间，对超过 ping_interval 没有请求的模型发送 ping"""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for model in list(self._models.values()):
+                if model.last_used is None or now - model.last_used > self.traffic_window:
+                    continue
+                if model.in_flight or now - (model.last_touched or 0) < self.ping_interval:
+                    continue
+                try:
+                    await self.load(model, kind="ping")
+                except Exception as e:
+                    logger.warning("Ollama 模型 %s 保活失败: %s", model.name, e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keep_alive": self.keep_alive if self._configured else None,
+            "ping_interval": self.ping_interval if self._configured else None,
+            "models": {f"{model.name}@{model.endpoint}": model.stats() for model in self._models.values()},
+        }
+
+
+# 进程内共享的实例：在 FastAPI 的 startup 中调用 start()，shutdown 中调用 close()
+ollama_models = OllamaModelManager()
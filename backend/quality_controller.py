@@ -0,0 +1,214 @@
+import os
+import time
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from metrics import COMFY_QUALITY_TIER
+
+logger = logging.getLogger(__name__)
+
+# 默认档位：名称:步数比例:分辨率比例，从完整质量逐级降低
+DEFAULT_TIERS = "full:1:1,fast:0.75:1,faster:0.5:1,draft:0.5:0.75,minimal:0.375:0.625"
+
+# 分辨率取 64 的倍数（SD 潜空间要求 8 的倍数，64 对各类模型都安全）
+RESOLUTION_STEP = 64
+
+
+class QualityTier:
+    """一个质量档位：KSampler 步数与 EmptyLatentImage 分辨率相对模板的比例"""
+
+    def __init__(self, name: str, steps: float, resolution: float):
+        if not 0 < steps <= 1 or not 0 < resolution <= 1:
+            raise ValueError(f"质量档位 {name} 的比例必须在 (0, 1] 之间")
+        self.name = name
+        self.steps = steps
+        self.resolution = resolution
+
+    @property
+    def full(self) -> bool:
+        return self.steps == 1 and self.resolution == 1
+
+    def values(self, template) -> Dict[str, int]:
+        """该档位下模板的步数与宽高；模板不支持的修改点不调整"""
+        values = {}
+        if "steps" in template.patch_points:
+            values["steps"] = max(1, round(template.get(template.nodes, "steps") * self.steps))
+        for point in ("width", "height"):
+            if point in template.patch_points:
+                size = template.get(template.nodes, point) * self.resolution
+                values[point] = max(RESOLUTION_STEP, int(round(size / RESOLUTION_STEP)) * RESOLUTION_STEP)
+        return values
+
+    @classmethod
+    def parse(cls, spec: str) -> List["QualityTier"]:
+        tiers = []
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            try:
+                name, steps, resolution = item.strip().split(":")
+                tiers.append(cls(name, float(steps), float(resolution)))
+            except ValueError as e:
+                raise ValueError(f"无法解析质量档位 {item!r}（格式为 名称:步数比例:分辨率比例）: {e}")
+        if not tiers:
+            raise ValueError("至少需要一个质量档位")
+        return tiers
+
+
+def sampling_work(workflow: Dict[str, Any]) -> float:
+    """工作流的采样工作量：各 KSampler 的 步数 × 百万像素 × batch_size 之和（合并后的批次同样适用）"""
+    work = 0.0
+    for node in workflow.values():
+        if node.get("class_type") != "KSampler":
+            continue
+        inputs = node.get("inputs", {})
+        latent = inputs.get("latent_image")
+        pixels = 1.0
+        if isinstance(latent, list) and latent and latent[0] in workflow:
+            latent_inputs = workflow[latent[0]].get("inputs", {})
+            if "width" in latent_inputs and "height" in latent_inputs:
+                pixels = latent_inputs["width"] * latent_inputs["height"] * latent_inputs.get("batch_size", 1) / 1e6
+        work += inputs.get("steps", 1) * pixels
+    return work
+
+
+class QualityController:
+    """按负载调整生成质量，使端到端生成延迟的 p95 保持在目标以内
+
+    每 interval 秒最多调整一个档位：
+    - 当前档位最近的 p95，或按队列深度预测的延迟超过目标时，降低一档
+    - 高一档的预测延迟与当前 p95 都低于 目标 × headroom 时，恢复一档
+    预测延迟 = (最短队列深度 + 1) × 单位工作量执行时间 × 档位工作量，
+    单位工作量执行时间取最近执行时间的指数加权平均。
+    p95 只统计当前档位的请求，避免降档前的慢请求导致连续降档。
+    """
+
+    def __init__(
+        self,
+        target: Optional[float] = None,
+        tiers: Optional[List[QualityTier]] = None,
+        interval: Optional[float] = None,
+        window: Optional[float] = None,
+        headroom: Optional[float] = None,
+        min_samples: Optional[int] = None,
+    ):
+        """
+        Args:
+            target: p95 目标（秒），默认读取 COMFY_QUALITY_P95_TARGET，0 表示始终使用完整质量
+            tiers: 质量档位，默认读取 COMFY_QUALITY_TIERS；第一个档位通常为完整质量
+        """
+        self.target = target if target is not None else float(os.getenv("COMFY_QUALITY_P95_TARGET", "0"))
+        self.tiers = tiers or QualityTier.parse(os.getenv("COMFY_QUALITY_TIERS", DEFAULT_TIERS))
+        self.interval = interval if interval is not None else float(os.getenv("COMFY_QUALITY_INTERVAL", "5"))
+        self.window = window or float(os.getenv("COMFY_QUALITY_WINDOW", "30"))
+        self.headroom = headroom or float(os.getenv("COMFY_QUALITY_HEADROOM", "0.7"))
+        self.min_samples = min_samples or int(os.getenv("COMFY_QUALITY_MIN_SAMPLES", "5"))
+        self.level = 0
+        self.changes = 0
+        self._changed_at = 0.0
+        # (完成时间, 档位, 端到端耗时)
+        self._samples: Deque[Tuple[float, int, float]] = deque(maxlen=1000)
+        # 每单位采样工作量的执行秒数
+        self._seconds_per_work: Optional[float] = None
+        self._last_prediction: Optional[float] = None
+        COMFY_QUALITY_TIER.set(0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.target > 0 and len(self.tiers) > 1
+
+    @property
+    def tier(self) -> QualityTier:
+        return self.tiers[self.level]
+
+    def select(self, template, load: int) -> Tuple[int, Dict[str, int]]:
+        """选择本次请求的档位，返回 (档位序号, 需要修改的步数与宽高)
+
+        Args:
+            template: 工作流模板
+            load: 最短的 ComfyUI 队列深度（含正在执行的 prompt）
+        """
+        if self.enabled:
+            self._adjust(template, load)
+        tier = self.tier
+        return self.level, {} if tier.full else tier.values(template)
+
+    def record(self, level: int, latency: float):
+        """记录一次完成的生成请求的端到端耗时（不含缓存命中）"""
+        self._samples.append((time.monotonic(), level, latency))
+
+    def record_execution(self, seconds: float, work: float):
+        """记录一次 ComfyUI 执行的耗时与采样工作量，更新单位工作量的执行时间"""
+        if work <= 0:
+            return
+        observed = seconds / work
+        if self._seconds_per_work is None:
+            self._seconds_per_work = observed
+        else:
+            self._seconds_per_work += 0.2 * (observed - self._seconds_per_work)
+
+    def describe(self, level: int, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """响应中报告的质量信息"""
+        template = getattr(workflow, "template", None)
+        result: Dict[str, Any] = {"tier": self.tiers[level].name, "level": level}
+        if template is not None:
+            for point in ("steps", "width", "height"):
+                if point in template.patch_points:
+                    result[point] = template.get(workflow, point)
+        return result
+
+    def p95(self, level: Optional[int] = None) -> Optional[float]:
+        """窗口内（指定档位）请求的端到端耗时 p95，样本不足时返回 None"""
+        cutoff = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        latencies = sorted(latency for _, tier, latency in self._samples if level is None or tier == level)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+    def predict(self, template, level: int, load: int) -> Optional[float]:
+        """按队列深度与最近的执行速度预测新请求在该档位的端到端耗时"""
+        if self._seconds_per_work is None:
+            return None
+        tier = self.tiers[level]
+        workflow = template.build(**tier.values(template)) if not tier.full else template.nodes
+        return (load + 1) * self._seconds_per_work * sampling_work(workflow)
+
+    def _adjust(self, template, load: int):
+        now = time.monotonic()
+        if now - self._changed_at < self.interval:
+            return
+        current_p95 = self.p95(self.level)
+        predicted = self.predict(template, self.level, load)
+        self._last_prediction = predicted
+        pressure = max(value for value in (current_p95, predicted, 0.0) if value is not None)
+        if pressure > self.target and self.level < len(self.tiers) - 1:
+            self._set_level(self.level + 1, now, pressure)
+        elif self.level > 0:
+            limit = self.target * self.headroom
+            upper = self.predict(template, self.level - 1, load)
+            if (upper is None or upper <= limit) and (current_p95 is None or current_p95 <= limit) and pressure <= limit:
+                self._set_level(self.level - 1, now, pressure)
+
+    def _set_level(self, level: int, now: float, pressure: float):
+        logger.info("生成质量档位 %s -> %s（预计延迟 %.1f 秒，目标 p95 %.1f 秒）",
+                    self.tier.name, self.tiers[level].name, pressure, self.target)
+        self.level = level
+        self.changes += 1
+        self._changed_at = now
+        COMFY_QUALITY_TIER.set(level)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "tier": self.tier.name,
+            "level": self.level,
+            "changes": self.changes,
+            "target_p95": self.target,
+            "p95": self.p95(),
+            "predicted": self._last_prediction,
+            "seconds_per_work": self._seconds_per_work,
+            "tiers": [{"name": t.name, "steps": t.steps, "resolution": t.resolution} for t in self.tiers],
+        }
@@ -0,0 +1,51 @@
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from typing import Optional
+
+# 多个 worker 进程（uvicorn --workers N）共用的状态都放在本机目录中：
+# SQLite 数据库使用 WAL 模式（读写互不阻塞），图片等文件放在共享目录中。
+# WAL 依赖共享内存，目录需在本地文件系统上（不支持 NFS 等网络文件系统）。
+
+_worker_id: Optional[str] = None
+_worker_pid: Optional[int] = None
+
+
+def shared_path(name: str) -> str:
+    """共享状态目录（SHARED_STATE_DIR）下的文件路径"""
+    return os.path.join(os.getenv("SHARED_STATE_DIR", "shared_state"), name)
+
+
+def connect(path: str, busy_timeout: Optional[float] = None) -> sqlite3.Connection:
+    """打开多进程共用的 SQLite 数据库
+
+    WAL 模式下读不阻塞写；写冲突时最多等待 busy_timeout 秒而不是立即报 database is locked。
+    synchronous=NORMAL 时提交不等待落盘，进程崩溃不丢数据，断电可能丢失最后几次提交。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    timeout = busy_timeout or float(os.getenv("SHARED_STATE_BUSY_TIMEOUT", "10"))
+    db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    # 多个 worker 同时启动时，切换日志模式可能直接返回 database is locked（不经过 busy_timeout 等待）
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            break
+        except sqlite3.OperationalError:
+            if time.monotonic() >= deadline:
+                db.close()
+                raise
+            time.sleep(0.05)
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+def worker_id() -> str:
+    """当前 worker 进程的标识（主机名:进程号:随机后缀），fork 出的子进程会重新生成"""
+    global _worker_id, _worker_pid
+    if _worker_pid != os.getpid():
+        _worker_pid = os.getpid()
+        _worker_id = f"{socket.gethostname()}:{_worker_pid}:{uuid.uuid4().hex[:6]}"
+    return _worker_id
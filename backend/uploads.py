@@ -0,0 +1,189 @@
+import os
+import json
+import base64
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Any, AsyncIterator, BinaryIO, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def max_upload_bytes() -> int:
+    """上传大小上限（字节）；在使用时读取，.env 在导入本模块之后才加载"""
+    return int(os.getenv("MAX_UPLOAD_BYTES", "10000000"))
+
+
+# 读写磁盘的块大小；base64 编码按 3 的倍数切块，拼接后与整体编码一致
+CHUNK_SIZE = 1024 * 1024
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+
+class UploadTooLarge(Exception):
+    """上传内容超过大小上限"""
+
+
+class BodySizeLimitMiddleware:
+    """按实际收到的字节数限制请求体大小（ASGI 中间件）
+
+    Content-Length 超限时直接拒绝；分块传输没有 Content-Length，
+    在读取过程中累计字节数，超限时立即返回 413 并中止后续处理。
+    """
+
+    def __init__(self, app, max_bytes: Optional[int] = None):
+        self.app = app
+        self.max_bytes = max_bytes or max_upload_bytes()
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"File too large. Maximum size allowed is {self.max_bytes} bytes"}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        rejected = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    raise UploadTooLarge(f"请求体超过 {self.max_bytes} 字节")
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            # 已经返回 413 后，丢弃应用因读取中止而产生的响应
+            if rejected:
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+        if rejected and not started:
+            await self._reject(send)
+
+
+class SpooledUpload:
+    """上传文件：直接使用 Starlette 已落盘的 UploadFile.file，读取时检查大小、计算哈希，
+    之后按块读取，不在内存中保留整份内容
+    """
+
+    def __init__(self, file: BinaryIO, size: int, sha256: str):
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+        self._path: Optional[str] = None
+        self._path_lock = asyncio.Lock()
+        # 同一上传可能同时被多个请求读取（对冲），按偏移读取时保护文件位置
+        self._read_lock = threading.Lock()
+
+    @classmethod
+    async def from_upload(cls, upload, max_bytes: Optional[int] = None) -> "SpooledUpload":
+        """检查 UploadFile 的大小并计算哈希（在线程中一次读完，不复制文件）
+
+        Raises:
+            UploadTooLarge: 超过大小上限
+        """
+        max_bytes = max_bytes or max_upload_bytes()
+        size, sha256 = await asyncio.to_thread(cls._digest, upload.file, max_bytes)
+        return cls(upload.file, size, sha256)
+
+    @staticmethod
+    def _digest(file: BinaryIO, max_bytes: int) -> Tuple[int, str]:
+        digest = hashlib.sha256()
+        size = 0
+        file.seek(0)
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"上传文件超过 {max_bytes} 字节")
+            digest.update(chunk)
+        file.seek(0)
+        return size, digest.hexdigest()
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        with self._read_lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    async def local_path(self) -> str:
+        """返回内容所在的文件路径（预处理子进程按路径读取）
+
+        UploadFile.file 是没有路径的临时文件，只有在需要路径时才复制一份到 UPLOAD_SPOOL_DIR，且只复制一次
+        """
+        async with self._path_lock:
+            if self._path is None:
+                self._path = await asyncio.to_thread(self._spool, os.getenv("UPLOAD_SPOOL_DIR") or None)
+                logger.debug("Spooled upload to %s (%d bytes)", self._path, self.size)
+        return self._path
+
+    def _spool(self, directory: Optional[str]) -> str:
+        fd, path = tempfile.mkstemp(prefix="upload_", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                offset = 0
+                while True:
+                    chunk = self._read_at(offset, CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    offset += len(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path
+
+    async def iter_base64(self) -> AsyncIterator[bytes]:
+        """逐块产出文件内容的 base64 编码"""
+        offset = 0
+        while True:
+            chunk = await asyncio.to_thread(self._read_at, offset, BASE64_CHUNK_SIZE)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield base64.b64encode(chunk)
+
+    def close(self):
+        """删除为预处理复制的文件；UploadFile 本身由框架在请求结束时关闭"""
+        if self._path is None:
+            return
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+        self._path = None
+
+
+async def stream_json_with_image(payload: Dict[str, Any], image: SpooledUpload) -> AsyncIterator[bytes]:
+    """流式产出 {**payload, "images": [<image 的 base64>]} 的 JSON 请求体"""
+    head = json.dumps({key: value for key, value in payload.items() if key != "images"}, ensure_ascii=False)
+    separator = ", " if len(head) > 2 else ""
+    yield f'{head[:-1]}{separator}"images": ["'.encode("utf-8")
+    async for chunk in image.iter_base64():
+        yield chunk
+    yield b'"]}'
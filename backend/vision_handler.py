@@ -1,75 +1,238 @@
 import os
-from typing import Optional, Union
-import aiohttp
-import asyncio
+import time
+import logging
+from typing import AsyncIterator, Optional, Tuple, Union
 import base64
-from tenacity import retry, stop_after_attempt, wait_exponential
+from http_client import http_clients, iter_ndjson
+from metrics import TIME_TO_FIRST_TOKEN, track_stage
+from description_cache import DescriptionCache, content_hash
+from image_preprocess import ImagePreprocessor
+from logging_config import truncate
+from ollama_models import ollama_models
+from uploads import SpooledUpload, stream_json_with_image
+
+logger = logging.getLogger(__name__)
 
 class VisionModelHandler:
+    # 未指定提示词时使用
+    default_prompt = "请详细描述这张图片，包括主要物体、颜色、形状和风格特征。"
+
     def __init__(self):
         self.api_endpoint = os.getenv("VISION_MODEL_API_ENDPOINT", "http://localhost:11434/api/generate")
         self.model = os.getenv("VISION_MODEL", "llama3.2-vision:11b")
-        print(f"Debug - Vision API Endpoint: {self.api_endpoint}")
-        print(f"Debug - Vision Model: {self.model}")
+        logger.info("Vision API Endpoint: %s", self.api_endpoint)
+        logger.info("Vision Model: %s", self.model)
+        self.cache = DescriptionCache()
+        self.preprocessor = ImagePreprocessor()
+        # 与 OllamaHandler 共用模型的预载入、保活与并发上限
+        self.ollama = ollama_models.register(self.api_endpoint, self.model)
+
+    async def start(self):
+        await self.preprocessor.start()
+
+    async def close(self):
+        await self.preprocessor.close()
+
+    async def warm_up(self):
+        """启动预处理子进程，并让 Ollama 提前把视觉模型载入显存（只带 model 的请求不做推理）"""
+        await self.preprocessor.warm_up()
+        await ollama_models.load(self.ollama)
+
+    async def _prepare(self, image_data: Union[str, bytes, SpooledUpload], prompt: Optional[str]) -> Tuple[str, Optional[str], Optional[dict]]:
+        """查缓存并构建 Ollama 请求
+
+        Returns:
+            (缓存键, 命中的描述, 未命中时的请求payload)；
+            payload["images"] 中可能是 SpooledUpload，发送时由 _request_body 流式编码
+        """
+        prompt_text = str(prompt) if prompt else self.default_prompt
+
+        if isinstance(image_data, str) and image_data.startswith('http'):
+            # 已知URL直接按内容哈希查缓存，无需重新下载
+            known_hash = self.cache.lookup_url(image_data)
+            if known_hash:
+                cache_key = self.cache.make_key(known_hash, prompt_text, self.model)
+                cached = await self.cache.get(cache_key)
+                if cached is not None:
+                    logger.debug("Description cache hit (url)")
+                    return cache_key, cached, None
+
+            image_bytes, image_hash = await self._download(image_data)
+        elif isinstance(image_data, bytes):
+            image_bytes = image_data
+            image_hash = content_hash(image_bytes)
+        elif isinstance(image_data, SpooledUpload):
+            # 落盘的上传文件：哈希已在读取时算好，内容不进入内存
+            image_bytes = None
+            image_hash = image_data.sha256
+        else:
+            raise ValueError("不支持的图片数据格式")
+
+        cache_key = self.cache.make_key(image_hash, prompt_text, self.model)
+        cached = await self.cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Description cache hit")
+            return cache_key, cached, None
+
+        # 缩放与重新编码在进程池中完成；缓存键仍基于原图内容
+        if image_bytes is None:
+            # 子进程按路径读取上传文件（只在启用预处理时复制出路径）；无法缩小时发送原文件
+            if self.preprocessor.enabled:
+                image_bytes = await self.preprocessor.process_file(await image_data.local_path(), image_data.size)
+            logger.debug("Preprocessed upload: %d -> %s bytes", image_data.size,
+                         len(image_bytes) if image_bytes is not None else "unchanged")
+        else:
+            original_size = len(image_bytes)
+            image_bytes = await self.preprocessor.process(image_bytes)
+            logger.debug("Preprocessed image: %d -> %d bytes", original_size, len(image_bytes))
+
+        if image_bytes is None:
+            image = image_data
+        else:
+            with track_stage("base64_encode", "local"):
+                image = base64.b64encode(image_bytes).decode('utf-8')
+
+        # 构建 Ollama API 请求
+        payload = ollama_models.with_keep_alive({
+            "model": str(self.model),  # 确保模型名称是字符串
+            "prompt": prompt_text,
+            "stream": False,
+            "images": [image]
+        })
+        return cache_key, None, payload
+
+    async def _download(self, url: str) -> Tuple[bytes, str]:
+        """下载图片，记住 URL 对应的内容哈希，返回 (图片内容, 内容哈希)"""
+        logger.debug("Downloading image from URL: %s", url)
+        with track_stage("image_download", "http"):
+            async with http_clients.session(url).get(url) as response:
+                if response.status != 200:
+                    raise Exception(f"Failed to download image: {response.status}")
+                image_bytes = await response.read()
+                logger.debug("Successfully downloaded image (%d bytes)", len(image_bytes))
+        image_hash = content_hash(image_bytes)
+        self.cache.remember_url(url, image_hash)
+        return image_bytes, image_hash
+
+    async def prefetch(self, image_data: Union[str, bytes, SpooledUpload]) -> Union[str, bytes, SpooledUpload]:
+        """提前下载 URL 图片，返回可直接传给 analyze_image 的数据
+
+        已知内容哈希的 URL 原样返回（analyze_image 按哈希查缓存，命中时无需下载）。
+        """
+        if isinstance(image_data, str) and image_data.startswith('http') and not self.cache.lookup_url(image_data):
+            image_bytes, _ = await self._download(image_data)
+            return image_bytes
+        return image_data
+
+    async def encode_image(self, image_data: Union[str, bytes, SpooledUpload]) -> str:
+        """预处理图片并以 base64 编码，供其他 LLM 服务的处理器使用"""
+        if isinstance(image_data, str) and image_data.startswith('http'):
+            image_data, _ = await self._download(image_data)
+        if isinstance(image_data, bytes):
+            image_bytes = await self.preprocessor.process(image_data)
+        elif isinstance(image_data, SpooledUpload):
+            image_bytes = None
+            if self.preprocessor.enabled:
+                image_bytes = await self.preprocessor.process_file(await image_data.local_path(), image_data.size)
+            if image_bytes is None:
+                # 无法缩小时发送原文件
+                return b"".join([chunk async for chunk in image_data.iter_base64()]).decode('ascii')
+        else:
+            raise ValueError("不支持的图片数据格式")
+        with track_stage("base64_encode", "local"):
+            return base64.b64encode(image_bytes).decode('utf-8')
 
-    async def analyze_image(self, image_data: Union[str, bytes], prompt: Optional[str] = None) -> str:
+    @staticmethod
+    def _request_body(payload: dict) -> dict:
+        """请求参数：图片为落盘的上传文件时，JSON 请求体边读文件边编码，分块发送"""
+        image = payload["images"][0]
+        if isinstance(image, SpooledUpload):
+            return {"data": stream_json_with_image(payload, image)}
+        return {"json": payload}
+
+    async def analyze_image(self, image_data: Union[str, bytes, SpooledUpload], prompt: Optional[str] = None) -> str:
         try:
-            print(f"Debug - Analyzing image with prompt: {prompt}")
-            
-            if isinstance(image_data, str) and image_data.startswith('http'):
-                print(f"Debug - Downloading image from URL: {image_data}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(image_data) as response:
-                        if response.status != 200:
-                            raise Exception(f"Failed to download image: {response.status}")
-                        image_bytes = await response.read()
-                        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                        print("Debug - Successfully downloaded and encoded image")
-            elif isinstance(image_data, bytes):
-                image_base64 = base64.b64encode(image_data).decode('utf-8')
-            else:
-                raise ValueError("不支持的图片数据格式")
-
-            # 构建 Ollama API 请求
-            payload = {
-                "model": str(self.model),  # 确保模型名称是字符串
-                "prompt": str(prompt) if prompt else "请详细描述这张图片，包括主要物体、颜色、形状和风格特征。",
-                "stream": False,
-                "images": [str(image_base64)]  # 确保图片数据是字符串
-            }
-
-            print(f"Debug - Sending request to Ollama API: {self.api_endpoint}")
-            print(f"Debug - Request payload: {payload}")
-
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
+            logger.debug("Analyzing image with prompt: %s", prompt)
+            cache_key, cached, payload = await self._prepare(image_data, prompt)
+            if cached is not None:
+                return cached
+
+            logger.debug("Sending request to Ollama API: %s", self.api_endpoint)
+            # 图片以 base64 放在 payload 中，只记录截断后的摘要
+            logger.debug("Request payload: %s", truncate(payload))
+
+            async with ollama_models.slot(self.ollama), track_stage("vision_inference", "ollama"):
+                async with http_clients.session(self.api_endpoint).post(
                     str(self.api_endpoint),  # 确保URL是字符串
                     headers={"Content-Type": "application/json"},
-                    json=payload
+                    **self._request_body(payload)
                 ) as response:
                     response_text = await response.text()
-                    print(f"Debug - Raw response: {response_text}")
-                    
+                    logger.debug("Raw response: %s", truncate(response_text))
+                
                     if response.status != 200:
                         raise Exception(f"Vision API请求失败: {response.status}, {response_text}")
-                    
+                
                     result = await response.json()
                     description = result.get("response", "无法解析图片")
-                    print(f"Debug - Generated description: {description}")
-                    
+                    logger.debug("Generated description: %s", truncate(description))
+                
+                    if "response" in result:
+                        await self.cache.set(cache_key, description)
                     return description
 
         except Exception as e:
-            print(f"Debug - Error in analyze_image: {str(e)}")
+            logger.error("Error in analyze_image: %s", e)
+            raise Exception(f"图片分析失败: {str(e)}")
+
+    async def analyze_image_stream(self, image_data: Union[str, bytes, SpooledUpload], prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """流式分析图片，逐段产出描述文本；完整描述写入缓存"""
+        try:
+            started = time.perf_counter()
+            cache_key, cached, payload = await self._prepare(image_data, prompt)
+            if cached is not None:
+                yield cached
+                return
+
+            payload["stream"] = True
+            parts = []
+            async with ollama_models.slot(self.ollama), track_stage("vision_inference_stream", "ollama"):
+                async with http_clients.session(self.api_endpoint).post(
+                    str(self.api_endpoint),
+                    headers={"Content-Type": "application/json"},
+                    **self._request_body(payload)
+                ) as response:
+                    if response.status != 200:
+                        response_text = await response.text()
+                        raise Exception(f"Vision API请求失败: {response.status}, {response_text}")
+
+                    async for chunk in iter_ndjson(response):
+                        if chunk.get("error"):
+                            raise Exception(chunk["error"])
+                        text = chunk.get("response", "")
+                        if text:
+                            if not parts:
+                                TIME_TO_FIRST_TOKEN.labels(backend="vision").observe(time.perf_counter() - started)
+                            parts.append(text)
+                            yield text
+                        if chunk.get("done"):
+                            break
+
+            description = "".join(parts)
+            logger.debug("Generated description: %s", truncate(description))
+            if description:
+                await self.cache.set(cache_key, description)
+
+        except Exception as e:
+            logger.error("Error in analyze_image_stream: %s", e)
             raise Exception(f"图片分析失败: {str(e)}")
 
     @staticmethod
     async def is_valid_image_url(url: str) -> bool:
         """异步验证图片URL"""
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.head(url) as response:
-                    return (response.status == 200 and 
-                           'image' in response.headers.get('content-type', ''))
-            except:
-                return False
\ No newline at end of file
+        try:
+            async with http_clients.session(url).head(url) as response:
+                return (response.status == 200 and 
+                       'image' in response.headers.get('content-type', ''))
+        except:
+            return False
\ No newline at end of file
@@ -0,0 +1,161 @@
+import os
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 可按请求修改的位置
+PATCH_POINTS = ("positive", "negative", "seed", "steps", "width", "height", "batch_size")
+
+# 模板节点预先序列化好的 JSON 片段，按对象 id 索引；同时保存节点本身，用于确认身份
+_fragments: Dict[int, Tuple[Dict[str, Any], str]] = {}
+
+
+def _dumps(value: Any) -> str:
+    """规范化序列化：键排序、无多余空白"""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def _is_link(value: Any) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def serialize_workflow(workflow: Dict[str, Any]) -> str:
+    """序列化工作流，结果与 json.dumps(workflow, sort_keys=True) 的紧凑形式一致
+
+    未被修改的模板节点直接复用预先序列化的片段，只有被修改的节点需要重新序列化。
+    """
+    parts = []
+    for node_id in sorted(workflow):
+        node = workflow[node_id]
+        cached = _fragments.get(id(node))
+        fragment = cached[1] if cached is not None and cached[0] is node else _dumps(node)
+        parts.append(f"{_dumps(node_id)}:{fragment}")
+    return "{" + ",".join(parts) + "}"
+
+
+class WorkflowValidationError(ValueError):
+    """工作流文件不合法"""
+
+
+class PreparedWorkflow(dict):
+    """由模板构建的工作流，附带来源模板与质量档位（序号，未调整质量时为 None）"""
+    __slots__ = ("template", "quality")
+
+
+class WorkflowTemplate:
+    """不可变的工作流模板
+
+    加载时校验节点图并识别修改点（正/负提示词、种子、步数、尺寸、batch_size），
+    build() 只复制被修改的节点，其余节点与模板共享。
+    """
+
+    def __init__(self, name: str, nodes: Dict[str, Any]):
+        self.name = name
+        self.nodes = nodes
+        self._validate()
+        self.patch_points = self._find_patch_points()
+        for node in nodes.values():
+            _fragments[id(node)] = (node, _dumps(node))
+
+    def build(self, **values: Any) -> PreparedWorkflow:
+        """按修改点构建本次请求的工作流"""
+        return self.patch(self.nodes, **values)
+
+    def patch(self, workflow: Dict[str, Any], **values: Any) -> PreparedWorkflow:
+        """在已有工作流上修改，返回新的工作流（原工作流不变）"""
+        prepared = PreparedWorkflow(workflow)
+        prepared.template = self
+        prepared.quality = getattr(workflow, "quality", None)
+        by_node: Dict[str, Dict[str, Any]] = {}
+        for point, value in values.items():
+            if point not in self.patch_points:
+                raise ValueError(f"工作流 {self.name} 不支持修改 {point}")
+            node_id, input_name = self.patch_points[point]
+            by_node.setdefault(node_id, {})[input_name] = value
+        for node_id, inputs in by_node.items():
+            node = prepared[node_id]
+            prepared[node_id] = {**node, "inputs": {**node["inputs"], **inputs}}
+        return prepared
+
+    def get(self, workflow: Dict[str, Any], point: str) -> Any:
+        """读取工作流中某个修改点的当前值"""
+        node_id, input_name = self.patch_points[point]
+        return workflow[node_id]["inputs"].get(input_name)
+
+    def _validate(self):
+        if not isinstance(self.nodes, dict) or not self.nodes:
+            raise WorkflowValidationError(f"{self.name}: 工作流为空")
+        for node_id, node in self.nodes.items():
+            if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                raise WorkflowValidationError(f"{self.name}: 节点 {node_id} 缺少 class_type 或 inputs")
+            for name, value in node["inputs"].items():
+                if _is_link(value) and value[0] not in self.nodes:
+                    raise WorkflowValidationError(f"{self.name}: 节点 {node_id}.{name} 引用了不存在的节点 {value[0]}")
+        if not self._nodes_of("SaveImage"):
+            raise WorkflowValidationError(f"{self.name}: 没有 SaveImage 输出节点")
+
+    def _nodes_of(self, class_type: str) -> List[str]:
+        return [node_id for node_id, node in self.nodes.items() if node["class_type"] == class_type]
+
+    def _find_patch_points(self) -> Dict[str, Tuple[str, str]]:
+        """根据 KSampler 的连接识别修改点"""
+        points: Dict[str, Tuple[str, str]] = {}
+        samplers = self._nodes_of("KSampler")
+        if len(samplers) != 1:
+            raise WorkflowValidationError(f"{self.name}: 需要且只能有一个 KSampler 节点")
+        sampler_id = samplers[0]
+        sampler_inputs = self.nodes[sampler_id]["inputs"]
+        points["seed"] = (sampler_id, "seed")
+        points["steps"] = (sampler_id, "steps")
+
+        for point, input_name in (("positive", "positive"), ("negative", "negative")):
+            link = sampler_inputs.get(input_name)
+            if _is_link(link) and self.nodes[link[0]]["class_type"] == "CLIPTextEncode":
+                points[point] = (link[0], "text")
+        if "positive" not in points:
+            raise WorkflowValidationError(f"{self.name}: 找不到正面提示词节点")
+
+        latent = sampler_inputs.get("latent_image")
+        if _is_link(latent) and self.nodes[latent[0]]["class_type"] == "EmptyLatentImage":
+            for point in ("width", "height", "batch_size"):
+                points[point] = (latent[0], point)
+        return points
+
+
+class WorkflowRegistry:
+    """启动时加载 workflows/ 下的所有工作流模板"""
+
+    def __init__(self, directory: Optional[str] = None, default: Optional[str] = None):
+        self.directory = Path(directory or os.path.join(os.path.dirname(__file__), "..", "workflows"))
+        self.default = default or os.getenv("COMFY_UI_DEFAULT_WORKFLOW", "BasicImGen")
+        self._templates: Dict[str, WorkflowTemplate] = {}
+
+    def load(self):
+        templates = {}
+        for path in sorted(self.directory.glob("*.json")):
+            try:
+                with open(path, "r") as f:
+                    templates[path.stem] = WorkflowTemplate(path.stem, json.load(f))
+            except (json.JSONDecodeError, WorkflowValidationError) as e:
+                logger.warning("跳过无效的工作流 %s: %s", path.name, e)
+        self._templates = templates
+        logger.info("Loaded workflows: %s", ", ".join(templates) or "(none)")
+
+    def get(self, name: Optional[str] = None) -> WorkflowTemplate:
+        template = self._templates.get(name or self.default)
+        if template is None:
+            raise ValueError(f"未知的工作流: {name or self.default}。可用的工作流有: {', '.join(self._templates)}")
+        return template
+
+    def names(self) -> List[str]:
+        return list(self._templates)
+
+    def describe(self) -> Dict[str, Dict[str, Any]]:
+        """各模板的修改点及其默认值"""
+        return {
+            name: {point: template.get(template.nodes, point) for point in template.patch_points}
+            for name, template in self._templates.items()
+        }
@@ -12,11 +12,20 @@ export default defineConfig(({ mode }) => {
     VITE_API_ENDPOINT: env.VITE_API_ENDPOINT
   })
 
+  // 生成的图片由后端的图片存储提供，不再复制到 public 目录
+  const imageProxy = {
+    '/static/images': env.VITE_BACKEND_URL || 'http://localhost:8000',
+  }
+
   return {
     plugins: [react()],
     server: {
       host: true,
       port: 5173,
+      proxy: imageProxy,
+    },
+    preview: {
+      proxy: imageProxy,
     },
     build: {
       assetsDir: 'static',